@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, sys
+import time
+import json
+import types
+import logging
+from logging.handlers import QueueHandler
+import argparse
+
+# load libs: the stand-ins, then the Add-on lib and bin directories of the working tree, then the third party libs
+# of the last build (splunklib, splunktaucclib) if any
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(bench_dir, 'libs'))
+sys.path.append(os.path.join(bench_dir, '..', 'package', 'lib'))
+sys.path.append(os.path.join(bench_dir, '..', 'package', 'bin'))
+sys.path.append(os.path.join(bench_dir, '..', 'output', 'splunk_start_defender', 'lib'))
+
+from stand_ins import FakeStoragePasswords, FakeService, build_account_credentials, build_in_string
+from servers import FakeCircServer, FakeRelayServer
+
+# Args
+parser = argparse.ArgumentParser(description='Measure the throughput and latency of the client, REST handler and relayed paths against a local fake Defender API')
+parser.add_argument('--scenarios', dest='scenarios', default='single,bulk,async,handler,handler_batch,relayed,relayed_batch',
+    help='comma separated list of scenarios: single, bulk, async, handler, handler_batch, relayed, relayed_batch')
+parser.add_argument('--action', dest='action', default='status', choices=['status', 'scan'], help='the Defender API action to run')
+parser.add_argument('--requests', dest='requests', type=int, default=500, help='number of computer names processed per scenario')
+parser.add_argument('--hosts', dest='hosts', type=int, default=0, help='number of distinct computer names, 0 for all distinct (repeated names are served by the relay status cache)')
+parser.add_argument('--concurrency', dest='concurrency', type=int, default=10, help='maximum concurrency of the bulk, handler and relayed scenarios')
+parser.add_argument('--batch-size', dest='batch_size', type=int, default=100, help='number of computer names per relay batch')
+parser.add_argument('--latency-ms', dest='latency_ms', type=float, default=20, help='fake Defender API latency')
+parser.add_argument('--jitter-ms', dest='jitter_ms', type=float, default=10, help='fake Defender API latency jitter, added uniformly to the latency')
+parser.add_argument('--error-rate', dest='error_rate', type=float, default=0.0, help='ratio of fake Defender API calls failing with a 503')
+parser.add_argument('--payload-size', dest='payload_size', type=int, default=512, help='bytes of padding in the fake Defender API responses')
+parser.add_argument('--status-cache-ttl', dest='status_cache_ttl', type=int, default=30, help='relay status cache ttl, 0 to disable the cache')
+parser.add_argument('--breaker-failure-threshold', dest='breaker_failure_threshold', type=int, default=5, help='relay circuit breaker failure threshold, 0 to disable the circuit breaker')
+parser.add_argument('--json', dest='json', action='store_true', help='print the results as JSON')
+parser.add_argument('--debug', dest='debug', action='store_true', help='log the Add-on messages to stdout')
+args = parser.parse_args()
+
+# set logging, the Add-on messages are only shown in debug
+root = logging.getLogger()
+root.setLevel(logging.INFO)
+if args.debug:
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root.addHandler(handler)
+else:
+    root.addHandler(logging.NullHandler())
+
+# the REST handler, its queued file logger is removed so that the benchmark does not write into the splunkd logs
+import splunk_start_manager_rest_handler as rest_handler_module
+import lib_splunk_start_defender_splunkd
+from lib_splunk_start_defender_logging import splunk_start_defender_stop_logging
+for hdlr in root.handlers[:]:
+    if isinstance(hdlr, QueueHandler):
+        root.removeHandler(hdlr)
+splunk_start_defender_stop_logging()
+
+from lib_splunk_start_defender import circ_get_status, circ_start_scan, circ_relay_get_status, circ_relay_start_scan, \
+    circ_relay_get_status_batch, circ_relay_start_scan_batch, splunk_start_defender_run_concurrent, splunk_start_defender_run_batches
+from lib_splunk_start_defender_async import circ_get_status_async, circ_start_scan_async, splunk_start_defender_run_async
+from lib_splunk_start_defender_credentials import account_credential_realm, credential_separator, credential_end_mark
+
+account = 'bench'
+circ_token = 'bench_circ_token'
+relay_token = 'bench_relay_token'
+
+
+# build the splunkd stand-in of the relay, with the account pointing to the fake Defender API
+def build_service(circ_url):
+
+    credentials = build_account_credentials(account_credential_realm, credential_separator, credential_end_mark,
+        account, json.dumps({'circ_token': circ_token}))
+
+    return FakeService({
+        'splunk_start_defender_settings': {
+            'role': {'instance_role': 'splunk_relay'},
+            'logging': {'loglevel': 'DEBUG' if args.debug else 'INFO'},
+            'relay': {'status_cache_ttl': str(args.status_cache_ttl), 'breaker_failure_threshold': str(args.breaker_failure_threshold)},
+        },
+        'splunk_start_defender_account': {
+            account: {'circ_url': circ_url},
+        },
+    }, FakeStoragePasswords(credentials))
+
+
+# the percentile of sorted values, nearest rank
+def percentile(values, ratio):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, max(0, int(round(ratio * len(values) + 0.5)) - 1))]
+
+
+# call the REST handler as splunkd does, and raise on errors as the client functions do
+def handle(handler, path_info, payload):
+    response = handler.handle(build_in_string('POST', path_info, payload))
+    if response.get('status') != 200:
+        raise Exception(f"HTTP status code: {response.get('status')}, response: {response.get('payload')}")
+    return response.get('payload')
+
+
+def get_scenario(name, handler, circ_url, relay_url):
+    """
+    Return a tuple (func, batched), func processes one computer name, or a list of computer names if batched.
+    For the async scenario, func is a coroutine function of the client and the computer name.
+    """
+
+    fullscan = False
+
+    if name in ('single', 'bulk'):
+        if args.action == 'status':
+            return lambda computername: circ_get_status(circ_token, computername, circ_url), False
+        return lambda computername: circ_start_scan(circ_token, computername, circ_url, fullscan), False
+
+    elif name == 'async':
+        if args.action == 'status':
+            return lambda client, computername: circ_get_status_async(client, circ_token, computername, circ_url), False
+        return lambda client, computername: circ_start_scan_async(client, circ_token, computername, circ_url, fullscan), False
+
+    elif name == 'handler':
+        if args.action == 'status':
+            return lambda computername: handle(handler, 'relay_circ_get_status', {'account': account, 'computername': computername}), False
+        return lambda computername: handle(handler, 'relay_circ_start_scan', {'account': account, 'computername': computername, 'fullscan': fullscan}), False
+
+    elif name == 'handler_batch':
+        if args.action == 'status':
+            return lambda batch: handle(handler, 'relay_circ_get_status_batch', {'account': account, 'computernames': batch, 'max_concurrency': args.concurrency}), True
+        return lambda batch: handle(handler, 'relay_circ_start_scan_batch', {'account': account, 'computernames': batch, 'fullscan': fullscan, 'max_concurrency': args.concurrency}), True
+
+    elif name == 'relayed':
+        if args.action == 'status':
+            return lambda computername: circ_relay_get_status(account, relay_token, computername, relay_url), False
+        return lambda computername: circ_relay_start_scan(account, relay_token, computername, relay_url, fullscan), False
+
+    elif name == 'relayed_batch':
+        if args.action == 'status':
+            return lambda batch: circ_relay_get_status_batch(account, relay_token, batch, relay_url, args.concurrency), True
+        return lambda batch: circ_relay_start_scan_batch(account, relay_token, batch, relay_url, fullscan, args.concurrency), True
+
+    raise ValueError(f"Unknown scenario=\"{name}\"")
+
+
+def run_scenario(name, handler, circ, relay):
+
+    func, batched = get_scenario(name, handler, circ.url, relay.url)
+    hosts = args.hosts or args.requests
+    computernames = [f"bench-{index % hosts:06d}" for index in range(args.requests)]
+
+    # every scenario starts from an empty status cache and closed circuit breakers, with the account already resolved
+    rest_handler_module.status_cache.clear()
+    rest_handler_module.circuit_breakers.clear()
+    with circ.requests_lock:
+        circ.requests.clear()
+
+    # latency of each call: a computer name, or a batch of computer names
+    latencies = []
+
+    def timed_func(item):
+        start = time.perf_counter()
+        try:
+            return func(item)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    errors = 0
+    start = time.perf_counter()
+
+    if name == 'single':
+        for computername in computernames:
+            try:
+                timed_func(computername)
+            except Exception:
+                errors += 1
+
+    elif name == 'async':
+
+        async def timed_coroutine(client, item):
+            start = time.perf_counter()
+            try:
+                return await func(client, item)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+        for computername, response, exception in splunk_start_defender_run_async(timed_coroutine, computernames, args.concurrency):
+            if exception is not None:
+                errors += 1
+
+    elif batched:
+        for computername, response, exception in splunk_start_defender_run_batches(timed_func, computernames, args.batch_size):
+            if exception is not None:
+                errors += 1
+
+    else:
+        for computername, response, exception in splunk_start_defender_run_concurrent(timed_func, computernames, args.concurrency):
+            if exception is not None:
+                errors += 1
+
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    return {
+        'scenario': name,
+        'action': args.action,
+        'items': len(computernames),
+        'calls': len(latencies),
+        'errors': errors,
+        'circ_calls': sum(circ.requests.values()),
+        'elapsed_s': round(elapsed, 3),
+        'items_per_s': round(len(computernames) / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+if __name__ == '__main__':
+
+    circ = FakeCircServer(args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate, args.payload_size).start()
+
+    # the REST handler of the relay, as instantiated by splunkd, connecting to the splunkd stand-in
+    service = build_service(circ.url)
+    lib_splunk_start_defender_splunkd.client = types.SimpleNamespace(connect=service.connect)
+    handler = rest_handler_module.SplunkStartDefender_v1(None, None)
+    relay = FakeRelayServer(handler).start()
+
+    # resolve the account once, the hot path then serves it from the accounts cache
+    handle(handler, 'relay_circ_get_status', {'account': account, 'computername': 'bench-warmup'})
+
+    results = []
+    try:
+        for name in [name.strip() for name in args.scenarios.split(',') if name.strip()]:
+            results.append(run_scenario(name, handler, circ, relay))
+    finally:
+        relay.stop()
+        circ.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        sys.exit(0)
+
+    print(f"latency_ms={args.latency_ms}, jitter_ms={args.jitter_ms}, error_rate={args.error_rate}, payload_size={args.payload_size}, "
+        f"requests={args.requests}, hosts={args.hosts or args.requests}, concurrency={args.concurrency}, batch_size={args.batch_size}, "
+        f"status_cache_ttl={args.status_cache_ttl}, breaker_failure_threshold={args.breaker_failure_threshold}, splunkd_connections={service.connections}")
+    print("")
+    print(f"{'scenario':>13} | {'action':>6} | {'items':>6} | {'calls':>6} | {'errors':>6} | {'circ_calls':>10} | {'items_per_s':>11} | {'p50_ms':>8} | {'p95_ms':>8} | {'p99_ms':>8}")
+    print("-" * 112)
+    for result in results:
+        print(f"{result['scenario']:>13} | {result['action']:>6} | {result['items']:>6} | {result['calls']:>6} | {result['errors']:>6} | {result['circ_calls']:>10} | "
+            f"{result['items_per_s']:>11} | {result['p50_ms']:>8} | {result['p95_ms']:>8} | {result['p99_ms']:>8}")
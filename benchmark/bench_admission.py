@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, sys
+import json
+import time
+import types
+import logging
+from logging.handlers import QueueHandler
+import argparse
+import threading
+import concurrent.futures
+
+# load libs: the stand-ins, then the Add-on lib and bin directories of the working tree, then the third party libs
+# of the last build (splunklib, splunktaucclib) if any
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(bench_dir, 'libs'))
+sys.path.append(os.path.join(bench_dir, '..', 'package', 'lib'))
+sys.path.append(os.path.join(bench_dir, '..', 'package', 'bin'))
+sys.path.append(os.path.join(bench_dir, '..', 'output', 'splunk_start_defender', 'lib'))
+
+from stand_ins import FakeService, FakeStoragePasswords, build_account_credentials, build_in_string
+from servers import FakeCircServer
+
+# Args
+parser = argparse.ArgumentParser(description='Send a burst of get status requests of an account to the relay REST handler, with and without admission control, while another account sends requests at a steady pace')
+parser.add_argument('--burst', dest='burst', type=int, default=300, help='number of concurrent get status requests of the bursting account')
+parser.add_argument('--steady', dest='steady', type=int, default=20, help='number of sequential get status requests of the other account during the burst')
+parser.add_argument('--max-workers', dest='max_workers', type=int, default=40, help='max_workers relay setting of the bounded mode')
+parser.add_argument('--max-queued', dest='max_queued', type=int, default=100, help='max_queued relay setting of the bounded mode')
+parser.add_argument('--account-max-workers', dest='account_max_workers', type=int, default=20, help='account_max_workers relay setting of the bounded mode')
+parser.add_argument('--latency-ms', dest='latency_ms', type=float, default=50, help='fake Defender API latency per request')
+parser.add_argument('--json', dest='json', action='store_true', help='print the results as JSON')
+args = parser.parse_args()
+
+# set logging, the Add-on messages are not shown
+root = logging.getLogger()
+root.setLevel(logging.INFO)
+root.addHandler(logging.NullHandler())
+
+# the REST handler, its queued file logger is removed so that the benchmark does not write into the splunkd logs
+import splunk_start_manager_rest_handler as rest_handler_module
+import lib_splunk_start_defender_splunkd
+from lib_splunk_start_defender_logging import splunk_start_defender_stop_logging
+for hdlr in root.handlers[:]:
+    if isinstance(hdlr, QueueHandler):
+        root.removeHandler(hdlr)
+splunk_start_defender_stop_logging()
+
+from lib_splunk_start_defender_credentials import account_credential_realm, credential_separator, credential_end_mark
+
+burst_account = 'bench'
+steady_account = 'steady'
+
+
+# build the splunkd stand-in of the relay with the admission settings of the mode, the status cache and the circuit
+# breaker are disabled so that every request calls the Defender API
+def build_service(circ_url, max_workers, max_queued, account_max_workers):
+
+    credentials = []
+    for account in (burst_account, steady_account):
+        credentials.extend(build_account_credentials(account_credential_realm, credential_separator, credential_end_mark,
+            account, json.dumps({'circ_token': 'bench_circ_token'})))
+
+    return FakeService({
+        'splunk_start_defender_settings': {
+            'role': {'instance_role': 'splunk_relay'},
+            'logging': {'loglevel': 'INFO'},
+            'relay': {
+                'status_cache_ttl': '0',
+                'breaker_failure_threshold': '0',
+                'max_workers': str(max_workers),
+                'max_queued': str(max_queued),
+                'account_max_workers': str(account_max_workers),
+            },
+        },
+        'splunk_start_defender_account': {
+            burst_account: {'circ_url': circ_url},
+            steady_account: {'circ_url': circ_url},
+        },
+    }, FakeStoragePasswords(credentials))
+
+
+# call the relay get status endpoint as splunkd does, returns (status, latency, retry_after)
+def get_status(handler, account, computername):
+    start = time.perf_counter()
+    response = handler.handle(build_in_string('POST', 'relay_circ_get_status', json.dumps({'account': account, 'computername': computername})))
+    latency = time.perf_counter() - start
+    return response.get('status'), latency, (response.get('headers') or {}).get('Retry-After')
+
+
+def percentile_ms(values, ratio):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(ratio * len(values)))] * 1000, 2)
+
+
+def run_mode(name, circ, handler, max_workers, max_queued, account_max_workers):
+
+    # the handler reads the settings of the mode
+    service = build_service(circ.url, max_workers, max_queued, account_max_workers)
+    lib_splunk_start_defender_splunkd.client = types.SimpleNamespace(connect=service.connect)
+    rest_handler_module.splunkd_services.clear()
+    rest_handler_module.config_snapshots.clear()
+    with rest_handler_module.account_cache_lock:
+        rest_handler_module.account_cache['accounts'].clear()
+    for account in (burst_account, steady_account):
+        get_status(handler, account, 'bench-warmup')
+    circ.max_in_flight = 0
+
+    steady_latencies = []
+
+    # the other account sends its requests one after the other during the burst
+    def steady():
+        for index in range(args.steady):
+            status, latency, retry_after = get_status(handler, steady_account, f"steady-{index}")
+            if status == 200:
+                steady_latencies.append(latency)
+
+    start = time.perf_counter()
+    steady_thread = threading.Thread(target=steady)
+    steady_thread.start()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.burst) as executor:
+        responses = list(executor.map(lambda index: get_status(handler, burst_account, f"burst-{index}"), range(args.burst)))
+    steady_thread.join()
+    elapsed = time.perf_counter() - start
+
+    accepted = [latency for status, latency, retry_after in responses if status == 200]
+    rejected = [latency for status, latency, retry_after in responses if status == 429]
+    retry_afters = [int(retry_after) for status, latency, retry_after in responses if status == 429 and retry_after]
+
+    return {
+        'mode': name,
+        'burst': args.burst,
+        'accepted': len(accepted),
+        'rejected': len(rejected),
+        'circ_max_in_flight': circ.max_in_flight,
+        'accepted_p50_ms': percentile_ms(accepted, 0.5),
+        'accepted_max_ms': percentile_ms(accepted, 1),
+        'rejected_max_ms': percentile_ms(rejected, 1),
+        'retry_after': f"{min(retry_afters)}-{max(retry_afters)}" if retry_afters else None,
+        'steady_p50_ms': percentile_ms(steady_latencies, 0.5),
+        'elapsed_s': round(elapsed, 2),
+    }
+
+
+if __name__ == '__main__':
+
+    circ = FakeCircServer(args.latency_ms / 1000, 0, 0, 128).start()
+
+    # the REST handler of the relay, as instantiated by splunkd, connecting to the splunkd stand-in
+    handler = rest_handler_module.SplunkStartDefender_v1(None, None)
+
+    results = []
+    try:
+        results.append(run_mode('unbounded', circ, handler, 0, 0, 0))
+        results.append(run_mode('bounded', circ, handler, args.max_workers, args.max_queued, args.account_max_workers))
+    finally:
+        circ.stop()
+
+    if args.json:
+        print(json.dumps({'results': results}, indent=2))
+        sys.exit(0)
+
+    print(f"burst={args.burst}, steady={args.steady}, max_workers={args.max_workers}, max_queued={args.max_queued}, "
+        f"account_max_workers={args.account_max_workers}, latency_ms={args.latency_ms}")
+    print("")
+    print(f"{'mode':>9} | {'accepted':>8} | {'rejected':>8} | {'circ_max_in_flight':>18} | {'accepted_p50_ms':>15} | "
+        f"{'accepted_max_ms':>15} | {'rejected_max_ms':>15} | {'retry_after':>11} | {'steady_p50_ms':>13}")
+    print("-" * 138)
+    for result in results:
+        print(f"{result['mode']:>9} | {result['accepted']:>8} | {result['rejected']:>8} | {result['circ_max_in_flight']:>18} | "
+            f"{str(result['accepted_p50_ms']):>15} | {str(result['accepted_max_ms']):>15} | {str(result['rejected_max_ms']):>15} | "
+            f"{str(result['retry_after']):>11} | {str(result['steady_p50_ms']):>13}")
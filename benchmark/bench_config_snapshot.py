@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, sys
+import json
+import time
+import shutil
+import logging
+from logging.handlers import QueueHandler
+import argparse
+import tempfile
+
+# load libs: the stand-ins, then the Add-on lib and bin directories of the working tree, then the third party libs
+# of the last build (splunklib, splunktaucclib) if any
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(bench_dir, 'libs'))
+sys.path.append(os.path.join(bench_dir, '..', 'package', 'lib'))
+sys.path.append(os.path.join(bench_dir, '..', 'package', 'bin'))
+sys.path.append(os.path.join(bench_dir, '..', 'output', 'splunk_start_defender', 'lib'))
+
+from stand_ins import build_account_credentials, build_in_string
+from servers import FakeSplunkdServer
+
+# Args
+parser = argparse.ArgumentParser(description='Compare reading the conf files from splunkd on every request against the configuration snapshot of the REST handler, and verify that a replicated change is detected')
+parser.add_argument('--requests', dest='requests', type=int, default=500, help='number of requests per endpoint and mode')
+parser.add_argument('--accounts', dest='accounts', type=int, default=20, help='number of accounts configured')
+parser.add_argument('--latency-ms', dest='latency_ms', type=float, default=1, help='fake splunkd latency per request')
+parser.add_argument('--json', dest='json', action='store_true', help='print the results as JSON')
+args = parser.parse_args()
+
+# set logging, the Add-on messages are not shown
+root = logging.getLogger()
+root.setLevel(logging.INFO)
+root.addHandler(logging.NullHandler())
+
+# the REST handler, its queued file logger is removed so that the benchmark does not write into the splunkd logs
+import splunk_start_manager_rest_handler as rest_handler_module
+from lib_splunk_start_defender_logging import splunk_start_defender_stop_logging
+for hdlr in root.handlers[:]:
+    if isinstance(hdlr, QueueHandler):
+        root.removeHandler(hdlr)
+splunk_start_defender_stop_logging()
+
+import lib_splunk_start_defender_config
+from lib_splunk_start_defender_config import ConfigSnapshotCache
+from lib_splunk_start_defender_credentials import account_credential_realm, credential_separator, credential_end_mark
+
+account = 'bench'
+token = 'bench_session_key'
+
+# the conf files of the app are watched in a temporary directory rather than in the app of SPLUNK_HOME
+app_home = tempfile.mkdtemp(prefix='splunk_start_defender_bench_')
+lib_splunk_start_defender_config.app_home = app_home
+os.makedirs(os.path.join(app_home, 'local'))
+
+
+# write the account conf file of the app, as the replication of a search head cluster does
+def write_account_conf(accounts):
+    with open(os.path.join(app_home, 'local', 'splunk_start_defender_account.conf'), 'w') as f:
+        for name, content in accounts.items():
+            f.write(f"[{name}]\n" + ''.join(f"{key} = {value}\n" for key, value in content.items()) + "\n")
+
+
+def build_server():
+
+    accounts = dict((f"account{index}", {'circ_url': f"https://circ{index}.bench"}) for index in range(args.accounts))
+    accounts[account] = {'circ_url': 'https://circ.bench'}
+    write_account_conf(accounts)
+
+    credentials = build_account_credentials(account_credential_realm, credential_separator, credential_end_mark,
+        account, json.dumps({'circ_token': 'bench_circ_token'}))
+
+    return FakeSplunkdServer({
+        'splunk_start_defender_settings': {
+            'role': {'instance_role': 'splunk_relay'},
+            'logging': {'loglevel': 'INFO'},
+            'relay': {'status_cache_ttl': '30', 'breaker_failure_threshold': '5', 'breaker_reset_timeout': '30'},
+            'timeouts': {'connect_timeout': '10', 'read_timeout': '60', 'search_timeout': '900'},
+            'proxy': {'proxy_enabled': '0'},
+        },
+        'splunk_start_defender_account': accounts,
+    }, credentials, token, latency=args.latency_ms / 1000).start()
+
+
+def call(handler, port, method, path_info, payload=None):
+
+    response = handler.handle(build_in_string(method, path_info, json.dumps(payload) if payload else None, port=port, authtoken=token))
+    if response.get('status') != 200:
+        raise Exception(f"HTTP status code: {response.get('status')}, response: {response.get('payload')}")
+
+    return response.get('payload')
+
+
+# the endpoints reading the configuration: the conf endpoint, and the account resolution once the accounts cache
+# expired (the decoded credentials stay cached, only the conf files are compared)
+endpoints = {
+    'conf': lambda handler, port: call(handler, port, 'GET', 'splunk_start_defender_conf'),
+    'account': lambda handler, port: call(handler, port, 'POST', 'command_context', {'account': account}),
+}
+
+
+def run_mode(name, snapshots, handler, server):
+
+    rest_handler_module.config_snapshots = snapshots
+    port = server.server_address[1]
+
+    results = []
+
+    for endpoint, func in endpoints.items():
+
+        server.requests.clear()
+        latencies = []
+
+        for request in range(args.requests):
+            with rest_handler_module.account_cache_lock:
+                rest_handler_module.account_cache['accounts'].clear()
+            start = time.perf_counter()
+            func(handler, port)
+            latencies.append(time.perf_counter() - start)
+
+        latencies.sort()
+        results.append({
+            'mode': name,
+            'endpoint': endpoint,
+            'requests': args.requests,
+            'splunkd_requests': server.requests.get('requests', 0),
+            'avg_us': round(sum(latencies) / len(latencies) * 1000000, 1),
+            'p50_us': round(latencies[len(latencies) // 2] * 1000000, 1),
+        })
+
+    return results
+
+
+if __name__ == '__main__':
+
+    server = build_server()
+    handler = rest_handler_module.SplunkStartDefender_v1(None, None)
+
+    results = []
+    try:
+        # reading the conf files on every request is a snapshot that is never fresh
+        results.extend(run_mode('read', ConfigSnapshotCache(max_age=0), handler, server))
+        snapshots = ConfigSnapshotCache()
+        results.extend(run_mode('snapshot', snapshots, handler, server))
+
+        # a change replicated from another member of the cluster: the conf file and splunkd are updated, the
+        # configuration generation marker of this instance is not
+        loads = snapshots.loads
+        accounts = dict(server.confs['splunk_start_defender_account'])
+        accounts[account] = {'circ_url': 'https://circ-replicated.bench'}
+        server.confs['splunk_start_defender_account'] = accounts
+        write_account_conf(accounts)
+        with rest_handler_module.account_cache_lock:
+            rest_handler_module.account_cache['accounts'].clear()
+        context = endpoints['account'](handler, server.server_address[1])
+        replicated_change = {
+            'detected': context['account'].get('circ_url') == 'https://circ-replicated.bench',
+            'snapshot_loads': snapshots.loads - loads,
+        }
+
+    finally:
+        server.stop()
+        shutil.rmtree(app_home, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({'results': results, 'replicated_change': replicated_change}, indent=2))
+        sys.exit(0)
+
+    print(f"requests={args.requests}, accounts={args.accounts}, latency_ms={args.latency_ms}")
+    print("")
+    print(f"{'mode':>8} | {'endpoint':>8} | {'requests':>8} | {'splunkd_requests':>16} | {'avg_us':>10} | {'p50_us':>10}")
+    print("-" * 76)
+    for result in results:
+        print(f"{result['mode']:>8} | {result['endpoint']:>8} | {result['requests']:>8} | {result['splunkd_requests']:>16} | "
+            f"{result['avg_us']:>10} | {result['p50_us']:>10}")
+    print("")
+    print(f"replicated change: detected={replicated_change['detected']}, snapshot_loads={replicated_change['snapshot_loads']}")
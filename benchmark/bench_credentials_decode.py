@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, sys
+import re
+import json
+import time
+import logging
+import argparse
+
+# load libs
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libs'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package', 'lib'))
+from stand_ins import FakeStoragePasswords, build_account_credentials
+from lib_splunk_start_defender_credentials import splunk_start_defender_get_credential, splunk_start_defender_decode_credential, \
+    CredentialCache, account_credential_realm, credential_separator, credential_end_mark, credential_max_chunks
+
+# Args
+parser = argparse.ArgumentParser(description='Compare the cost and the correctness of the account token extraction: regex on concatenated chunks, JSON on joined chunks, and cached')
+parser.add_argument('--token-lengths', dest='token_lengths', default='64,1200,8000,25000', help='comma separated list of token lengths, ucc-gen splits the stored value in chunks of 255')
+parser.add_argument('--iterations', dest='iterations', type=int, default=2000, help='number of extractions per token length and method')
+args = parser.parse_args()
+
+# set logging
+root = logging.getLogger()
+root.setLevel(logging.INFO)
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+root.addHandler(handler)
+
+account = 'circapi_defender'
+
+
+# the extraction, as previously implemented by the REST handler: chunks concatenated one by one, then a regex per token
+def regex_extract(storage_passwords, account):
+
+    bearer_token_rawvalue = ""
+    for index in range(1, credential_max_chunks + 1):
+        try:
+            chunk = str(storage_passwords[f"{account_credential_realm}:{account}{credential_separator}{index}:"].content.clear_password)
+        except KeyError:
+            break
+        if chunk == credential_end_mark:
+            break
+        bearer_token_rawvalue = bearer_token_rawvalue + chunk
+
+    tokens = {}
+    for token_name in ('circ_token', 'relay_token'):
+        bearer_token_rawvalue_match = re.search('\\{\\"' + token_name + '\\":\\s*\\"(.*)\\"\\}', bearer_token_rawvalue)
+        tokens[token_name] = bearer_token_rawvalue_match.group(1) if bearer_token_rawvalue_match else None
+
+    return tokens
+
+
+# the extraction of the REST handler: chunks joined, then parsed as JSON once
+def json_extract(storage_passwords, account):
+    fields = splunk_start_defender_decode_credential(splunk_start_defender_get_credential(storage_passwords, account))
+    return {'circ_token': fields.get('circ_token'), 'relay_token': fields.get('relay_token')}
+
+
+credential_cache = CredentialCache()
+
+
+# the extraction of the REST handler once the account was decoded
+def cached_extract(storage_passwords, account):
+    fields = credential_cache.get(storage_passwords, account, account_credential_realm, 'bench')
+    return {'circ_token': fields.get('circ_token'), 'relay_token': fields.get('relay_token')}
+
+
+methods = (('regex', regex_extract), ('json', json_extract), ('cached', cached_extract))
+
+
+def build_store(fields):
+    return FakeStoragePasswords(build_account_credentials(account_credential_realm, credential_separator, credential_end_mark,
+        account, json.dumps(fields)))
+
+
+def run(extract, storage_passwords):
+    start = time.perf_counter()
+    for iteration in range(args.iterations):
+        tokens = extract(storage_passwords, account)
+    return tokens, (time.perf_counter() - start) * 1000000 / args.iterations
+
+
+if __name__ == '__main__':
+
+    logging.info(f"iterations={args.iterations}")
+    print("")
+    print(f"{'token_length':>12} | {'chunks':>6} | {'method':>7} | {'avg_us':>9}")
+    print("-" * 45)
+
+    for token_length in [int(token_length) for token_length in args.token_lengths.split(',')]:
+
+        fields = {'circ_token': 't' * token_length}
+        storage_passwords = build_store(fields)
+        credential_cache.clear()
+
+        for method, extract in methods:
+            tokens, avg_us = run(extract, storage_passwords)
+            if tokens['circ_token'] != fields['circ_token']:
+                raise ValueError(f"method={method} did not return the expected token")
+            print(f"{token_length:>12} | {len(storage_passwords.credentials) - 1:>6} | {method:>7} | {avg_us:>9.2f}")
+
+    # values the regex extraction does not decode: escaped characters, and both tokens stored for the same account
+    print("")
+    print(f"{'case':>22} | {'method':>7} | {'correct':>7}")
+    print("-" * 44)
+
+    cases = (
+        ('escaped characters', {'circ_token': 'abc"def\\ghi/'}),
+        ('circ and relay tokens', {'circ_token': 'circ', 'relay_token': 'relay'}),
+        ('no encrypted fields', {}),
+    )
+
+    for case, fields in cases:
+        storage_passwords = build_store(fields) if fields else FakeStoragePasswords([])
+        credential_cache.clear()
+        for method, extract in methods:
+            tokens = extract(storage_passwords, account)
+            correct = tokens == {'circ_token': fields.get('circ_token'), 'relay_token': fields.get('relay_token')}
+            print(f"{case:>22} | {method:>7} | {str(correct):>7}")
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, sys
+import time
+import logging
+import argparse
+
+# load libs
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libs'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package', 'lib'))
+from stand_ins import FakeCredential, FakeStoragePasswords, build_account_credentials
+from lib_splunk_start_defender_credentials import splunk_start_defender_get_credential, \
+    account_credential_realm, credential_separator, credential_end_mark
+
+# Args
+parser = argparse.ArgumentParser(description='Compare the cost of the account credential lookup as the credential store grows')
+parser.add_argument('--sizes', dest='sizes', default='10,100,1000,5000', help='comma separated list of credential store sizes')
+parser.add_argument('--iterations', dest='iterations', type=int, default=20, help='number of lookups per store size')
+parser.add_argument('--request-latency-ms', dest='request_latency_ms', type=float, default=1.0, help='simulated splunkd round trip latency')
+parser.add_argument('--entity-cost-ms', dest='entity_cost_ms', type=float, default=0.05, help='simulated cost per decrypted entity returned')
+parser.add_argument('--token-length', dest='token_length', type=int, default=1200, help='length of the stored token, ucc-gen splits it in chunks of 255')
+args = parser.parse_args()
+
+# set logging
+root = logging.getLogger()
+root.setLevel(logging.INFO)
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+root.addHandler(handler)
+
+
+# build a credential store of a given size, with the account of interest and credentials of other add-ons
+def build_store(size, account, token):
+
+    # the account, as stored by ucc-gen
+    credentials = build_account_credentials(account_credential_realm, credential_separator, credential_end_mark,
+        account, '{"circ_token": "%s"}' % token)
+
+    # credentials of other add-ons
+    for index in range(max(0, size - len(credentials))):
+        realm = f"__REST_CREDENTIAL__#other_addon_{index % 50}#configs/conf-other_addon_account"
+        credentials.append(FakeCredential(f"{realm}:account_{index}``splunk_cred_sep``1:", realm, 'x' * 64))
+
+    return FakeStoragePasswords(credentials, args.request_latency_ms / 1000, args.entity_cost_ms / 1000)
+
+
+# the full enumeration lookup, as previously implemented by the REST handler
+def enumerate_credential(storage_passwords, account):
+
+    credential_name = str(account_credential_realm) + ":" + str(account) + "``"
+    bearer_token_rawvalue = ""
+
+    for credential in storage_passwords:
+        if credential.content.get('realm') == str(account_credential_realm) and credential.name.startswith(credential_name):
+            bearer_token_rawvalue = bearer_token_rawvalue + str(credential.content.clear_password)
+
+    return bearer_token_rawvalue
+
+
+def run(lookup, store, account):
+    store.round_trips = 0
+    store.entities = 0
+    start = time.perf_counter()
+    for iteration in range(args.iterations):
+        value = lookup(store, account)
+    elapsed = time.perf_counter() - start
+    return value, elapsed * 1000 / args.iterations, store.round_trips / args.iterations, store.entities / args.iterations
+
+
+if __name__ == '__main__':
+
+    account = 'circapi_defender'
+    token = 't' * args.token_length
+
+    logging.info(f"request_latency_ms={args.request_latency_ms}, entity_cost_ms={args.entity_cost_ms}, token_length={args.token_length}, iterations={args.iterations}")
+    print("")
+    print(f"{'store_size':>10} | {'method':>11} | {'avg_ms':>9} | {'round_trips':>11} | {'entities':>8}")
+    print("-" * 63)
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        store = build_store(size, account, token)
+
+        for method, lookup in (('enumerate', enumerate_credential), ('targeted', splunk_start_defender_get_credential)):
+            value, avg_ms, round_trips, entities = run(lookup, store, account)
+            if token not in value:
+                raise ValueError(f"method={method} did not return the expected token")
+            print(f"{size:>10} | {method:>11} | {avg_ms:>9.2f} | {round_trips:>11.1f} | {entities:>8.1f}")
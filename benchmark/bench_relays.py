@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, sys
+import json
+import time
+import types
+import socket
+import shutil
+import logging
+from logging.handlers import QueueHandler
+import argparse
+import tempfile
+
+# load libs: the stand-ins, then the Add-on lib and bin directories of the working tree, then the third party libs
+# of the last build (splunklib, splunktaucclib) if any
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(bench_dir, 'libs'))
+sys.path.append(os.path.join(bench_dir, '..', 'package', 'lib'))
+sys.path.append(os.path.join(bench_dir, '..', 'package', 'bin'))
+sys.path.append(os.path.join(bench_dir, '..', 'output', 'splunk_start_defender', 'lib'))
+
+from stand_ins import FakeService, FakeStoragePasswords, build_account_credentials
+from servers import FakeCircServer, FakeRelayServer
+
+# Args
+parser = argparse.ArgumentParser(description='Measure the get status throughput of the streaming commands of Splunk Cloud spread over one or more relays of limited capacity, and verify the failover from an unreachable relay')
+parser.add_argument('--relays', dest='relays', default='1,2,4', help='comma separated list of relay counts to measure')
+parser.add_argument('--computers', dest='computers', type=int, default=400, help='number of distinct computer names per run')
+parser.add_argument('--batch-size', dest='batch_size', type=int, default=20, help='number of computer names per relay batch')
+parser.add_argument('--relay-capacity', dest='relay_capacity', type=int, default=1, help='number of batches a relay handles at a time')
+parser.add_argument('--concurrency', dest='concurrency', type=int, default=2, help='maximum concurrency of the relay within a batch')
+parser.add_argument('--latency-ms', dest='latency_ms', type=float, default=50, help='fake Defender API latency per request')
+parser.add_argument('--json', dest='json', action='store_true', help='print the results as JSON')
+args = parser.parse_args()
+
+# set logging, the Add-on messages are not shown
+root = logging.getLogger()
+root.setLevel(logging.INFO)
+root.addHandler(logging.NullHandler())
+
+# the REST handler, its queued file logger is removed so that the benchmark does not write into the splunkd logs
+import splunk_start_manager_rest_handler as rest_handler_module
+import lib_splunk_start_defender_splunkd
+from lib_splunk_start_defender_logging import splunk_start_defender_stop_logging
+for hdlr in root.handlers[:]:
+    if isinstance(hdlr, QueueHandler):
+        root.removeHandler(hdlr)
+splunk_start_defender_stop_logging()
+
+import lib_splunk_start_defender_relays
+from lib_splunk_start_defender_relays import RelayPool
+from lib_splunk_start_defender import circ_relay_get_status_batch, splunk_start_defender_run_batches
+from lib_splunk_start_defender_credentials import account_credential_realm, credential_separator, credential_end_mark
+
+account = 'bench'
+relay_token = 'bench_relay_token'
+
+# the relays marked down are shared through a file in a temporary directory rather than in SPLUNK_HOME
+tmpdir = tempfile.mkdtemp(prefix='splunk_start_defender_bench_')
+lib_splunk_start_defender_relays.relay_health_file = os.path.join(tmpdir, 'relay_health.json')
+
+
+# build the splunkd stand-in of the relays, with the account pointing to the fake Defender API, the status cache is
+# disabled so that every run calls the Defender API
+def build_service(circ_url):
+
+    credentials = build_account_credentials(account_credential_realm, credential_separator, credential_end_mark,
+        account, json.dumps({'circ_token': 'bench_circ_token'}))
+
+    return FakeService({
+        'splunk_start_defender_settings': {
+            'role': {'instance_role': 'splunk_relay'},
+            'logging': {'loglevel': 'INFO'},
+            'relay': {'status_cache_ttl': '0'},
+        },
+        'splunk_start_defender_account': {
+            account: {'circ_url': circ_url},
+        },
+    }, FakeStoragePasswords(credentials))
+
+
+# an https URL nothing listens on, as a relay which is down
+def get_unreachable_url():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return f"https://127.0.0.1:{port}"
+
+
+# get the status of the computers through the relays, in batches, as the streaming commands do
+def run(name, relay_url):
+
+    if os.path.exists(lib_splunk_start_defender_relays.relay_health_file):
+        os.remove(lib_splunk_start_defender_relays.relay_health_file)
+
+    relays = RelayPool(relay_url)
+    computernames = [f"{name}-{index}" for index in range(args.computers)]
+
+    succeeded = 0
+    failed = 0
+
+    start = time.perf_counter()
+    for computername, response, exception in splunk_start_defender_run_batches(
+        lambda batch: relays.call(lambda relay_url: circ_relay_get_status_batch(account, relay_token, batch, relay_url, args.concurrency)),
+        computernames, args.batch_size, relays.get_batches_in_flight()):
+        if exception is None:
+            succeeded += 1
+        else:
+            failed += 1
+    elapsed = time.perf_counter() - start
+
+    return {
+        'run': name,
+        'relays': len(relays.get_relay_urls()),
+        'computers': args.computers,
+        'succeeded': succeeded,
+        'failed': failed,
+        'computers_per_s': round(args.computers / elapsed, 1) if elapsed else 0,
+        'elapsed_s': round(elapsed, 2),
+        'metrics': relays.get_metrics(),
+    }
+
+
+if __name__ == '__main__':
+
+    circ = FakeCircServer(args.latency_ms / 1000, 0, 0, 128).start()
+
+    # the REST handler of the relays, as instantiated by splunkd, connecting to the splunkd stand-in, every relay
+    # server dispatches to it with its own capacity
+    service = build_service(circ.url)
+    lib_splunk_start_defender_splunkd.client = types.SimpleNamespace(connect=service.connect)
+    handler = rest_handler_module.SplunkStartDefender_v1(None, None)
+
+    counts = [int(count) for count in args.relays.split(',') if count.strip()]
+    servers = [FakeRelayServer(handler, max_concurrency=args.relay_capacity).start() for index in range(max(counts))]
+
+    results = []
+    try:
+        for count in counts:
+            results.append(run(f"relays_{count}", ','.join(server.url for server in servers[:count])))
+
+        # the first relay listed cannot be reached: the batches sent to it fail over to the others, and it is marked down
+        failover = run('failover', ','.join([get_unreachable_url()] + [server.url for server in servers[:max(counts)]]))
+
+    finally:
+        for server in servers:
+            server.stop()
+        circ.stop()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({'results': results, 'failover': failover}, indent=2))
+        sys.exit(0)
+
+    print(f"computers={args.computers}, batch_size={args.batch_size}, relay_capacity={args.relay_capacity}, latency_ms={args.latency_ms}")
+    print("")
+    print(f"{'run':>10} | {'relays':>6} | {'succeeded':>9} | {'failed':>6} | {'computers_per_s':>15} | {'elapsed_s':>9}")
+    print("-" * 72)
+    for result in results + [failover]:
+        print(f"{result['run']:>10} | {result['relays']:>6} | {result['succeeded']:>9} | {result['failed']:>6} | "
+            f"{result['computers_per_s']:>15} | {result['elapsed_s']:>9}")
+    print("")
+    print("failover, per relay metrics:")
+    for metrics in failover['metrics']:
+        print(f"  relay={metrics['relay']}, requests={metrics['requests']}, failures={metrics['failures']}, "
+            f"failovers={metrics['failovers']}, latency_ms={metrics['latency_ms']}, state={metrics['state']}")
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, sys
+import json
+import time
+import logging
+from logging.handlers import QueueHandler
+import argparse
+import concurrent.futures
+
+# load libs: the stand-ins, then the Add-on lib and bin directories of the working tree, then the third party libs
+# of the last build (splunklib, splunktaucclib) if any
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(bench_dir, 'libs'))
+sys.path.append(os.path.join(bench_dir, '..', 'package', 'lib'))
+sys.path.append(os.path.join(bench_dir, '..', 'package', 'bin'))
+sys.path.append(os.path.join(bench_dir, '..', 'output', 'splunk_start_defender', 'lib'))
+
+from stand_ins import build_account_credentials, build_in_string
+from servers import FakeSplunkdServer
+
+# Args
+parser = argparse.ArgumentParser(description='Compare a splunkd connection per request against the shared splunkd services of the REST handler, when resolving the command context of an account')
+parser.add_argument('--requests', dest='requests', type=int, default=200, help='number of command context requests per mode, each resolving the account from splunkd')
+parser.add_argument('--concurrency', dest='concurrency', type=int, default=4, help='number of concurrent requests')
+parser.add_argument('--latency-ms', dest='latency_ms', type=float, default=1, help='fake splunkd latency per request')
+parser.add_argument('--json', dest='json', action='store_true', help='print the results as JSON')
+args = parser.parse_args()
+
+# set logging, the Add-on messages are not shown
+root = logging.getLogger()
+root.setLevel(logging.INFO)
+root.addHandler(logging.NullHandler())
+
+# the REST handler, its queued file logger is removed so that the benchmark does not write into the splunkd logs
+import splunk_start_manager_rest_handler as rest_handler_module
+from lib_splunk_start_defender_logging import splunk_start_defender_stop_logging
+for hdlr in root.handlers[:]:
+    if isinstance(hdlr, QueueHandler):
+        root.removeHandler(hdlr)
+splunk_start_defender_stop_logging()
+
+import splunklib.client as client
+from lib_splunk_start_defender_splunkd import ServiceCache
+from lib_splunk_start_defender_credentials import account_credential_realm, credential_separator, credential_end_mark
+
+account = 'bench'
+token = 'bench_session_key'
+
+
+class ConnectPerRequest(object):
+    """
+    The previous behaviour of the REST handler: a new service per request, with the default handler of splunklib.
+    """
+
+    def call(self, port, token, func):
+        return func(client.connect(owner="nobody", app="splunk_start_defender", port=port, token=token))
+
+
+def build_server():
+
+    credentials = build_account_credentials(account_credential_realm, credential_separator, credential_end_mark,
+        account, json.dumps({'circ_token': 'bench_circ_token'}))
+
+    return FakeSplunkdServer({
+        'splunk_start_defender_settings': {
+            'role': {'instance_role': 'splunk_relay'},
+            'logging': {'loglevel': 'INFO'},
+        },
+        'splunk_start_defender_account': {
+            account: {'circ_url': 'https://circ.bench'},
+        },
+    }, credentials, token, latency=args.latency_ms / 1000).start()
+
+
+# resolve the command context of the account, with the caches of the handler emptied so that splunkd is called
+def resolve(handler, port):
+
+    with rest_handler_module.account_cache_lock:
+        rest_handler_module.account_cache['accounts'].clear()
+    rest_handler_module.credential_cache.clear()
+    rest_handler_module.config_snapshots.clear()
+
+    response = handler.handle(build_in_string('POST', 'command_context', json.dumps({'account': account}), port=port, authtoken=token))
+    if response.get('status') != 200:
+        raise Exception(f"HTTP status code: {response.get('status')}, response: {response.get('payload')}")
+
+
+def run_mode(name, services, handler, server):
+
+    rest_handler_module.splunkd_services = services
+    port = server.server_address[1]
+    server.requests.clear()
+
+    latencies = []
+
+    def timed_resolve(index):
+        start = time.perf_counter()
+        resolve(handler, port)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = list(executor.map(timed_resolve, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    return {
+        'mode': name,
+        'requests': args.requests,
+        'splunkd_requests': server.requests.get('requests', 0),
+        'splunkd_connections': server.requests.get('connections', 0),
+        'requests_per_s': round(args.requests / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2),
+    }
+
+
+if __name__ == '__main__':
+
+    server = build_server()
+    handler = rest_handler_module.SplunkStartDefender_v1(None, None)
+
+    services = ServiceCache(owner="nobody", app="splunk_start_defender")
+
+    results = []
+    try:
+        results.append(run_mode('connect', ConnectPerRequest(), handler, server))
+        results.append(run_mode('cached', services, handler, server))
+
+        # the token of the cached service is rejected once: the service is replaced and the request succeeds
+        server.reject_requests = 1
+        connections = services.connections
+        resolve(handler, server.server_address[1])
+        auth_refresh = {'succeeded': True, 'services_connected': services.connections - connections}
+
+    finally:
+        services.close()
+        server.stop()
+
+    if args.json:
+        print(json.dumps({'results': results, 'auth_refresh': auth_refresh}, indent=2))
+        sys.exit(0)
+
+    print(f"requests={args.requests}, concurrency={args.concurrency}, latency_ms={args.latency_ms}")
+    print("")
+    print(f"{'mode':>8} | {'requests':>8} | {'splunkd_requests':>16} | {'splunkd_connections':>19} | {'requests_per_s':>14} | {'p50_ms':>8} | {'max_ms':>8}")
+    print("-" * 100)
+    for result in results:
+        print(f"{result['mode']:>8} | {result['requests']:>8} | {result['splunkd_requests']:>16} | {result['splunkd_connections']:>19} | "
+            f"{result['requests_per_s']:>14} | {result['p50_ms']:>8} | {result['max_ms']:>8}")
+    print("")
+    print(f"auth refresh: succeeded={auth_refresh['succeeded']}, services_connected={auth_refresh['services_connected']}")
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, sys
+import time
+import json
+import argparse
+import tempfile
+import subprocess
+
+# the custom commands are started as splunkd does, from the bin directory of the working tree, and the third party
+# libs of the last build (splunklib, splunktaucclib) if any
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+bin_dir = os.path.join(bench_dir, '..', 'package', 'bin')
+build_lib_dir = os.path.join(bench_dir, '..', 'output', 'splunk_start_defender', 'lib')
+
+commands = {
+    'defenderstatus': ('get_defender_status.py', 'computername=bench'),
+    'defenderscan': ('start_defender.py', 'computername=bench'),
+    'defenderstatusstream': ('get_defender_status_stream.py', ''),
+    'defenderscanstream': ('start_defender_stream.py', ''),
+    'defenderjobs': ('get_defender_jobs.py', ''),
+}
+
+# Args
+parser = argparse.ArgumentParser(description='Measure the cold start of the custom commands: wall time of a process answering the getinfo exchange of splunkd, and number of modules imported')
+parser.add_argument('--commands', dest='commands', default=','.join(commands), help='comma separated list of commands: ' + ', '.join(commands))
+parser.add_argument('--iterations', dest='iterations', type=int, default=10, help='number of processes started per command')
+parser.add_argument('--top', dest='top', type=int, default=0, help='show the N slowest imports of each command (python -X importtime)')
+parser.add_argument('--json', dest='json', action='store_true', help='print the results as JSON')
+args = parser.parse_args()
+
+# run in the child process: reports the number of modules loaded when the command exits
+child_code = '''
+import sys, json, atexit, runpy
+modules = len(sys.modules)
+atexit.register(lambda: sys.stderr.write("bench_startup " + json.dumps({"modules": len(sys.modules) - modules}) + "\\n"))
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+'''
+
+
+# the getinfo exchange splunkd starts a chunked (protocol v2) custom command with
+def build_getinfo(command, arguments, dispatch_dir):
+
+    metadata = json.dumps({
+        'action': 'getinfo',
+        'preview': False,
+        'searchinfo': {
+            'args': arguments.split(),
+            'raw_args': arguments.split(),
+            'dispatch_dir': dispatch_dir,
+            'sid': 'bench_startup',
+            'app': 'splunk_start_defender',
+            'owner': 'admin',
+            'username': 'admin',
+            'session_key': 'bench',
+            'splunkd_uri': 'https://127.0.0.1:8089',
+            'splunk_version': '9.1.0',
+            'search': f'| {command} {arguments}',
+            'command': command,
+            'maxresultrows': 50000,
+            'earliest_time': '0',
+            'latest_time': '0',
+        },
+    })
+
+    return f"chunked 1.0,{len(metadata)},0\n{metadata}".encode('utf-8')
+
+
+def run_command(command, importtime=False):
+
+    filename, arguments = commands[command]
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([path for path in [build_lib_dir, env.get('PYTHONPATH')] if path])
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+
+    python_args = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', child_code, os.path.join(bin_dir, filename)]
+
+    with tempfile.TemporaryDirectory() as dispatch_dir:
+        start = time.perf_counter()
+        process = subprocess.run(python_args, input=build_getinfo(command, arguments, dispatch_dir), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        elapsed = time.perf_counter() - start
+
+    stdout = process.stdout.decode('utf-8', 'replace')
+    stderr = process.stderr.decode('utf-8', 'replace')
+
+    if '"type"' not in stdout and 'streaming' not in stdout and 'generating' not in stdout:
+        raise Exception(f"The command {command} did not answer the getinfo exchange, stdout=\"{stdout[-500:]}\", stderr=\"{stderr[-2000:]}\"")
+
+    modules = None
+    imports = []
+    for line in stderr.splitlines():
+        if line.startswith('bench_startup '):
+            modules = json.loads(line[len('bench_startup '):])['modules']
+        elif line.startswith('import time:') and '|' in line:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            # nested imports are indented
+            if self_us.strip().isdigit() and len(name) - len(name.lstrip()) == 1:
+                imports.append((int(cumulative_us), name.strip()))
+
+    return elapsed, modules, imports
+
+
+# the cold start of the interpreter alone, for reference
+def run_interpreter():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'])
+    return time.perf_counter() - start
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0
+
+
+if __name__ == '__main__':
+
+    results = []
+
+    results.append({
+        'command': 'python',
+        'modules': 0,
+        'median_ms': round(median([run_interpreter() for iteration in range(args.iterations)]) * 1000, 1),
+    })
+
+    top_imports = {}
+
+    for command in [command.strip() for command in args.commands.split(',') if command.strip()]:
+
+        timings = []
+        for iteration in range(args.iterations):
+            elapsed, modules, imports = run_command(command)
+            timings.append(elapsed)
+
+        timings.sort()
+        results.append({
+            'command': command,
+            'modules': modules,
+            'median_ms': round(median(timings) * 1000, 1),
+            'min_ms': round(timings[0] * 1000, 1),
+            'max_ms': round(timings[-1] * 1000, 1),
+        })
+
+        # top level imports only, their cumulative time includes their own imports
+        if args.top:
+            elapsed, modules, imports = run_command(command, importtime=True)
+            top_imports[command] = sorted(imports, reverse=True)[:args.top]
+
+    if args.json:
+        print(json.dumps({'results': results, 'top_imports': top_imports}, indent=2))
+        sys.exit(0)
+
+    print(f"iterations={args.iterations}, python=\"{sys.executable}\"")
+    print("")
+    print(f"{'command':>20} | {'modules':>7} | {'median_ms':>9} | {'min_ms':>8} | {'max_ms':>8}")
+    print("-" * 65)
+    for result in results:
+        print(f"{result['command']:>20} | {result['modules']:>7} | {result['median_ms']:>9} | {result.get('min_ms', ''):>8} | {result.get('max_ms', ''):>8}")
+
+    for command, imports in top_imports.items():
+        print("")
+        print(f"{command}: slowest imports (cumulative ms)")
+        for cumulative, name in imports:
+            print(f"    {round(cumulative / 1000, 1):>8} {name}")
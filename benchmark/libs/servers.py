@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import ssl
+import socket
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.sax.saxutils import escape
+
+from stand_ins import build_in_string
+
+
+# generate a self signed certificate, the relay enforces https to reach the Defender API
+def generate_certificate(directory):
+    """
+    Generate a self signed certificate with the openssl command, returns the tuple (certfile, keyfile).
+    """
+
+    if not shutil.which('openssl'):
+        raise Exception('The openssl command is required to generate a certificate for the fake Defender API')
+
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', keyfile, '-out', certfile,
+        '-days', '1', '-subj', '/CN=localhost'], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return certfile, keyfile
+
+
+# serve https from a http server, returns the temporary directory holding the certificate
+def enable_tls(server):
+    tmpdir = tempfile.mkdtemp(prefix='splunk_start_defender_bench_')
+    certfile, keyfile = generate_certificate(tmpdir)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    return tmpdir
+
+
+class BenchServer(ThreadingHTTPServer):
+    """
+    Threaded local server, started in a background thread and optionally serving https.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, request_handler, tls=True, port=0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), request_handler)
+        self.requests = {}
+        self.requests_lock = threading.Lock()
+        self.tmpdir = enable_tls(self) if tls else None
+        self.thread = None
+        self.url = '{}://127.0.0.1:{}'.format('https' if tls else 'http', self.server_address[1])
+
+    def count_request(self, path):
+        with self.requests_lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name=self.__class__.__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class BenchRequestHandler(BaseHTTPRequestHandler):
+
+    # keep-alive, as the real services
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # headers and body are written separately, do not let them wait for delayed acknowledgements
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send_body(self, status, body, headers=None):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, data):
+        self.send_body(status, json.dumps(data))
+
+
+class FakeCircRequestHandler(BenchRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        url = urlsplit(self.path)
+        params = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+
+        # drain the body, if any
+        self.read_body()
+
+        server.count_request(url.path)
+
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self.send_json(401, {'error': 'missing bearer token'})
+
+        # simulated latency and errors
+        server.enter()
+        try:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+        finally:
+            server.leave()
+
+        if random.random() < server.error_rate:
+            return self.send_json(503, {'error': 'simulated failure'})
+
+        if url.path == '/status':
+            return self.send_json(200, {
+                'computername': params.get('computername'),
+                'scan_status': 'completed',
+                'last_scan_start': time.time() - 60,
+                'last_scan_end': time.time(),
+                'details': 'x' * server.payload_size,
+            })
+
+        elif url.path == '/scan':
+            return self.send_json(200, {
+                'computername': params.get('computername'),
+                'fullscan': params.get('fullscan'),
+                'action': 'scan requested',
+                'details': 'x' * server.payload_size,
+            })
+
+        return self.send_json(404, {'error': 'not found'})
+
+
+class FakeCircServer(BenchServer):
+    """
+    Local stand-in for the Defender (CIRC) API, serving POST /status and POST /scan with a configurable latency
+    (latency + uniform jitter, in seconds), error rate (ratio of 503 responses) and payload size (bytes of padding).
+    The requests in progress are counted, max_in_flight is the highest count reached.
+    """
+
+    def __init__(self, latency=0.02, jitter=0.01, error_rate=0.0, payload_size=512, tls=True, port=0):
+        BenchServer.__init__(self, FakeCircRequestHandler, tls, port)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.payload_size = payload_size
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def enter(self):
+        with self.requests_lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def leave(self):
+        with self.requests_lock:
+            self.in_flight -= 1
+
+
+class FakeRelayRequestHandler(BenchRequestHandler):
+
+    def handle_request(self, method):
+        server = self.server
+        url = urlsplit(self.path)
+        body = self.read_body()
+
+        # splunkd routes /services/splunk_start_defender/manager/<path_info> to the persistent handler
+        if not url.path.startswith(server.root_path):
+            return self.send_json(404, {'error': 'not found'})
+        path_info = url.path[len(server.root_path):]
+        server.count_request(path_info)
+
+        in_string = build_in_string(method, path_info, payload=body.decode('utf-8') if body else None,
+            query=dict((key, values[0]) for key, values in parse_qs(url.query).items()), headers=self.headers.items())
+
+        # the capacity of the relay, requests beyond it wait
+        if server.capacity is not None:
+            with server.capacity:
+                response = server.handler.handle(in_string)
+        else:
+            response = server.handler.handle(in_string)
+
+        payload = response.get('payload')
+        if not isinstance(payload, str):
+            payload = json.dumps(payload)
+
+        return self.send_body(response.get('status', 200), payload, response.get('headers'))
+
+    def do_GET(self):
+        return self.handle_request('GET')
+
+    def do_POST(self):
+        return self.handle_request('POST')
+
+
+class FakeRelayServer(BenchServer):
+    """
+    Local stand-in for the splunkd of the relay: requests to the manager endpoints are turned into the in_string
+    splunkd sends to persistent REST handlers, and dispatched to the handle method of the REST handler instance.
+    With max_concurrency, at most max_concurrency requests are handled at a time, as a relay of limited capacity.
+    """
+
+    root_path = '/services/splunk_start_defender/manager/'
+
+    def __init__(self, handler, tls=True, port=0, max_concurrency=0):
+        BenchServer.__init__(self, FakeRelayRequestHandler, tls, port)
+        self.handler = handler
+        self.capacity = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+
+class FakeSplunkdRequestHandler(BenchRequestHandler):
+
+    def setup(self):
+        BenchRequestHandler.setup(self)
+        self.server.count_request('connections')
+
+    # as splunkd, answer a request with the Connection: close header of the default handler of splunklib in kind
+    def end_headers(self):
+        if (self.headers.get('Connection') or '').lower() == 'close':
+            self.send_header('Connection', 'close')
+        BenchRequestHandler.end_headers(self)
+
+    def send_feed(self, entries):
+        feed = ['<feed xmlns="http://www.w3.org/2005/Atom" xmlns:s="http://dev.splunk.com/ns/rest">']
+        for path, title, content in entries:
+            keys = ''.join(f'<s:key name="{escape(key)}">{escape(str(value))}</s:key>' for key, value in content.items())
+            feed.append(f'<entry><title>{escape(title)}</title><id>https://127.0.0.1{escape(path)}</id>'
+                f'<link href="{escape(path)}" rel="alternate"/><content type="text/xml"><s:dict>{keys}</s:dict></content></entry>')
+        feed.append('</feed>')
+        self.send_response(200)
+        body = ''.join(feed).encode('utf-8')
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        path = urlsplit(self.path).path.rstrip('/')
+        server.count_request('requests')
+
+        with server.requests_lock:
+            rejected = server.reject_requests > 0
+            if rejected:
+                server.reject_requests -= 1
+        if rejected or self.headers.get('Authorization') != f"Splunk {server.token}":
+            return self.send_json(401, {'messages': [{'type': 'WARN', 'text': 'call not properly authenticated'}]})
+
+        time.sleep(server.latency)
+
+        # /servicesNS/<owner>/<app>/<endpoint>/<name>
+        parts = path.split('/')
+        endpoint, name = '/'.join(parts[4:-1]), unquote(parts[-1])
+
+        if endpoint == 'properties' and name in server.confs:
+            return self.send_feed([])
+
+        if endpoint == 'configs' and name.startswith('conf-') and name[len('conf-'):] in server.confs:
+            stanzas = server.confs[name[len('conf-'):]]
+            return self.send_feed([(f"{path}/{stanza}", stanza, content) for stanza, content in stanzas.items()])
+
+        if endpoint == 'storage/passwords' and name in server.credentials:
+            credential = server.credentials[name]
+            return self.send_feed([(path, credential.name, {'realm': credential.content.realm, 'clear_password': credential.content.clear_password})])
+
+        return self.send_json(404, {'messages': [{'type': 'ERROR', 'text': 'not found'}]})
+
+
+class FakeSplunkdServer(BenchServer):
+    """
+    Local stand-in for the REST API of splunkd, as read by splunklib: conf files (properties and configs/conf-*) and
+    the credential store (storage/passwords), authenticated with a token, with a configurable latency per request.
+    Connections and requests are counted, reject_requests makes the next requests fail with 401.
+    """
+
+    def __init__(self, confs, credentials, token, latency=0, tls=True, port=0):
+        BenchServer.__init__(self, FakeSplunkdRequestHandler, tls, port)
+        self.confs = confs
+        self.credentials = dict((credential.name, credential) for credential in credentials)
+        self.token = token
+        self.latency = latency
+        self.reject_requests = 0
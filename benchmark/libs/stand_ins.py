@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import time
+
+
+#
+# credential store stand-in
+#
+
+class FakeContent(object):
+    def __init__(self, realm, clear_password):
+        self.realm = realm
+        self.clear_password = clear_password
+
+    def get(self, key):
+        return getattr(self, key)
+
+
+class FakeCredential(object):
+    def __init__(self, name, realm, clear_password):
+        self.name = name
+        self.content = FakeContent(realm, clear_password)
+
+
+class FakeStoragePasswords(object):
+    """
+    Behaves like splunklib StoragePasswords: iterating costs one round trip and decrypts every entity,
+    fetching by name costs one round trip and decrypts one entity.
+    """
+
+    def __init__(self, credentials, request_latency=0, entity_cost=0):
+        self.credentials = credentials
+        self.by_name = dict((credential.name, credential) for credential in credentials)
+        self.request_latency = request_latency
+        self.entity_cost = entity_cost
+        self.round_trips = 0
+        self.entities = 0
+
+    def cost(self, entities):
+        self.round_trips += 1
+        self.entities += entities
+        time.sleep(self.request_latency + entities * self.entity_cost)
+
+    def __iter__(self):
+        self.cost(len(self.credentials))
+        return iter(list(self.credentials))
+
+    def __getitem__(self, name):
+        if name in self.by_name:
+            self.cost(1)
+            return self.by_name[name]
+        self.cost(0)
+        raise KeyError(name)
+
+
+# build the credential chunks of an account, as stored by ucc-gen
+def build_account_credentials(realm, separator, end_mark, account, value):
+    chunks = [value[i:i + 255] for i in range(0, len(value), 255)] + [end_mark]
+    return [FakeCredential(f"{realm}:{account}{separator}{index}:", realm, chunk) for index, chunk in enumerate(chunks, start=1)]
+
+
+#
+# splunkd service stand-in
+#
+
+class FakeStanza(object):
+    def __init__(self, name, content):
+        self.name = name
+        self.content = dict(content)
+
+
+class FakeConf(object):
+    def __init__(self, stanzas):
+        self.stanzas = [FakeStanza(name, content) for name, content in stanzas.items()]
+
+    def __iter__(self):
+        return iter(self.stanzas)
+
+
+class FakeService(object):
+    """
+    Behaves like the splunklib Service as used by the REST handler: confs[<conf file>] iterates over the stanzas,
+    storage_passwords is the credential store stand-in. Each connection is counted.
+    """
+
+    def __init__(self, confs, storage_passwords):
+        self.confs = dict((conf_file, FakeConf(stanzas)) for conf_file, stanzas in confs.items())
+        self.storage_passwords = storage_passwords
+        self.connections = 0
+
+    def connect(self, **kwargs):
+        self.connections += 1
+        return self
+
+
+#
+# persistent REST handler request
+#
+
+# build the in_string splunkd sends to a persistent REST handler
+def build_in_string(method, path_info, payload=None, query=None, port=8089, authtoken='bench_session_key', headers=None):
+    request = {
+        'output_mode': 'json',
+        'session': {
+            'authtoken': authtoken,
+            'user': 'admin',
+        },
+        'system_authtoken': authtoken,
+        'server': {
+            'rest_uri': f"https://127.0.0.1:{port}",
+            'hostname': 'bench',
+            'servername': 'bench',
+        },
+        'connection': {
+            'src_ip': '127.0.0.1',
+            'listening_port': port,
+        },
+        'method': method,
+        'path_info': path_info,
+        'query': [list(item) for item in (query or {}).items()],
+        'form': [],
+        'headers': [list(item) for item in (headers or [])],
+    }
+
+    if payload is not None:
+        request['payload'] = payload if isinstance(payload, str) else json.dumps(payload)
+
+    return json.dumps(request)
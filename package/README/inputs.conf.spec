@@ -0,0 +1,33 @@
+[defender_status_sweep://<name>]
+account = <string>
+* account to be used for the query, defaults to circapi_defender.
+
+lookup = <string>
+* name of the lookup containing the computer names, either lookup or search must be set.
+
+search = <string>
+* search returning the computer names, either lookup or search must be set.
+
+field = <string>
+* name of the field containing the computer name, defaults to computername.
+
+max_concurrency = <integer>
+* maximum number of concurrent get status requests in flight, defaults to 10 (up to 100 with engine=threads).
+
+engine = <threads|asyncio>
+* when running on the relay, run the requests to circ on a pool of threads (threads) or on an asyncio event loop (asyncio), defaults to threads.
+
+batch_size = <integer>
+* when running on Splunk Cloud, number of computer names sent to the relay per request, defaults to 100.
+
+checkpoint_size = <integer>
+* number of computer names processed between two checkpoints, a restarted sweep resumes from the last checkpoint, defaults to 500.
+
+mode = <full|delta>
+* full to query every computer and index every status, delta to query only the computers not checked for stale_after seconds or returned by trigger_search, and index only the statuses which changed, defaults to full.
+
+stale_after = <integer>
+* in delta mode, number of seconds after which the status of a computer is queried again, defaults to 86400.
+
+trigger_search = <string>
+* in delta mode, search returning computer names to query whatever the time of their last check, for instance computers with recent Defender alerts.
@@ -0,0 +1,307 @@
+import sys, time, os
+import logging
+import json
+import uuid
+from os.path import join, dirname, basename
+######################################################################
+# developed by Oliver Zimmermann
+#
+######################################################################
+
+APP_NAME = basename(dirname(dirname(__file__)))
+APP_HOME = dirname(dirname(__file__))
+sys.path.append(join(APP_HOME, 'lib'))
+splunkhome = os.environ['SPLUNK_HOME']
+
+# set logging, records are written to the log file by a background thread
+from lib_splunk_start_defender_logging import splunk_start_defender_setup_logging, JsonMessage
+# set the log level to INFO, DEBUG as the default is ERROR
+log = splunk_start_defender_setup_logging('%s/var/log/splunk/%s.log' % (splunkhome, APP_NAME), logging.INFO)
+
+try:
+    from splunklib.modularinput import Script, Scheme, Argument, Event
+    import splunklib.results as results
+except Exception as e:
+    logging.error(e)
+
+# import additional libs
+from lib_splunk_start_defender import splunk_start_defender_get_command_context, \
+    circ_get_status, circ_relay_get_status_batch, splunk_start_defender_run_concurrent, splunk_start_defender_run_batches, \
+    splunk_start_defender_set_timing, splunk_start_defender_get_timing_fields, \
+    splunk_start_defender_apply_command_context
+from lib_splunk_start_defender_checkpoint import splunk_start_defender_load_checkpoint, splunk_start_defender_save_checkpoint
+from lib_splunk_start_defender_jobs import get_status_hash
+from lib_splunk_start_defender_relays import RelayPool
+
+# the sourcetype of the status events
+sweep_sourcetype = 'splunk_start_defender:status'
+
+# the checkpoint namespace of the per host state of the delta sweeps
+hosts_checkpoint_namespace = 'hosts'
+
+
+class DefenderStatusSweep(Script):
+
+    def get_scheme(self):
+
+        scheme = Scheme("Defender status sweep")
+        scheme.description = "Periodically get the Defender status of a list of computers, from a lookup or a search, and index the results."
+        scheme.use_external_validation = True
+        scheme.use_single_instance = False
+
+        arguments = [
+            ('account', "Account", "account to be used for the query, defaults to circapi_defender.", Argument.data_type_string),
+            ('lookup', "Lookup", "name of the lookup containing the computer names, either lookup or search must be set.", Argument.data_type_string),
+            ('search', "Search", "search returning the computer names, either lookup or search must be set.", Argument.data_type_string),
+            ('field', "Field", "name of the field containing the computer name, defaults to computername.", Argument.data_type_string),
+            ('max_concurrency', "Max concurrency", "maximum number of concurrent get status requests in flight, defaults to 10 (up to 100 with engine=threads).", Argument.data_type_number),
+            ('engine', "Engine", "when running on the relay, run the requests to circ on a pool of threads (threads) or on an asyncio event loop (asyncio), defaults to threads.", Argument.data_type_string),
+            ('batch_size', "Batch size", "when running on Splunk Cloud, number of computer names sent to the relay per request, defaults to 100.", Argument.data_type_number),
+            ('checkpoint_size', "Checkpoint size", "number of computer names processed between two checkpoints, a restarted sweep resumes from the last checkpoint, defaults to 500.", Argument.data_type_number),
+            ('mode', "Mode", "full to query every computer and index every status, delta to query only the computers not checked for stale_after seconds or returned by trigger_search, and index only the statuses which changed, defaults to full.", Argument.data_type_string),
+            ('stale_after', "Stale after", "in delta mode, number of seconds after which the status of a computer is queried again, defaults to 86400.", Argument.data_type_number),
+            ('trigger_search', "Trigger search", "in delta mode, search returning computer names to query whatever the time of their last check, for instance computers with recent Defender alerts.", Argument.data_type_string),
+        ]
+
+        for name, title, description, data_type in arguments:
+            argument = Argument(name)
+            argument.title = title
+            argument.description = description
+            argument.data_type = data_type
+            argument.required_on_create = False
+            scheme.add_argument(argument)
+
+        return scheme
+
+    def validate_input(self, definition):
+
+        parameters = definition.parameters
+
+        if bool(parameters.get('lookup')) == bool(parameters.get('search')):
+            raise ValueError("Either lookup or search must be set")
+
+        for name, minimum, maximum in (('max_concurrency', 1, 1000), ('batch_size', 1, 1000), ('checkpoint_size', 1, 100000), ('stale_after', 0, 31536000)):
+            if parameters.get(name) and not minimum <= int(parameters.get(name)) <= maximum:
+                raise ValueError(f"{name} must be between {minimum} and {maximum}")
+
+        if parameters.get('engine') and parameters.get('engine') not in ('threads', 'asyncio'):
+            raise ValueError("engine must be threads or asyncio")
+
+        if parameters.get('mode') and parameters.get('mode') not in ('full', 'delta'):
+            raise ValueError("mode must be full or delta")
+
+    # get the sorted and unique computer names of the sweep
+    def get_computernames(self, lookup, search, field):
+
+        if lookup:
+            search = f'| inputlookup {lookup} | fields {field}'
+        elif not search.lstrip().startswith('|') and not search.lstrip().startswith('search '):
+            search = f'search {search}'
+
+        computernames = set()
+        reader = results.JSONResultsReader(self.service.jobs.export(search, output_mode='json', count=0))
+
+        for result in reader:
+            if not isinstance(result, dict):
+                continue
+            values = result.get(field)
+            if isinstance(values, str):
+                values = [values]
+            for value in values or []:
+                if value.strip():
+                    computernames.add(value.strip())
+
+        return sorted(computernames)
+
+    def stream_events(self, inputs, ew):
+
+        for input_name, input_item in inputs.inputs.items():
+            self.sweep(input_name, input_item, inputs.metadata, ew)
+
+    def sweep(self, input_name, input_item, metadata, ew):
+
+        account = input_item.get('account') or 'circapi_defender'
+        field = input_item.get('field') or 'computername'
+        max_concurrency = int(input_item.get('max_concurrency') or 10)
+        engine = input_item.get('engine') or 'threads'
+        batch_size = int(input_item.get('batch_size') or 100)
+        checkpoint_size = int(input_item.get('checkpoint_size') or 500)
+        mode = input_item.get('mode') or 'full'
+        stale_after = int(input_item.get('stale_after') or 86400)
+        checkpoint_dir = metadata['checkpoint_dir']
+
+        # get instance_role, loglevel and account in a single call
+        start = time.perf_counter()
+        timing = {}
+        command_context = splunk_start_defender_get_command_context(metadata['session_key'], metadata['server_uri'], account)
+        instance_role = command_context['instance_role']
+        account_conf = command_context['account']
+        splunk_start_defender_set_timing(timing, 'context_ms', start)
+
+        # set the log level, the timeouts and the proxy, a sweep is not bound to the deadline of a search, the asyncio
+        # engine falls back to threads if it does not support the proxy
+        engine = splunk_start_defender_apply_command_context(command_context, None, engine)[1]
+
+        # resume the sweep in progress if any, otherwise start a new sweep
+        checkpoint = splunk_start_defender_load_checkpoint(checkpoint_dir, input_name)
+
+        # the state of every computer of the input, by computer name: hash of the last status, times of the last check
+        # and of the last change, kept in its own checkpoint namespace
+        hosts = splunk_start_defender_load_checkpoint(checkpoint_dir, input_name, hosts_checkpoint_namespace) or {}
+
+        if checkpoint and checkpoint.get('completed') is None:
+            # a sweep keeps the mode it was started with
+            for key, value in (('mode', 'full'), ('skipped', 0), ('unchanged', 0)):
+                checkpoint.setdefault(key, value)
+            mode = checkpoint['mode']
+            logging.info(f"defender_status_sweep, input=\"{input_name}\", sweep_id=\"{checkpoint['sweep_id']}\", resuming sweep at position={checkpoint['position']}/{len(checkpoint['computernames'])}")
+
+        else:
+            computernames = self.get_computernames(input_item.get('lookup'), input_item.get('search'), field)
+
+            # computers which are no longer part of the input are forgotten
+            hosts = {computername: hosts[computername] for computername in computernames if computername in hosts}
+            splunk_start_defender_save_checkpoint(checkpoint_dir, input_name, hosts, hosts_checkpoint_namespace)
+
+            # in delta mode, only stale, new and triggered computers are queried
+            skipped = 0
+            if mode == 'delta':
+                triggered = set(self.get_computernames(None, input_item.get('trigger_search'), field)) if input_item.get('trigger_search') else set()
+                now = time.time()
+                selected = [computername for computername in computernames
+                    if computername in triggered or computername not in hosts or now - hosts[computername]['checked'] >= stale_after]
+                skipped = len(computernames) - len(selected)
+                computernames = selected
+
+            checkpoint = {
+                'sweep_id': uuid.uuid4().hex,
+                'mode': mode,
+                'started': time.time(),
+                'completed': None,
+                'computernames': computernames,
+                'position': 0,
+                'skipped': skipped,
+                'succeeded': 0,
+                'unchanged': 0,
+                'failed': 0,
+            }
+            splunk_start_defender_save_checkpoint(checkpoint_dir, input_name, checkpoint)
+            logging.info(f"defender_status_sweep, input=\"{input_name}\", sweep_id=\"{checkpoint['sweep_id']}\", mode=\"{mode}\", starting sweep of {len(computernames)} computer names, skipped={skipped}")
+
+        # time spent per computer name, in milliseconds
+        timings = {}
+
+        relays = None
+
+        # act depending on the context
+        if instance_role in ('splunk_cloud'):
+
+            relay_url = account_conf.get('relay_url')
+            relay_token = account_conf.get('relay_token')
+
+            # the account may list several relays, batches are spread over the relays and fail over to the next relay
+            # if one cannot be reached
+            relays = RelayPool(relay_url)
+
+            # computer names are sent to the relays in batches, the relay runs the requests concurrently
+            def run_requests(computernames):
+                return splunk_start_defender_run_batches(
+                    lambda batch: relays.call(lambda relay_url: circ_relay_get_status_batch(account, relay_token, batch, relay_url, max_concurrency, False, timings)),
+                    computernames, batch_size, relays.get_batches_in_flight())
+
+            target = 'relay=\"{}\"'.format(relay_url)
+
+        else:
+
+            circ_url = account_conf.get('circ_url')
+            circ_token = account_conf.get('circ_token')
+
+            def run_requests(computernames):
+                if engine == 'asyncio':
+                    # the asyncio client (httpx) is only imported when used, to keep the startup of the command short
+                    from lib_splunk_start_defender_async import circ_get_status_async, splunk_start_defender_run_async
+                    return splunk_start_defender_run_async(
+                        lambda client, computername: circ_get_status_async(client, circ_token, computername, circ_url, timings.setdefault(computername, {})),
+                        computernames, max_concurrency)
+                return splunk_start_defender_run_concurrent(
+                    lambda computername: circ_get_status(circ_token, computername, circ_url, timings.setdefault(computername, {})),
+                    computernames, max_concurrency)
+
+            target = 'circ=\"{}\"'.format(circ_url)
+
+        # the computer names are processed by chunks of checkpoint_size, the position is saved once a chunk completes, after
+        # the state of the computers so that the chunk processed again after a restart finds the statuses unchanged
+        computernames = checkpoint['computernames']
+
+        while checkpoint['position'] < len(computernames):
+
+            chunk = computernames[checkpoint['position']:checkpoint['position'] + checkpoint_size]
+
+            for computername, response, exception in run_requests(chunk):
+
+                if exception is None:
+                    now = time.time()
+                    status_hash = get_status_hash(response)
+                    previous = hosts.get(computername)
+
+                    if previous is None:
+                        state_change = 'new'
+                    elif previous['hash'] != status_hash:
+                        state_change = 'changed'
+                    else:
+                        state_change = 'unchanged'
+
+                    hosts[computername] = {
+                        'hash': status_hash,
+                        'checked': now,
+                        'changed': previous['changed'] if state_change == 'unchanged' else now,
+                    }
+                    checkpoint['succeeded'] += 1
+
+                    # in delta mode, only the statuses which changed are indexed
+                    if mode == 'delta' and state_change == 'unchanged':
+                        checkpoint['unchanged'] += 1
+                        timings.pop(computername, None)
+                        continue
+
+                    data = dict(response) if isinstance(response, dict) else {'response': response}
+                    data['state_change'] = state_change
+
+                else:
+                    data = {
+                        'action': 'failure',
+                        'computername': computername,
+                        'exception': str(exception),
+                    }
+                    checkpoint['failed'] += 1
+                    logging.error(f"defender_status_sweep, input=\"{input_name}\", sweep_id=\"{checkpoint['sweep_id']}\", computername=\"{computername}\", exception=\"{str(exception)}\"")
+
+                data.setdefault('computername', computername)
+                data['sweep_id'] = checkpoint['sweep_id']
+                data.update(splunk_start_defender_get_timing_fields(timing, timings.pop(computername, None)))
+
+                ew.write_event(Event(
+                    data=json.dumps(data),
+                    stanza=input_name,
+                    time="%.3f" % time.time(),
+                    index=input_item.get('index'),
+                    sourcetype=sweep_sourcetype,
+                ))
+
+            splunk_start_defender_save_checkpoint(checkpoint_dir, input_name, hosts, hosts_checkpoint_namespace)
+
+            checkpoint['position'] += len(chunk)
+            splunk_start_defender_save_checkpoint(checkpoint_dir, input_name, checkpoint)
+
+        checkpoint['completed'] = time.time()
+        splunk_start_defender_save_checkpoint(checkpoint_dir, input_name, checkpoint)
+
+        logging.info(f"defender_status_sweep, input=\"{input_name}\", sweep_id=\"{checkpoint['sweep_id']}\", mode=\"{mode}\", processed {len(computernames)} get_defender_status requests against {target}, "
+            f"skipped={checkpoint['skipped']}, succeeded={checkpoint['succeeded']}, unchanged={checkpoint['unchanged']}, failed={checkpoint['failed']}, duration={round(checkpoint['completed'] - checkpoint['started'], 3)}")
+
+        if relays is not None:
+            logging.info("defender_status_sweep, input=\"%s\", relays=%s", input_name, JsonMessage(relays.get_metrics()))
+
+
+if __name__ == "__main__":
+    sys.exit(DefenderStatusSweep().run(sys.argv))
@@ -0,0 +1,140 @@
+import sys, time, os
+import logging
+from os.path import join, dirname, basename
+######################################################################
+# developed by Oliver Zimmermann
+#
+######################################################################
+
+URL_CONF = 'defender'
+APP_NAME = basename(dirname(dirname(__file__)))
+APP_HOME = dirname(dirname(__file__))
+sys.path.append(join(APP_HOME, 'lib'))
+splunkhome = os.environ['SPLUNK_HOME']
+
+# set logging, records are written to the log file by a background thread
+from lib_splunk_start_defender_logging import splunk_start_defender_setup_logging, JsonMessage
+# set the log level to INFO, DEBUG as the default is ERROR
+log = splunk_start_defender_setup_logging('%s/var/log/splunk/%s.log' % (splunkhome, APP_NAME), logging.INFO)
+
+try:
+    from splunklib.searchcommands import dispatch, GeneratingCommand, Configuration, Option, validators
+except Exception as e:
+    logging.error(e)
+
+# import additional libs
+from lib_splunk_start_defender import splunk_start_defender_get_command_context, \
+    circ_relay_get_job, circ_relay_list_jobs, \
+    splunk_start_defender_apply_command_context
+from lib_splunk_start_defender_relays import splunk_start_defender_get_relay_urls
+
+@Configuration()
+class GetDefenderJobs(GeneratingCommand):
+
+    account = Option(
+        doc='''
+        **Syntax:** **account=****
+        **Description:** account to be used for the query.''',
+        require=False, default="circapi_defender", validate=validators.Match("account", r"^.*$"))
+
+    job_id = Option(
+        doc='''
+        **Syntax:** **job_id=****
+        **Description:** the identifier of the job to be returned, if not set all jobs of the account are returned.''',
+        require=False, default=None, validate=validators.Match("job_id", r"^.*$"))
+
+    state = Option(
+        doc='''
+        **Syntax:** **state=****
+        **Description:** only return the jobs in this state (submitted, running, completed, failed, timeout).''',
+        require=False, default=None, validate=validators.Match("state", r"^(submitted|running|completed|failed|timeout)$"))
+
+    def generate(self):
+
+        # get instance_role, loglevel and account in a single call
+        search_start = time.monotonic()
+        try:
+            command_context = splunk_start_defender_get_command_context(self._metadata.searchinfo.session_key, self._metadata.searchinfo.splunkd_uri, self.account)
+            instance_role = command_context['instance_role']
+            account_conf = command_context['account']
+
+        except Exception as e:
+            raise Exception(str(e))
+
+        # set the log level, the timeouts and the proxy, requests are not sent nor retried once the deadline of the
+        # search is reached
+        deadline = splunk_start_defender_apply_command_context(command_context, search_start)[0]
+
+        # Process
+        try:
+
+            # act depending on the context, jobs are held by the relay, which is the local splunkd when running on the relay
+            if instance_role in ('splunk_cloud'):
+
+                # the account may list several relays, each relay holds the jobs it started
+                job_urls = splunk_start_defender_get_relay_urls(account_conf.get('relay_url'))
+                job_token = account_conf.get('relay_token')
+                job_auth_scheme = "Bearer"
+
+            else:
+
+                job_url = self._metadata.searchinfo.splunkd_uri
+                if not job_url.startswith("https://"):
+                    job_url = f"https://{job_url}"
+                job_urls = [job_url]
+                job_token = self._metadata.searchinfo.session_key
+                job_auth_scheme = "Splunk"
+
+            # run call, a job is looked up on each relay until found, jobs are listed from every relay
+            try:
+                if not job_urls:
+                    raise Exception("No relay is configured for this account, relay_url is required when running on Splunk Cloud")
+
+                jobs = []
+                exceptions = []
+                for job_url in job_urls:
+                    try:
+                        if self.job_id:
+                            jobs = [circ_relay_get_job(job_token, self.job_id, job_url, job_auth_scheme, deadline)]
+                            break
+                        jobs.extend(circ_relay_list_jobs(job_token, job_url, self.account, self.state, job_auth_scheme, deadline))
+                    except Exception as e:
+                        logging.error(f"get_defender_jobs, failed to get the jobs of relay=\"{job_url}\", exception=\"{str(e)}\"")
+                        exceptions.append(e)
+
+                # the job was not found on any relay, or no relay could list its jobs
+                if len(exceptions) == len(job_urls):
+                    raise exceptions[-1]
+
+                for job in jobs:
+                    yield_record = {
+                    '_time': job.get('created', time.time()),
+                    '_raw': job,
+                    'job_id': job.get('job_id'),
+                    'computername': job.get('computername'),
+                    'state': job.get('state'),
+                    }
+                    logging.debug(JsonMessage(yield_record))
+                    yield yield_record
+
+            except Exception as e:
+                yield_record = {
+                '_time': time.time(),
+                '_raw': {
+                    'action': 'failure',
+                    'exception': str(e),
+                    },
+                }
+                logging.error(JsonMessage(yield_record))
+                yield yield_record
+
+        except Exception as e:
+
+            msg = "get_defender_jobs, an exception was encountered, exception=\"{}\"".format(str(e))
+            yield {
+                '_raw': msg,
+                '_time': time.time()
+                }
+            logging.error(msg)
+
+dispatch(GetDefenderJobs, sys.argv, sys.stdin, sys.stdout, __name__)
@@ -1,8 +1,5 @@
-import sys, requests, time, os
+import sys, time, os
 import logging
-from logging.handlers import RotatingFileHandler
-import json
-from os import environ
 from os.path import join, dirname, basename
 ######################################################################
 # developed by Oliver Zimmermann
@@ -15,18 +12,10 @@ APP_HOME = dirname(dirname(__file__))
 sys.path.append(join(APP_HOME, 'lib'))
 splunkhome = os.environ['SPLUNK_HOME']
 
-# set logging
-filehandler = RotatingFileHandler('%s/var/log/splunk/%s.log' % (splunkhome, APP_NAME), mode='a', maxBytes=10000000, backupCount=1)
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(filename)s %(funcName)s %(lineno)d %(message)s')
-logging.Formatter.converter = time.gmtime
-filehandler.setFormatter(formatter)
-log = logging.getLogger()  # root logger - Good to get it only once.
-for hdlr in log.handlers[:]:  # remove the existing file handlers
-    if isinstance(hdlr,logging.FileHandler):
-        log.removeHandler(hdlr)
-log.addHandler(filehandler)      # set the new handler
+# set logging, records are written to the log file by a background thread
+from lib_splunk_start_defender_logging import splunk_start_defender_setup_logging, JsonMessage
 # set the log level to INFO, DEBUG as the default is ERROR
-log.setLevel(logging.INFO)
+log = splunk_start_defender_setup_logging('%s/var/log/splunk/%s.log' % (splunkhome, APP_NAME), logging.INFO)
 
 try:
     from splunklib.searchcommands import dispatch, GeneratingCommand, Configuration, Option, validators
@@ -34,9 +23,11 @@ except Exception as e:
     logging.error(e)
 
 # import additional libs
-from lib_splunk_start_defender import splunk_start_defender_get_conf, splunk_start_defender_get_account, \
-    circ_get_status, circ_start_scan, \
-    circ_relay_get_status, circ_relay_start_scan
+from lib_splunk_start_defender import splunk_start_defender_get_command_context, \
+    circ_get_status, circ_relay_get_status, \
+    splunk_start_defender_set_timing, splunk_start_defender_get_timing_fields, \
+    splunk_start_defender_apply_command_context
+from lib_splunk_start_defender_relays import RelayPool
 
 @Configuration()
 class GetDefender(GeneratingCommand):
@@ -53,23 +44,33 @@ class GetDefender(GeneratingCommand):
         **Description:** computername to be used for the query.''',
         require=True, default=None, validate=validators.Match("computername", r"^.*$"))
 
+    nocache = Option(
+        doc='''
+        **Syntax:** **nocache=****
+        **Description:** when running on Splunk Cloud, bypass the relay status cache and always query circ (boolean).''',
+        require=False, default=False, validate=validators.Boolean())
+
     def generate(self):
 
-        # get instance_role
+        # time spent per phase, in milliseconds
+        timing = {}
+
+        # get instance_role, loglevel and account in a single call
+        search_start = time.monotonic()
+        start = time.perf_counter()
         try:
-            start_defender_conf = splunk_start_defender_get_conf(self._metadata.searchinfo.session_key, self._metadata.searchinfo.splunkd_uri)
-            instance_role = start_defender_conf['role']['instance_role']
+            command_context = splunk_start_defender_get_command_context(self._metadata.searchinfo.session_key, self._metadata.searchinfo.splunkd_uri, self.account)
+            instance_role = command_context['instance_role']
+            account_conf = command_context['account']
 
         except Exception as e:
             raise Exception(str(e))
 
-        # get account
-        try:
-            # get account
-            account_conf = splunk_start_defender_get_account(self._metadata.searchinfo.session_key, self._metadata.searchinfo.splunkd_uri, self.account)
+        splunk_start_defender_set_timing(timing, 'context_ms', start)
 
-        except Exception as e:
-            raise Exception(str(e))
+        # set the log level, the timeouts and the proxy, requests are not sent nor retried once the deadline of the
+        # search is reached
+        deadline = splunk_start_defender_apply_command_context(command_context, search_start)[0]
 
         # Process
         try:
@@ -80,6 +81,9 @@ class GetDefender(GeneratingCommand):
                 relay_url = account_conf.get('relay_url')
                 relay_token = account_conf.get('relay_token')
 
+                # the account may list several relays, the call fails over to the next relay if one cannot be reached
+                relays = RelayPool(relay_url)
+
                 # run call
                 yield_record = {
                     '_time': time.time(),
@@ -91,17 +95,19 @@ class GetDefender(GeneratingCommand):
                         'response': 'sending request to relay=\"{}\"'.format(relay_url),
                     },
                 }
-                logging.info(json.dumps(yield_record, indent=2))
+                yield_record.update(splunk_start_defender_get_timing_fields(timing))
+                logging.info(JsonMessage(yield_record))
                 yield yield_record
 
                 # run call
                 try:
-                    response = circ_relay_get_status(self.account, relay_token, self.computername, relay_url)
+                    response = relays.call(lambda relay_url: circ_relay_get_status(self.account, relay_token, self.computername, relay_url, self.nocache, timing, deadline))
                     yield_record = {
                     '_time': time.time(),
                     '_raw': response,
                     }
-                    logging.info(json.dumps(yield_record, indent=2))
+                    yield_record.update(splunk_start_defender_get_timing_fields(timing))
+                    logging.info(JsonMessage(yield_record))
                     yield yield_record
 
                 except Exception as e:
@@ -112,9 +118,12 @@ class GetDefender(GeneratingCommand):
                         'exception': str(e),
                         },
                     }
-                    logging.error(json.dumps(yield_record, indent=2))
+                    yield_record.update(splunk_start_defender_get_timing_fields(timing))
+                    logging.error(JsonMessage(yield_record))
                     yield yield_record
 
+                logging.info("get_defender_status, relays=%s", JsonMessage(relays.get_metrics()))
+
             else:
 
                 circ_url = account_conf.get('circ_url')
@@ -131,17 +140,19 @@ class GetDefender(GeneratingCommand):
                         'response': 'sending get_defender_status request to circ=\"{}\"'.format(circ_url),
                     },
                 }
-                logging.info(json.dumps(yield_record, indent=2))
+                yield_record.update(splunk_start_defender_get_timing_fields(timing))
+                logging.info(JsonMessage(yield_record))
                 yield yield_record
 
                 # run call
                 try:
-                    response = circ_get_status(circ_token, self.computername, circ_url)
+                    response = circ_get_status(circ_token, self.computername, circ_url, timing, deadline)
                     yield_record = {
                     '_time': time.time(),
                     '_raw': response,
                     }
-                    logging.info(json.dumps(yield_record, indent=2))
+                    yield_record.update(splunk_start_defender_get_timing_fields(timing))
+                    logging.info(JsonMessage(yield_record))
                     yield yield_record
 
                 except Exception as e:
@@ -152,7 +163,8 @@ class GetDefender(GeneratingCommand):
                         'exception': str(e),
                         },
                     }
-                    logging.error(json.dumps(yield_record, indent=2))
+                    yield_record.update(splunk_start_defender_get_timing_fields(timing))
+                    logging.error(JsonMessage(yield_record))
                     yield yield_record
 
         except Exception as e:
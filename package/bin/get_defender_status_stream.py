@@ -0,0 +1,55 @@
+import sys, os
+import logging
+from os.path import join, dirname, basename
+######################################################################
+# developed by Oliver Zimmermann
+#
+######################################################################
+
+URL_CONF = 'defender'
+APP_NAME = basename(dirname(dirname(__file__)))
+APP_HOME = dirname(dirname(__file__))
+sys.path.append(join(APP_HOME, 'lib'))
+splunkhome = os.environ['SPLUNK_HOME']
+
+# set logging, records are written to the log file by a background thread
+from lib_splunk_start_defender_logging import splunk_start_defender_setup_logging
+# set the log level to INFO, DEBUG as the default is ERROR
+log = splunk_start_defender_setup_logging('%s/var/log/splunk/%s.log' % (splunkhome, APP_NAME), logging.INFO)
+
+try:
+    from splunklib.searchcommands import dispatch, Configuration, Option, validators
+except Exception as e:
+    logging.error(e)
+
+# import additional libs
+from lib_splunk_start_defender import circ_get_status, circ_relay_get_status_batch
+from lib_splunk_start_defender_stream import DefenderStreamingCommand
+
+@Configuration(distributed=False)
+class GetDefenderStream(DefenderStreamingCommand):
+
+    command_name = 'get_defender_status_stream'
+
+    nocache = Option(
+        doc='''
+        **Syntax:** **nocache=****
+        **Description:** when running on Splunk Cloud, bypass the relay status cache and always query circ (boolean).''',
+        require=False, default=False, validate=validators.Boolean())
+
+    def call_relay_batch(self, relay_token, computernames, relay_url, timings):
+        return circ_relay_get_status_batch(self.account, relay_token, computernames, relay_url, self.max_concurrency, self.nocache, timings, self.deadline)
+
+    def call_circ(self, circ_token, computername, circ_url, timing):
+        return circ_get_status(circ_token, computername, circ_url, timing, self.deadline)
+
+    async def call_circ_async(self, client, circ_token, computername, circ_url, timing):
+        # the asyncio client (httpx) is only imported when used, to keep the startup of the command short
+        from lib_splunk_start_defender_async import circ_get_status_async
+        return await circ_get_status_async(client, circ_token, computername, circ_url, timing, self.deadline)
+
+    def get_summary(self, count, target):
+        return 'get_defender_status_stream, requester=\"{}\", account=\"{}\", processed {} get_defender_status requests against {}'.format(
+            self._metadata.searchinfo.username, self.account, count, target)
+
+dispatch(GetDefenderStream, sys.argv, sys.stdin, sys.stdout, __name__)
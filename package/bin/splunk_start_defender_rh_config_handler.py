@@ -0,0 +1,33 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__author__ = "Guilhem Marchand for Mercedes"
+
+# import_declare_test is generated by ucc-gen, and sets the lib directory in the path
+import import_declare_test
+
+from splunktaucclib.rest_handler.admin_external import AdminExternalHandler
+
+# import additional libs
+from lib_splunk_start_defender import splunk_start_defender_touch_config_generation
+
+
+class SplunkStartDefenderConfigHandler(AdminExternalHandler):
+    """
+    UCC handler for the account and settings endpoints, bumps the configuration generation on every change so that
+    the persistent REST handler invalidates its cached accounts and tokens.
+    """
+
+    def __init__(self, *args, **kwargs):
+        AdminExternalHandler.__init__(self, *args, **kwargs)
+
+    def handleCreate(self, confInfo):
+        AdminExternalHandler.handleCreate(self, confInfo)
+        splunk_start_defender_touch_config_generation()
+
+    def handleEdit(self, confInfo):
+        AdminExternalHandler.handleEdit(self, confInfo)
+        splunk_start_defender_touch_config_generation()
+
+    def handleRemove(self, confInfo):
+        AdminExternalHandler.handleRemove(self, confInfo)
+        splunk_start_defender_touch_config_generation()
@@ -4,38 +4,118 @@ __name__ = "splunk_start_manager_rest_handler.py"
 __author__ = "Guilhem Marchand for Mercedes"
 
 import logging
-from logging.handlers import RotatingFileHandler
 import os, sys
 import json
-import re
 import time
+import threading
 
 splunkhome = os.environ['SPLUNK_HOME']
 
-# set logging
-logger = logging.getLogger(__name__)
-filehandler = RotatingFileHandler('%s/var/log/splunk/splunk_start_manager_rest_api.log' % splunkhome, mode='a', maxBytes=10000000, backupCount=1)
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(filename)s %(funcName)s %(lineno)d %(message)s')
-logging.Formatter.converter = time.gmtime
-filehandler.setFormatter(formatter)
-log = logging.getLogger()
-for hdlr in log.handlers[:]:
-    if isinstance(hdlr,logging.FileHandler):
-        log.removeHandler(hdlr)
-log.addHandler(filehandler)
-log.setLevel(logging.INFO)
-
 sys.path.append(os.path.join(splunkhome, 'etc', 'apps', 'splunk_start_defender', 'lib'))
 
+# set logging, records are written to the log file by a background thread, the log level is only changed if the
+# configuration changed
+from lib_splunk_start_defender_logging import splunk_start_defender_setup_logging, splunk_start_defender_set_loglevel
+logger = logging.getLogger(__name__)
+log = splunk_start_defender_setup_logging('%s/var/log/splunk/splunk_start_manager_rest_api.log' % splunkhome, logging.INFO)
+
 # import API handler
 import rest_handler
 
 # import additional libs
-from lib_splunk_start_defender import circ_get_status, circ_start_scan
-
-# import Splunk libs
-import splunklib.client as client
-import splunklib.results as results
+from lib_splunk_start_defender import circ_get_status, circ_start_scan, splunk_start_defender_run_concurrent, \
+    splunk_start_defender_touch_config_generation, \
+    splunk_start_defender_set_timing, splunk_start_defender_format_timing, circ_timing_header, \
+    splunk_start_defender_is_circ_failure, splunk_start_defender_set_timeouts, splunk_start_defender_get_forwarded_deadline, \
+    splunk_start_defender_set_proxy
+from lib_splunk_start_defender_credentials import CredentialCache, account_credential_realm, settings_credential_realm
+from lib_splunk_start_defender_jobs import ScanJobTracker
+from lib_splunk_start_defender_cache import SingleFlightCache
+from lib_splunk_start_defender_breaker import CircuitBreakers, CircuitOpenError
+from lib_splunk_start_defender_admission import AdmissionControl, RelayOverloadedError
+from lib_splunk_start_defender_splunkd import ServiceCache
+from lib_splunk_start_defender_relays import splunk_start_defender_get_relay_urls
+from lib_splunk_start_defender_config import ConfigSnapshotCache, splunk_start_defender_get_config_snapshot_generation, \
+    splunk_start_defender_read_confs
+
+# relay batch endpoints limits
+relay_batch_max_size = 1000
+relay_batch_max_concurrency = 20
+
+# accounts cache:
+# the handler is persistent, resolved accounts and their tokens are cached in-process for account_cache_ttl seconds,
+# so that the hot path does not need any call to splunkd. The cache is emptied when the configuration generation
+# changes, which happens when the accounts or settings are edited through the configuration UI, or when the
+# invalidate_cache endpoint is called.
+account_cache_ttl = 300
+account_cache = {
+    'generation': None,
+    'accounts': {},
+}
+account_cache_lock = threading.Lock()
+
+# decoded credentials of the accounts and of the proxy, see lib_splunk_start_defender_credentials
+credential_cache = CredentialCache()
+
+# splunkd services, shared by the endpoints, see lib_splunk_start_defender_splunkd
+splunkd_services = ServiceCache(owner="nobody", app="splunk_start_defender")
+
+# configuration snapshot:
+# the settings and accounts conf files are read from splunkd once per configuration generation, which includes the
+# changes replicated by the other members of a search head cluster, see lib_splunk_start_defender_config
+config_snapshots = ConfigSnapshotCache()
+
+# proxy settings:
+# the [proxy] settings and the proxy password are resolved once per configuration generation, and shared by every
+# account, the calls to circ are then routed through the proxy by the pooled sessions
+proxy_cache = {
+    'resolved': False,
+    'generation': None,
+    'conf': None,
+}
+proxy_cache_lock = threading.Lock()
+
+# scan jobs, tracked in memory by this persistent process, a job is unknown of the other processes of the handler if
+# splunkd runs more than one
+scan_jobs = ScanJobTracker()
+
+# status cache:
+# get status responses are cached per account and computer name for status_cache_ttl seconds (relay settings),
+# and concurrent identical requests share a single call to circ
+status_cache_ttl_default = 30
+status_cache = SingleFlightCache()
+
+# scan requests de-duplication:
+# scan calls from Splunk Cloud carry an idempotency key, a retried call with the same key is served the result of the
+# first call for scan_idempotency_ttl seconds rather than starting the scan again, failed calls are not remembered.
+# Keys are held in memory by this process, a retry served by another process of the handler is not de-duplicated.
+scan_idempotency_ttl = 600
+scan_requests = SingleFlightCache()
+
+# circuit breakers:
+# calls to circ go through a circuit breaker per account, after breaker_failure_threshold consecutive failures
+# (connection failures, timeouts, HTTP 429 and 5xx) the calls of the account fail immediately for breaker_reset_timeout
+# seconds rather than each waiting for circ, a single probe call then decides if the circuit closes (relay settings)
+breaker_failure_threshold_default = 5
+breaker_reset_timeout_default = 30
+circuit_breakers = CircuitBreakers()
+
+# admission control:
+# at most max_workers calls to circ run at a time, and at most account_max_workers per account, up to max_queued
+# further calls wait for a worker, calls beyond are rejected with HTTP 429 and a Retry-After hint, so that a burst of
+# searches from Splunk Cloud neither piles up in splunkd nor reaches circ (relay settings, 0 disables the limits)
+max_workers_default = 40
+max_queued_default = 100
+account_max_workers_default = 20
+circ_admission = AdmissionControl(max_workers_default, max_queued_default, account_max_workers_default)
+
+# timeouts:
+# connect and read timeouts of the calls to circ, and the maximum duration of a search (timeouts settings), the
+# search deadline is used by the custom commands, the relay abandons the work once the deadline forwarded by the
+# caller is reached
+connect_timeout_default = 10
+read_timeout_default = 60
+search_timeout_default = 900
 
 class SplunkStartDefender_v1(rest_handler.RESTHandler):
 
@@ -65,7 +145,7 @@ class SplunkStartDefender_v1(rest_handler.RESTHandler):
         # Retrieve from data
         try:
             resp_dict = json.loads(str(request_info.raw_args['payload']))
-        except Exception as e:
+        except Exception:
             resp_dict = None
 
         if resp_dict is not None:
@@ -73,7 +153,7 @@ class SplunkStartDefender_v1(rest_handler.RESTHandler):
                 describe = resp_dict['describe']
                 if describe in ("true", "True"):
                     describe = True
-            except Exception as e:
+            except Exception:
                 describe = False
         else:
             # body is not required
@@ -91,34 +171,12 @@ class SplunkStartDefender_v1(rest_handler.RESTHandler):
                 'status': 200
             }
 
-        # Get service
-        service = client.connect(
-            owner="nobody",
-            app="splunk_start_defender",
-            port=request_info.connection_listening_port,
-            token=request_info.system_authtoken
-        )
-
-        # set and get conf
-        conf_file = "splunk_start_defender_settings"
-        confs = service.confs[str(conf_file)]
-
-        # Initialize the splunk_start_defender dictionary
-        splunk_start_defender = {}
-
-        # Get conf
-        for stanza in confs:
-            logging.debug(f"get_conf, Processing stanza.name=\"{stanza.name}\"")
-            # Create a sub-dictionary for the current stanza name if it doesn't exist
-            if stanza.name not in splunk_start_defender:
-                splunk_start_defender[stanza.name] = {}
-
-            # Store key-value pairs from the stanza content in the corresponding sub-dictionary
-            for stanzakey, stanzavalue in stanza.content.items():
-                logging.debug(f"get_splunk_start_defender, Processing stanzakey=\"{stanzakey}\", stanzavalue=\"{stanzavalue}\"")
-                splunk_start_defender[stanza.name][stanzakey] = stanzavalue
+        # get the conf from the configuration snapshot
+        snapshot = self.get_config_snapshot(request_info)
+        splunk_start_defender = dict((stanza_name, dict(stanza_content)) for stanza_name, stanza_content in
+            snapshot.get_conf('splunk_start_defender_settings').items())
 
-        logging.debug("get_splunk_start_defender, process result: {}".format(splunk_start_defender))
+        logging.debug("get_splunk_start_defender, process result: %s", splunk_start_defender)
 
         return {
             "payload": splunk_start_defender,
@@ -126,6 +184,13 @@ class SplunkStartDefender_v1(rest_handler.RESTHandler):
         }
 
 
+    # get the configuration snapshot, the conf files are read from splunkd only if the snapshot is stale
+    def get_config_snapshot(self, request_info, config_generation=None):
+
+        return config_snapshots.get(lambda: splunkd_services.call(request_info.connection_listening_port,
+            request_info.system_authtoken, splunk_start_defender_read_confs), config_generation)
+
+
     # get account details with least privileges approach
     def post_get_account(self, request_info, **kwargs):
 
@@ -134,7 +199,7 @@ class SplunkStartDefender_v1(rest_handler.RESTHandler):
         # Retrieve from data
         try:
             resp_dict = json.loads(str(request_info.raw_args['payload']))
-        except Exception as e:
+        except Exception:
             resp_dict = None
 
         if resp_dict is not None:
@@ -142,7 +207,7 @@ class SplunkStartDefender_v1(rest_handler.RESTHandler):
                 describe = resp_dict['describe']
                 if describe in ("true", "True"):
                     describe = True
-            except Exception as e:
+            except Exception:
                 describe = False
                 account = resp_dict['account']
         else:
@@ -164,378 +229,539 @@ class SplunkStartDefender_v1(rest_handler.RESTHandler):
                 'status': 200
             }
 
-        # Get service
-        service = client.connect(
-            owner="nobody",
-            app="splunk_start_defender",
-            port=request_info.connection_listening_port,
-            token=request_info.system_authtoken
-        )
+        # get the account
+        account_conf, error_response = self.get_account_conf(request_info, account)
+        if error_response:
+            return error_response
 
-        # set loglevel
-        loglevel = 'INFO'
-        conf_file = "splunk_start_defender_settings"
-        confs = service.confs[str(conf_file)]
-        for stanza in confs:
-            if stanza.name == 'logging':
-                for stanzakey, stanzavalue in stanza.content.items():
-                    if stanzakey == "loglevel":
-                        loglevel = stanzavalue
-        logginglevel = logging.getLevelName(loglevel)
-        log.setLevel(logginglevel)
+        return self.get_account_response(account, account_conf)
 
-        # Splunk credentials store
-        storage_passwords = service.storage_passwords
 
-        # get instance role
-        conf_file = "splunk_start_defender_settings"
-        confs = service.confs[str(conf_file)]
-        for stanza in confs:
-            if stanza.name == 'role':
-                for key, value in stanza.content.items():
-                    if key == "instance_role":
-                        instance_role = value
+    # get the command context: instance role, logging level and account in a single call
+    def post_command_context(self, request_info, **kwargs):
 
-        # get all acounts
-        accounts = []
-        conf_file = "splunk_start_defender_account"
-        confs = service.confs[str(conf_file)]
-        for stanza in confs:
-            # get all accounts
-            for name in stanza.name:
-                accounts.append(stanza.name)
-                break
+        describe = False
 
-        # get account
-        circ_url = None
-        relay_url = None
+        # Retrieve from data
+        try:
+            resp_dict = json.loads(str(request_info.raw_args['payload']))
+        except Exception:
+            resp_dict = None
 
-        for stanza in confs:
-            if stanza.name == str(account):
-                for key, value in stanza.content.items():
-                    if key == "circ_url":
-                        circ_url = value
-                    if key == "relay_url":
-                        relay_url = value                              
+        if resp_dict is not None:
+            try:
+                describe = resp_dict['describe']
+                if describe in ("true", "True"):
+                    describe = True
+            except Exception:
+                describe = False
+                account = resp_dict['account']
+        else:
+            # body is required
+            describe = True
 
-        # end of get configuration
+        # if describe is requested, show the usage
+        if describe:
 
-        # Stop here if we cannot find the submitted account
-        if not account in accounts:
-            return {
-                "payload": {
-                    'status': 'failure',
-                    'message': 'The account could be found on this system, check the spelling and your configuration',
-                    'account': account,
-                },
-                'status': 500
+            response = {
+                'describe': 'This endpoint provides the context of the custom commands in a single call: the instance role, the logging level, the timeouts, the proxy and the account configuration, it requires a POST call with the following options:',
+                "resource_desc": "Retrieve the instance role, the logging level, the timeouts, the proxy and the account configuration",
+                'options': [{
+                    'account': 'The account configuration identifier',
+                }]
             }
-
-        elif len(accounts) == 0:
             return {
-                "payload": {
-                    'status': 'failure',
-                    'message': 'There are no account configured yet for this instance.',
-                    'account': account,
-                },
-                'status': 500
+                "payload": response,
+                'status': 200
             }
 
-        else:
-
-            # if instance_role is Splunk Relay
-            if instance_role in ('splunk_relay'):
-
-                # enforce https
-                if not circ_url.startswith("https://"):
-                    circ_url = "https://" + str(circ_url)
+        # get the account
+        account_conf, error_response = self.get_account_conf(request_info, account)
+        if error_response:
+            return error_response
 
-                # remote trailing slash in the URL, if any
-                if circ_url.endswith('/'):
-                    circ_url = circ_url[:-1]
+        account_response = self.get_account_response(account, account_conf)
+        if account_response.get('status') != 200:
+            return account_response
 
-                # get circ_token
-                circ_token = None
+        return {
+            "payload": {
+                'status': 'success',
+                'instance_role': account_conf.get('instance_role'),
+                'loglevel': account_conf.get('loglevel'),
+                'timeouts': {
+                    'connect_timeout': account_conf.get('connect_timeout'),
+                    'read_timeout': account_conf.get('read_timeout'),
+                    'search_timeout': account_conf.get('search_timeout'),
+                },
+                'proxy': account_conf.get('proxy'),
+                'account': account_response.get('payload'),
+            },
+            'status': 200
+        }
 
-                # realm
-                credential_realm = '__REST_CREDENTIAL__#splunk_start_defender#configs/conf-splunk_start_defender_account'
-                credential_name = str(credential_realm) + ":" + str(account) + "``"
 
-                # extract as raw json
-                bearer_token_rawvalue = ""
+    # verify the account configuration and render it depending on the instance role, shared by the account endpoints
+    def get_account_response(self, account, account_conf):
 
-                for credential in storage_passwords:
-                    if credential.content.get('realm') == str(credential_realm) and credential.name.startswith(credential_name):
-                        bearer_token_rawvalue = bearer_token_rawvalue + str(credential.content.clear_password)
+        instance_role = account_conf.get('instance_role')
 
-                # extract a clean json object
-                bearer_token_rawvalue_match = re.search('\{\"circ_token\":\s*\"(.*)\"\}', bearer_token_rawvalue)
-                if bearer_token_rawvalue_match:
-                    circ_token = bearer_token_rawvalue_match.group(1)
-                else:
-                    circ_token = None
+        #
+        # verify and return the response
+        #
 
-            # else if instance_role is Splunk Cloud
-            elif instance_role in ('splunk_cloud'):
+        if instance_role not in ("splunk_cloud", "splunk_relay"):
 
-                # enforce https
-                if not relay_url.startswith("https://"):
-                    relay_url = "https://" + str(relay_url)
+            msg = 'This instance has no role configured yet, cannot continue.'
+            logging.error(msg)
 
-                # remote trailing slash in the URL, if any
-                if relay_url.endswith('/'):
-                    relay_url = relay_url[:-1]
+            return {
+                "payload": {
+                    'status': 'failure',
+                    'message': msg,
+                    'account': account,
+                },
+                'status': 500
+            }
 
-                # get relay_token
-                relay_token = None
+        elif instance_role in ("splunk_cloud") and not account_conf.get('relay_token'):
 
-                # realm
-                credential_realm = '__REST_CREDENTIAL__#splunk_start_defender#configs/conf-splunk_start_defender_account'
-                credential_name = str(credential_realm) + ":" + str(account) + "``"
+            msg = 'This instance is configured with role {} but the circ_token could not be retrieved, cannot continue.'.format(instance_role)
+            logging.error(msg)
 
-                # extract as raw json
-                bearer_token_rawvalue = ""
+            return {
+                "payload": {
+                    'status': 'failure',
+                    'message': msg,
+                    'account': account,
+                },
+                'status': 500
+            }
 
-                for credential in storage_passwords:
-                    if credential.content.get('realm') == str(credential_realm) and credential.name.startswith(credential_name):
-                        bearer_token_rawvalue = bearer_token_rawvalue + str(credential.content.clear_password)
+        elif instance_role in ("splunk_relay") and not account_conf.get('circ_token'):
 
-                # extract a clean json object
-                bearer_token_rawvalue_match = re.search('\{\"relay_token\":\s*\"(.*)\"\}', bearer_token_rawvalue)
-                if bearer_token_rawvalue_match:
-                    relay_token = bearer_token_rawvalue_match.group(1)
-                else:
-                    relay_token = None
+            msg = 'This instance is configured with role {} but the relay_token could not be retrieved, cannot continue.'.format(instance_role)
+            logging.error(msg)
 
-            #
-            # verify and return the response
-            #
+            return {
+                "payload": {
+                    'status': 'failure',
+                    'message': msg,
+                    'account': account,
+                },
+                'status': 500
+            }
 
-            if instance_role in ("splunk_cloud") and not relay_token:
+        else:
 
-                msg = 'This instance is configured with role {} but the circ_token could not be retrieved, cannot continue.'.format(instance_role)
-                logging.error(msg)
+            if instance_role in ("splunk_cloud"):
 
                 return {
                     "payload": {
-                        'status': 'failure',
-                        'message': msg,
+                        'status': 'success',
+                        'instance_role': instance_role,
                         'account': account,
+                        'relay_url': account_conf.get('relay_url'),
+                        'relay_token': account_conf.get('relay_token'),
                     },
-                    'status': 500
+                    'status': 200
                 }
-            
-            elif instance_role in ("splunk_relay") and not circ_token:
-            
-                msg = 'This instance is configured with role {} but the relay_token could not be retrieved, cannot continue.'.format(instance_role)
-                logging.error(msg)
+
+            elif instance_role in ("splunk_relay"):
 
                 return {
                     "payload": {
-                        'status': 'failure',
-                        'message': msg,
+                        'status': 'success',
+                        'instance_role': instance_role,
                         'account': account,
+                        'circ_url': account_conf.get('circ_url'),
+                        'circ_token': account_conf.get('circ_token'),
                     },
-                    'status': 500
+                    'status': 200
                 }
 
-            else:
 
-                if instance_role in ("splunk_cloud"):
-
-                    return {
-                        "payload": {
-                            'status': 'success',
-                            'instance_role': instance_role,
-                            'account': account,
-                            'relay_url': relay_url,
-                            'relay_token': relay_token,
-                        },
-                        'status': 200
-                    }
-            
-                elif instance_role in ("splunk_relay"):
-
-                    return {
-                        "payload": {
-                            'status': 'success',
-                            'instance_role': instance_role,
-                            'account': account,
-                            'circ_url': circ_url,
-                            'circ_token': circ_token,
-                        },
-                        'status': 200
-                    }
+    # get the settings and the account configuration, shared by the account and relay endpoints
+    def get_account_conf(self, request_info, account):
+        """
+        Resolve the instance role, the log level, and the account configuration including its tokens.
+        Resolved accounts are cached in-process, see account_cache.
+        Returns a tuple (account_conf, error_response), error_response is None if the account was resolved.
+        """
 
+        # serve from the cache, the cache is emptied if the configuration was changed since it was filled
+        config_generation = splunk_start_defender_get_config_snapshot_generation()
 
-    # Run the circ get status action
-    def post_relay_circ_get_status(self, request_info, **kwargs):
+        with account_cache_lock:
+            if account_cache['generation'] != config_generation:
+                account_cache['generation'] = config_generation
+                account_cache['accounts'].clear()
 
-        describe = False
+            cached_account = account_cache['accounts'].get(account)
 
-        # Retrieve from data
-        try:
-            resp_dict = json.loads(str(request_info.raw_args['payload']))
-        except Exception as e:
-            resp_dict = None
+        if cached_account and time.time() - cached_account['mtime'] < account_cache_ttl:
+            splunk_start_defender_set_loglevel(cached_account['conf']['loglevel'])
+            return cached_account['conf'], None
 
-        if resp_dict is not None:
-            try:
-                describe = resp_dict['describe']
-                if describe in ("true", "True"):
-                    describe = True
-            except Exception as e:
-                describe = False
-                account = resp_dict['account']
-                computername = resp_dict['computername']
-        else:
-            # body is required
-            describe = True
+        # resolve the account from the configuration snapshot, and its credentials through the shared splunkd service
+        snapshot = self.get_config_snapshot(request_info, config_generation)
 
-        # if describe is requested, show the usage
-        if describe:
+        return splunkd_services.call(request_info.connection_listening_port, request_info.system_authtoken,
+            lambda service: self.read_account_conf(service, snapshot, account, config_generation))
 
-            response = {
-                'describe': 'This endpoint runs the action circ get status, it requires a POST call with the following options:',
-                "resource_desc": "Run circ get status action",
-                'options': [{
-                    'account': 'The name of the account',
-                    'computername': 'The computer name',
-                }]
-            }
-            return {
-                "payload": response,
-                'status': 200
-            }
 
-        # Get service
-        service = client.connect(
-            owner="nobody",
-            app="splunk_start_defender",
-            port=request_info.connection_listening_port,
-            token=request_info.system_authtoken
-        )
+    # read the instance settings and the account configuration, and store the account in the cache
+    def read_account_conf(self, service, snapshot, account, config_generation):
+        """
+        Returns a tuple (account_conf, error_response), see get_account_conf.
+        """
 
-        # set loglevel
+        # set loglevel, get instance role and relay settings
         loglevel = 'INFO'
+        instance_role = None
+        status_cache_ttl = status_cache_ttl_default
+        breaker_failure_threshold = breaker_failure_threshold_default
+        breaker_reset_timeout = breaker_reset_timeout_default
+        max_workers = max_workers_default
+        max_queued = max_queued_default
+        account_max_workers = account_max_workers_default
+        connect_timeout = connect_timeout_default
+        read_timeout = read_timeout_default
+        search_timeout = search_timeout_default
+        proxy_settings = {}
         conf_file = "splunk_start_defender_settings"
-        confs = service.confs[str(conf_file)]
-        for stanza in confs:
-            if stanza.name == 'logging':
-                for stanzakey, stanzavalue in stanza.content.items():
+        confs = snapshot.get_conf(conf_file)
+        for stanza_name, stanza_content in confs.items():
+            if stanza_name == 'logging':
+                for stanzakey, stanzavalue in stanza_content.items():
                     if stanzakey == "loglevel":
                         loglevel = stanzavalue
-        logginglevel = logging.getLevelName(loglevel)
-        log.setLevel(logginglevel)
-
-        # first, retrieve the credentials for this account
+            if stanza_name == 'role':
+                for stanzakey, stanzavalue in stanza_content.items():
+                    if stanzakey == "instance_role":
+                        instance_role = stanzavalue
+            if stanza_name == 'relay':
+                for stanzakey, stanzavalue in stanza_content.items():
+                    if stanzakey == "status_cache_ttl":
+                        try:
+                            status_cache_ttl = int(stanzavalue)
+                        except Exception:
+                            logging.error(f"Invalid value for status_cache_ttl=\"{stanzavalue}\", using the default of {status_cache_ttl_default} seconds")
+                    if stanzakey == "breaker_failure_threshold":
+                        try:
+                            breaker_failure_threshold = int(stanzavalue)
+                        except Exception:
+                            logging.error(f"Invalid value for breaker_failure_threshold=\"{stanzavalue}\", using the default of {breaker_failure_threshold_default}")
+                    if stanzakey == "breaker_reset_timeout":
+                        try:
+                            breaker_reset_timeout = int(stanzavalue)
+                        except Exception:
+                            logging.error(f"Invalid value for breaker_reset_timeout=\"{stanzavalue}\", using the default of {breaker_reset_timeout_default} seconds")
+                    if stanzakey == "max_workers":
+                        try:
+                            max_workers = int(stanzavalue)
+                        except Exception:
+                            logging.error(f"Invalid value for max_workers=\"{stanzavalue}\", using the default of {max_workers_default}")
+                    if stanzakey == "max_queued":
+                        try:
+                            max_queued = int(stanzavalue)
+                        except Exception:
+                            logging.error(f"Invalid value for max_queued=\"{stanzavalue}\", using the default of {max_queued_default}")
+                    if stanzakey == "account_max_workers":
+                        try:
+                            account_max_workers = int(stanzavalue)
+                        except Exception:
+                            logging.error(f"Invalid value for account_max_workers=\"{stanzavalue}\", using the default of {account_max_workers_default}")
+            if stanza_name == 'proxy':
+                proxy_settings = dict(stanza_content.items())
+            if stanza_name == 'timeouts':
+                for stanzakey, stanzavalue in stanza_content.items():
+                    if stanzakey == "connect_timeout":
+                        try:
+                            connect_timeout = float(stanzavalue)
+                        except Exception:
+                            logging.error(f"Invalid value for connect_timeout=\"{stanzavalue}\", using the default of {connect_timeout_default} seconds")
+                    if stanzakey == "read_timeout":
+                        try:
+                            read_timeout = float(stanzavalue)
+                        except Exception:
+                            logging.error(f"Invalid value for read_timeout=\"{stanzavalue}\", using the default of {read_timeout_default} seconds")
+                    if stanzakey == "search_timeout":
+                        try:
+                            search_timeout = float(stanzavalue)
+                        except Exception:
+                            logging.error(f"Invalid value for search_timeout=\"{stanzavalue}\", using the default of {search_timeout_default} seconds")
+        splunk_start_defender_set_loglevel(loglevel)
+
+        # set the timeouts of the calls to circ
+        splunk_start_defender_set_timeouts(connect_timeout, read_timeout)
 
         # Splunk credentials store
         storage_passwords = service.storage_passwords
 
+        # set the proxy of the calls to circ
+        proxy_conf = self.get_proxy_conf(storage_passwords, proxy_settings, config_generation)
+        try:
+            splunk_start_defender_set_proxy(proxy_conf)
+        except Exception as e:
+            logging.error(f"Failed to set the proxy, calls are not routed through the proxy, exception=\"{str(e)}\"")
+
         # get all acounts
         accounts = []
         conf_file = "splunk_start_defender_account"
-        confs = service.confs[str(conf_file)]
-        for stanza in confs:
+        confs = snapshot.get_conf(conf_file)
+        for stanza_name, stanza_content in confs.items():
             # get all accounts
-            for name in stanza.name:
-                accounts.append(stanza.name)
-                break
+            accounts.append(stanza_name)
 
         # get account
         circ_url = None
         relay_url = None
 
-        for stanza in confs:
-            if stanza.name == str(account):
-                for key, value in stanza.content.items():
+        for stanza_name, stanza_content in confs.items():
+            if stanza_name == str(account):
+                for key, value in stanza_content.items():
                     if key == "circ_url":
                         circ_url = value
                     if key == "relay_url":
-                        relay_url = value                              
+                        relay_url = value
 
         # end of get configuration
 
         # Stop here if we cannot find the submitted account
-        if not account in accounts:
-            return {
+        if len(accounts) == 0:
+            return None, {
                 "payload": {
                     'status': 'failure',
-                    'message': 'The account could be found on this system, check the spelling and your configuration',
+                    'message': 'There are no account configured yet for this instance.',
                     'account': account,
                 },
                 'status': 500
             }
 
-        elif len(accounts) == 0:
-            return {
+        elif not account in accounts:
+            return None, {
                 "payload": {
                     'status': 'failure',
-                    'message': 'There are no account configured yet for this instance.',
+                    'message': 'The account could be found on this system, check the spelling and your configuration',
                     'account': account,
                 },
                 'status': 500
             }
 
-        else:
-
-            # enforce https
+        # enforce https, and remove trailing slash in the URLs, if any
+        if circ_url:
             if not circ_url.startswith("https://"):
                 circ_url = "https://" + str(circ_url)
-
-            # remote trailing slash in the URL, if any
             if circ_url.endswith('/'):
                 circ_url = circ_url[:-1]
 
-            # get circ_token
-            circ_token = None
+        # an account may list several relays, separated by commas
+        if relay_url:
+            relay_url = ','.join(splunk_start_defender_get_relay_urls(relay_url))
+
+        # decode the encrypted fields of the account, only the credential chunks of this account are retrieved, failures
+        # to reach splunkd are raised so that a rejected token is retried with a new service
+        try:
+            credentials = credential_cache.get(storage_passwords, account, account_credential_realm, config_generation)
+        except ValueError as e:
+            logging.error(f"Failed to decode the credentials of account=\"{account}\", exception=\"{str(e)}\"")
+            credentials = {}
+
+        circ_token = credentials.get('circ_token')
+        relay_token = credentials.get('relay_token')
+
+        account_conf = {
+            'instance_role': instance_role,
+            'loglevel': loglevel,
+            'account': account,
+            'circ_url': circ_url,
+            'circ_token': circ_token,
+            'relay_url': relay_url,
+            'relay_token': relay_token,
+            'status_cache_ttl': status_cache_ttl,
+            'breaker_failure_threshold': breaker_failure_threshold,
+            'breaker_reset_timeout': breaker_reset_timeout,
+            'max_workers': max_workers,
+            'max_queued': max_queued,
+            'account_max_workers': account_max_workers,
+            'connect_timeout': connect_timeout,
+            'read_timeout': read_timeout,
+            'search_timeout': search_timeout,
+            'proxy': proxy_conf,
+        }
 
-            # realm
-            credential_realm = '__REST_CREDENTIAL__#splunk_start_defender#configs/conf-splunk_start_defender_account'
-            credential_name = str(credential_realm) + ":" + str(account) + "``"
+        # store in the cache, only if the configuration was not changed in the meantime
+        with account_cache_lock:
+            if account_cache['generation'] == config_generation:
+                account_cache['accounts'][account] = {
+                    'mtime': time.time(),
+                    'conf': account_conf,
+                }
 
-            # extract as raw json
-            bearer_token_rawvalue = ""
+        return account_conf, None
 
-            for credential in storage_passwords:
-                if credential.content.get('realm') == str(credential_realm) and credential.name.startswith(credential_name):
-                    bearer_token_rawvalue = bearer_token_rawvalue + str(credential.content.clear_password)
 
-            # extract a clean json object
-            bearer_token_rawvalue_match = re.search('\{\"circ_token\":\s*\"(.*)\"\}', bearer_token_rawvalue)
-            if bearer_token_rawvalue_match:
-                circ_token = bearer_token_rawvalue_match.group(1)
-            else:
-                circ_token = None
+    # get the proxy settings with the clear proxy password, resolved once per configuration generation
+    def get_proxy_conf(self, storage_passwords, proxy_settings, config_generation):
+        """
+        Return the proxy settings, with proxy_password resolved from the credential store, see proxy_cache.
+        """
 
-        # proceed
+        with proxy_cache_lock:
+            if proxy_cache['resolved'] and proxy_cache['generation'] == config_generation:
+                return proxy_cache['conf']
+
+        proxy_conf = dict(proxy_settings)
+        proxy_conf.pop('proxy_password', None)
+
+        # the password is only stored if the proxy is enabled with credentials
+        if str(proxy_conf.get('proxy_enabled')).lower() in ('1', 'true') and proxy_conf.get('proxy_username'):
+            try:
+                proxy_conf['proxy_password'] = credential_cache.get(storage_passwords, 'proxy', settings_credential_realm, config_generation).get('proxy_password')
+            except Exception as e:
+                logging.error(f"Failed to decode the proxy password, exception=\"{str(e)}\"")
+
+        with proxy_cache_lock:
+            proxy_cache['resolved'] = True
+            proxy_cache['generation'] = config_generation
+            proxy_cache['conf'] = proxy_conf
+
+        return proxy_conf
+
+
+    # get the deadline forwarded by the caller, as a time.monotonic() value, or None
+    def get_request_deadline(self, request_info):
+        return splunk_start_defender_get_forwarded_deadline(request_info.raw_args.get('headers') or [])
+
+
+    # get the admission control of the calls to circ, with the relay settings of the account
+    def get_circ_admission(self, account_conf):
+
+        max_workers = account_conf.get('max_workers', max_workers_default)
+        max_queued = account_conf.get('max_queued', max_queued_default)
+        account_max_workers = account_conf.get('account_max_workers', account_max_workers_default)
+
+        if not circ_admission.is_configured(max_workers, max_queued, account_max_workers):
+            circ_admission.configure(max_workers, max_queued, account_max_workers)
+
+        return circ_admission
+
+
+    # call circ through the admission control and the circuit breaker of the account
+    def call_circ(self, account_conf, func, deadline=None):
+        """
+        Call func() once a worker is available, through the circuit breaker of the account. RelayOverloadedError is
+        raised if no worker is available in time, CircuitOpenError without calling circ while the circuit is open.
+        """
+
+        breaker = circuit_breakers.get(account_conf.get('account'),
+            account_conf.get('breaker_failure_threshold'), account_conf.get('breaker_reset_timeout'))
+
+        # the rejected calls are not accounted by the circuit breaker
+        return self.get_circ_admission(account_conf).call(account_conf.get('account'),
+            lambda: breaker.call(func, splunk_start_defender_is_circ_failure), deadline)
+
+
+    # the response of a failed call to circ, a call rejected by an open circuit breaker says so, a call rejected by
+    # the admission control is returned as HTTP 429 with a Retry-After header, which the caller retries
+    def circ_failure_response(self, exception, timing):
+
+        payload = {
+            'action': 'failure',
+            'exception': str(exception),
+        }
+        status = 500
+        headers = {
+            circ_timing_header: str(timing.get('circ_ms')),
+        }
+
+        if isinstance(exception, CircuitOpenError):
+            payload['circuit_breaker'] = 'open'
+            payload['retry_after'] = round(exception.retry_after, 1)
+
+        elif isinstance(exception, RelayOverloadedError):
+            payload['admission'] = 'rejected'
+            payload['retry_after'] = exception.retry_after
+            status = 429
+            headers['Retry-After'] = str(exception.retry_after)
+
+        return {
+            "payload": payload,
+            'status': status,
+            'headers': headers,
+        }
+
+
+    # invalidate the accounts cache
+    def post_invalidate_cache(self, request_info, **kwargs):
+
+        describe = False
+
+        # Retrieve from data
         try:
-            response = circ_get_status(circ_token, computername, circ_url)
+            resp_dict = json.loads(str(request_info.raw_args['payload']))
+        except Exception:
+            resp_dict = None
+
+        if resp_dict is not None:
+            try:
+                describe = resp_dict['describe']
+                if describe in ("true", "True"):
+                    describe = True
+            except Exception:
+                describe = False
+        else:
+            # body is not required
+            describe = False
+
+        # if describe is requested, show the usage
+        if describe:
+
+            response = {
+                'describe': 'This endpoint invalidates the cached accounts, tokens and statuses, it requires a POST call with no options:',
+                "resource_desc": "Invalidate the accounts and status caches",
+            }
             return {
                 "payload": response,
                 'status': 200
             }
 
-        except Exception as e:
-            return {
-                "payload": {
-                    'action': 'failure',
-                    'exception': str(e),
-                },
-                'status': 500
-            }
+        # bump the configuration generation, this invalidates the cache of every persistent process
+        splunk_start_defender_touch_config_generation()
 
+        with account_cache_lock:
+            accounts_count = len(account_cache['accounts'])
+            account_cache['accounts'].clear()
 
-    # Run the circ start scan action
-    def post_relay_circ_start_scan(self, request_info, **kwargs):
+        status_cache.clear()
+        credential_cache.clear()
+        config_snapshots.clear()
+
+        with proxy_cache_lock:
+            proxy_cache['resolved'] = False
+
+        logging.info(f"invalidate_cache, the accounts cache was invalidated, {accounts_count} cached accounts were purged")
+
+        return {
+            "payload": {
+                'action': 'success',
+                'message': 'The accounts cache was invalidated',
+                'purged_accounts': accounts_count,
+            },
+            'status': 200
+        }
+
+
+    # Run the circ get status action
+    def post_relay_circ_get_status(self, request_info, **kwargs):
 
         describe = False
 
         # Retrieve from data
         try:
             resp_dict = json.loads(str(request_info.raw_args['payload']))
-        except Exception as e:
+        except Exception:
             resp_dict = None
 
         if resp_dict is not None:
@@ -543,13 +769,13 @@ class SplunkStartDefender_v1(rest_handler.RESTHandler):
                 describe = resp_dict['describe']
                 if describe in ("true", "True"):
                     describe = True
-            except Exception as e:
+            except Exception:
                 describe = False
                 account = resp_dict['account']
                 computername = resp_dict['computername']
-                fullscan = resp_dict['fullscan']
+                nocache = str(resp_dict.get('nocache', False)) in ("true", "True", "1")
         else:
-            # body is not required in this endpoint, if not submitted do not describe the usage
+            # body is required
             describe = True
 
         # if describe is requested, show the usage
@@ -559,9 +785,9 @@ class SplunkStartDefender_v1(rest_handler.RESTHandler):
                 'describe': 'This endpoint runs the action circ get status, it requires a POST call with the following options:',
                 "resource_desc": "Run circ get status action",
                 'options': [{
-                    'account': 'The account',
+                    'account': 'The name of the account',
                     'computername': 'The computer name',
-                    'fullscan': 'Run fullscan (boolean)',
+                    'nocache': 'OPTIONAL: Bypass the status cache (boolean)',
                 }]
             }
             return {
@@ -569,118 +795,688 @@ class SplunkStartDefender_v1(rest_handler.RESTHandler):
                 'status': 200
             }
 
-        # Get service
-        service = client.connect(
-            owner="nobody",
-            app="splunk_start_defender",
-            port=request_info.connection_listening_port,
-            token=request_info.system_authtoken
-        )
+        # get the account
+        timing = {}
+        start = time.perf_counter()
+        account_conf, error_response = self.get_account_conf(request_info, account)
+        splunk_start_defender_set_timing(timing, 'account_ms', start)
+        if error_response:
+            return error_response
 
-        # set loglevel
-        loglevel = 'INFO'
-        conf_file = "splunk_start_defender_settings"
-        confs = service.confs[str(conf_file)]
-        for stanza in confs:
-            if stanza.name == 'logging':
-                for stanzakey, stanzavalue in stanza.content.items():
-                    if stanzakey == "loglevel":
-                        loglevel = stanzavalue
-        logginglevel = logging.getLevelName(loglevel)
-        log.setLevel(logginglevel)
+        circ_url = account_conf.get('circ_url')
+        circ_token = account_conf.get('circ_token')
 
-        # first, retrieve the credentials for this account
+        # calls to circ are abandoned once the deadline of the caller is reached
+        deadline = self.get_request_deadline(request_info)
 
-        # Splunk credentials store
-        storage_passwords = service.storage_passwords
+        # proceed, the time spent on circ (or waiting for the cache) is returned to the caller in the timing header
+        cache_status = None
+        start = time.perf_counter()
+        try:
+            response, cache_status = status_cache.get(
+                (account, str(computername).lower()),
+                lambda: self.call_circ(account_conf, lambda: circ_get_status(circ_token, computername, circ_url, deadline=deadline), deadline),
+                account_conf.get('status_cache_ttl'), nocache)
+            splunk_start_defender_set_timing(timing, 'circ_ms', start)
+            return {
+                "payload": response,
+                'status': 200,
+                'headers': {
+                    'X-Splunk-Start-Defender-Cache': cache_status,
+                    circ_timing_header: str(timing['circ_ms']),
+                },
+            }
 
-        # get all acounts
-        accounts = []
-        conf_file = "splunk_start_defender_account"
-        confs = service.confs[str(conf_file)]
-        for stanza in confs:
-            # get all accounts
-            for name in stanza.name:
-                accounts.append(stanza.name)
-                break
+        except Exception as e:
+            splunk_start_defender_set_timing(timing, 'circ_ms', start)
+            return self.circ_failure_response(e, timing)
 
-        # get account
-        circ_url = None
+        finally:
+            logging.info(f"relay_circ_get_status, account=\"{account}\", computername=\"{computername}\", cache=\"{cache_status}\", {splunk_start_defender_format_timing(timing)}")
 
-        for stanza in confs:
-            if stanza.name == str(account):
-                for key, value in stanza.content.items():
-                    if key == "circ_url":
-                        circ_url = value
 
-        # end of get configuration
+    # Run the circ start scan action
+    def post_relay_circ_start_scan(self, request_info, **kwargs):
 
-        # Stop here if we cannot find the submitted account
-        if not account in accounts:
+        describe = False
+
+        # Retrieve from data
+        try:
+            resp_dict = json.loads(str(request_info.raw_args['payload']))
+        except Exception:
+            resp_dict = None
+
+        if resp_dict is not None:
+            try:
+                describe = resp_dict['describe']
+                if describe in ("true", "True"):
+                    describe = True
+            except Exception:
+                describe = False
+                account = resp_dict['account']
+                computername = resp_dict['computername']
+                fullscan = resp_dict['fullscan']
+                idempotency_key = resp_dict.get('idempotency_key')
+        else:
+            # body is not required in this endpoint, if not submitted do not describe the usage
+            describe = True
+
+        # if describe is requested, show the usage
+        if describe:
+
+            response = {
+                'describe': 'This endpoint runs the action circ get status, it requires a POST call with the following options:',
+                "resource_desc": "Run circ get status action",
+                'options': [{
+                    'account': 'The account',
+                    'computername': 'The computer name',
+                    'fullscan': 'Run fullscan (boolean)',
+                    'idempotency_key': 'OPTIONAL: A unique key for this request, retries with the same key do not start the scan again',
+                }]
+            }
             return {
-                "payload": {
+                "payload": response,
+                'status': 200
+            }
+
+        # get the account
+        timing = {}
+        start = time.perf_counter()
+        account_conf, error_response = self.get_account_conf(request_info, account)
+        splunk_start_defender_set_timing(timing, 'account_ms', start)
+        if error_response:
+            return error_response
+
+        circ_url = account_conf.get('circ_url')
+        circ_token = account_conf.get('circ_token')
+
+        # calls to circ are abandoned once the deadline of the caller is reached
+        deadline = self.get_request_deadline(request_info)
+
+        # proceed, the time spent on circ is returned to the caller in the timing header
+        try:
+            response = self.run_scan_once(account, idempotency_key,
+                lambda: self.call_circ(account_conf, lambda: circ_start_scan(circ_token, computername, circ_url, fullscan, timing, deadline), deadline))
+            return {
+                "payload": response,
+                'status': 200,
+                'headers': {
+                    circ_timing_header: str(timing.get('circ_ms')),
+                },
+            }
+
+        except Exception as e:
+            return self.circ_failure_response(e, timing)
+
+        finally:
+            logging.info(f"relay_circ_start_scan, account=\"{account}\", computername=\"{computername}\", {splunk_start_defender_format_timing(timing)}")
+
+
+    # Run a circ action for a batch of computer names, results are returned in the order of the submitted computer names
+    def run_relay_batch(self, func, computernames, max_concurrency, max_rate=None):
+
+        results = [None] * len(computernames)
+        circ_timings = [None] * len(computernames)
+
+        # each result carries the time spent on circ for its computer name
+        def timed_func(index):
+            start = time.perf_counter()
+            try:
+                return func(computernames[index])
+            finally:
+                circ_timings[index] = round((time.perf_counter() - start) * 1000, 2)
+
+        for index, response, exception in splunk_start_defender_run_concurrent(
+            timed_func, range(len(computernames)), max_concurrency, max_rate):
+
+            if exception is None:
+                results[index] = {
+                    'computername': computernames[index],
+                    'status': 'success',
+                    'response': response,
+                    'circ_ms': circ_timings[index],
+                }
+            else:
+                results[index] = {
+                    'computername': computernames[index],
                     'status': 'failure',
-                    'message': 'The account could be found on this system, check the spelling and your configuration',
-                    'account': account,
+                    'exception': str(exception),
+                    'circ_ms': circ_timings[index],
+                }
+
+        return results
+
+
+    # Run a scan request once per idempotency key, retried requests get the result of the first request
+    def run_scan_once(self, account, idempotency_key, func):
+
+        if not idempotency_key:
+            return func()
+
+        response, cache_status = scan_requests.get((account, str(idempotency_key)), func, scan_idempotency_ttl)
+
+        if cache_status in ('hit', 'coalesced'):
+            logging.info(f"duplicate scan request, account=\"{account}\", idempotency_key=\"{idempotency_key}\", returning the result of the first request")
+
+        return response
+
+
+    # get and verify the list of computer names submitted to a batch endpoint
+    def get_batch_computernames(self, computernames):
+
+        # accept a comma separated list as well as a JSON array
+        if not isinstance(computernames, list):
+            computernames = str(computernames).split(',')
+        computernames = [str(computername).strip() for computername in computernames if str(computername).strip()]
+
+        if len(computernames) == 0:
+            raise Exception('No computer names were submitted')
+        elif len(computernames) > relay_batch_max_size:
+            raise Exception('Too many computer names were submitted, the maximum batch size is {}'.format(relay_batch_max_size))
+
+        return computernames
+
+
+    # Run the circ get status action for a batch of computer names
+    def post_relay_circ_get_status_batch(self, request_info, **kwargs):
+
+        describe = False
+
+        # Retrieve from data
+        try:
+            resp_dict = json.loads(str(request_info.raw_args['payload']))
+        except Exception:
+            resp_dict = None
+
+        if resp_dict is not None:
+            try:
+                describe = resp_dict['describe']
+                if describe in ("true", "True"):
+                    describe = True
+            except Exception:
+                describe = False
+                account = resp_dict['account']
+                computernames = resp_dict['computernames']
+                max_concurrency = int(resp_dict.get('max_concurrency', relay_batch_max_concurrency))
+                nocache = str(resp_dict.get('nocache', False)) in ("true", "True", "1")
+        else:
+            # body is required
+            describe = True
+
+        # if describe is requested, show the usage
+        if describe:
+
+            response = {
+                'describe': 'This endpoint runs the action circ get status for a batch of computer names, it requires a POST call with the following options:',
+                "resource_desc": "Run circ get status action for a batch of computer names",
+                'options': [{
+                    'account': 'The name of the account',
+                    'computernames': 'The computer names, as a JSON array or a comma separated list (maximum {} per batch)'.format(relay_batch_max_size),
+                    'max_concurrency': 'OPTIONAL: The maximum number of concurrent requests to circ (maximum {})'.format(relay_batch_max_concurrency),
+                    'nocache': 'OPTIONAL: Bypass the status cache (boolean)',
+                }]
+            }
+            return {
+                "payload": response,
+                'status': 200
+            }
+
+        # verify the submitted computer names
+        try:
+            computernames = self.get_batch_computernames(computernames)
+        except Exception as e:
+            return {
+                "payload": {
+                    'action': 'failure',
+                    'exception': str(e),
                 },
                 'status': 500
             }
 
-        elif len(accounts) == 0:
+        # get the account
+        timing = {}
+        start = time.perf_counter()
+        account_conf, error_response = self.get_account_conf(request_info, account)
+        splunk_start_defender_set_timing(timing, 'account_ms', start)
+        if error_response:
+            return error_response
+
+        circ_url = account_conf.get('circ_url')
+        circ_token = account_conf.get('circ_token')
+
+        # calls to circ are abandoned once the deadline of the caller is reached
+        deadline = self.get_request_deadline(request_info)
+
+        # the batch is rejected as a whole if the relay is overloaded, rather than failing its computer names
+        try:
+            self.get_circ_admission(account_conf).check(account)
+        except RelayOverloadedError as e:
+            return self.circ_failure_response(e, timing)
+
+        def get_status(computername):
+            response, cache_status = status_cache.get(
+                (account, str(computername).lower()),
+                lambda: self.call_circ(account_conf, lambda: circ_get_status(circ_token, computername, circ_url, deadline=deadline), deadline),
+                account_conf.get('status_cache_ttl'), nocache)
+            return response
+
+        # proceed
+        start = time.perf_counter()
+        results = self.run_relay_batch(
+            get_status,
+            computernames, max(1, min(max_concurrency, relay_batch_max_concurrency)))
+
+        splunk_start_defender_set_timing(timing, 'circ_ms', start)
+
+        logging.info(f"relay_circ_get_status_batch, account=\"{account}\", processed {len(results)} computer names, {splunk_start_defender_format_timing(timing)}")
+
+        return {
+            "payload": {
+                'account': account,
+                'results': results,
+            },
+            'status': 200
+        }
+
+
+    # Run the circ start scan action for a batch of computer names
+    def post_relay_circ_start_scan_batch(self, request_info, **kwargs):
+
+        describe = False
+
+        # Retrieve from data
+        try:
+            resp_dict = json.loads(str(request_info.raw_args['payload']))
+        except Exception:
+            resp_dict = None
+
+        if resp_dict is not None:
+            try:
+                describe = resp_dict['describe']
+                if describe in ("true", "True"):
+                    describe = True
+            except Exception:
+                describe = False
+                account = resp_dict['account']
+                computernames = resp_dict['computernames']
+                fullscan = resp_dict['fullscan']
+                max_concurrency = int(resp_dict.get('max_concurrency', relay_batch_max_concurrency))
+                max_rate = resp_dict.get('max_rate')
+                idempotency_key = resp_dict.get('idempotency_key')
+        else:
+            # body is required
+            describe = True
+
+        # if describe is requested, show the usage
+        if describe:
+
+            response = {
+                'describe': 'This endpoint runs the action circ start scan for a batch of computer names, it requires a POST call with the following options:',
+                "resource_desc": "Run circ start scan action for a batch of computer names",
+                'options': [{
+                    'account': 'The account',
+                    'computernames': 'The computer names, as a JSON array or a comma separated list (maximum {} per batch)'.format(relay_batch_max_size),
+                    'fullscan': 'Run fullscan (boolean)',
+                    'max_concurrency': 'OPTIONAL: The maximum number of concurrent requests to circ (maximum {})'.format(relay_batch_max_concurrency),
+                    'max_rate': 'OPTIONAL: The maximum number of requests started per second',
+                    'idempotency_key': 'OPTIONAL: A unique key for this request, retries with the same key do not start the scans again',
+                }]
+            }
+            return {
+                "payload": response,
+                'status': 200
+            }
+
+        # verify the submitted computer names
+        try:
+            computernames = self.get_batch_computernames(computernames)
+        except Exception as e:
             return {
                 "payload": {
-                    'status': 'failure',
-                    'message': 'There are no account configured yet for this instance.',
-                    'account': account,
+                    'action': 'failure',
+                    'exception': str(e),
                 },
                 'status': 500
             }
 
+        # get the account
+        timing = {}
+        start = time.perf_counter()
+        account_conf, error_response = self.get_account_conf(request_info, account)
+        splunk_start_defender_set_timing(timing, 'account_ms', start)
+        if error_response:
+            return error_response
+
+        circ_url = account_conf.get('circ_url')
+        circ_token = account_conf.get('circ_token')
+
+        # calls to circ are abandoned once the deadline of the caller is reached
+        deadline = self.get_request_deadline(request_info)
+
+        # the batch is rejected as a whole if the relay is overloaded, rather than failing its computer names
+        try:
+            self.get_circ_admission(account_conf).check(account)
+        except RelayOverloadedError as e:
+            return self.circ_failure_response(e, timing)
+
+        # proceed
+        start = time.perf_counter()
+        results = self.run_scan_once(account, idempotency_key, lambda: self.run_relay_batch(
+            lambda computername: self.call_circ(account_conf, lambda: circ_start_scan(circ_token, computername, circ_url, fullscan, deadline=deadline), deadline),
+            computernames, max(1, min(max_concurrency, relay_batch_max_concurrency)), float(max_rate) if max_rate else None))
+
+        splunk_start_defender_set_timing(timing, 'circ_ms', start)
+
+        logging.info(f"relay_circ_start_scan_batch, account=\"{account}\", fullscan=\"{fullscan}\", processed {len(results)} computer names, {splunk_start_defender_format_timing(timing)}")
+
+        return {
+            "payload": {
+                'account': account,
+                'results': results,
+            },
+            'status': 200
+        }
+
+
+    # Run the circ start scan action, and track the scan as a job until it ends
+    def post_relay_circ_start_scan_job(self, request_info, **kwargs):
+
+        describe = False
+
+        # Retrieve from data
+        try:
+            resp_dict = json.loads(str(request_info.raw_args['payload']))
+        except Exception:
+            resp_dict = None
+
+        if resp_dict is not None:
+            try:
+                describe = resp_dict['describe']
+                if describe in ("true", "True"):
+                    describe = True
+            except Exception:
+                describe = False
+                account = resp_dict['account']
+                computername = resp_dict['computername']
+                fullscan = resp_dict['fullscan']
+                idempotency_key = resp_dict.get('idempotency_key')
         else:
+            # body is required
+            describe = True
 
-            # enforce https
-            if not circ_url.startswith("https://"):
-                circ_url = "https://" + str(circ_url)
+        # if describe is requested, show the usage
+        if describe:
 
-            # remote trailing slash in the URL, if any
-            if circ_url.endswith('/'):
-                circ_url = circ_url[:-1]
+            response = {
+                'describe': 'This endpoint runs the action circ start scan and returns a job identifier, the scan status is then tracked in the background until the scan ends, it requires a POST call with the following options:',
+                "resource_desc": "Run circ start scan action as a tracked job",
+                'options': [{
+                    'account': 'The account',
+                    'computername': 'The computer name',
+                    'fullscan': 'Run fullscan (boolean)',
+                    'idempotency_key': 'OPTIONAL: A unique key for this request, retries with the same key return the same job',
+                }]
+            }
+            return {
+                "payload": response,
+                'status': 200
+            }
 
-            # get circ_token
-            circ_token = None
+        # get the account
+        timing = {}
+        start = time.perf_counter()
+        account_conf, error_response = self.get_account_conf(request_info, account)
+        splunk_start_defender_set_timing(timing, 'account_ms', start)
+        if error_response:
+            return error_response
 
-            # realm
-            credential_realm = '__REST_CREDENTIAL__#splunk_start_defender#configs/conf-splunk_start_defender_account'
-            credential_name = str(credential_realm) + ":" + str(account) + "``"
+        circ_url = account_conf.get('circ_url')
+        circ_token = account_conf.get('circ_token')
 
-            # extract as raw json
-            bearer_token_rawvalue = ""
+        # calls to circ are abandoned once the deadline of the caller is reached
+        deadline = self.get_request_deadline(request_info)
 
-            for credential in storage_passwords:
-                if credential.content.get('realm') == str(credential_realm) and credential.name.startswith(credential_name):
-                    bearer_token_rawvalue = bearer_token_rawvalue + str(credential.content.clear_password)
+        # the job polls the status through the circuit breaker as well, with no deadline
+        def get_status(deadline=None):
+            return self.call_circ(account_conf, lambda: circ_get_status(circ_token, computername, circ_url, deadline=deadline), deadline)
 
-            # extract a clean json object
-            bearer_token_rawvalue_match = re.search('\{\"circ_token\":\s*\"(.*)\"\}', bearer_token_rawvalue)
-            if bearer_token_rawvalue_match:
-                circ_token = bearer_token_rawvalue_match.group(1)
-            else:
-                circ_token = None
+        def start_job():
+
+            # get the status before the scan, this allows detecting when the status reflects the new scan
+            try:
+                baseline_status = get_status(deadline)
+            except Exception:
+                baseline_status = None
+
+            response = self.call_circ(account_conf, lambda: circ_start_scan(circ_token, computername, circ_url, fullscan, deadline=deadline), deadline)
+
+            return scan_jobs.submit(account, computername, fullscan, response, get_status, baseline_status)['job_id']
+
+        # the baseline status and the scan request are both accounted in the circ time
+        start = time.perf_counter()
 
         # proceed
         try:
-            response = circ_start_scan(circ_token, computername, circ_url, fullscan)
+            job_id = self.run_scan_once(account, idempotency_key, start_job)
+
+        except Exception as e:
+            splunk_start_defender_set_timing(timing, 'circ_ms', start)
+            return self.circ_failure_response(e, timing)
+
+        splunk_start_defender_set_timing(timing, 'circ_ms', start)
+
+        job = scan_jobs.get_job(job_id)
+
+        logging.info(f"relay_circ_start_scan_job, account=\"{account}\", computername=\"{computername}\", job_id=\"{job['job_id']}\", {splunk_start_defender_format_timing(timing)}")
+
+        return {
+            "payload": job,
+            'status': 200,
+            'headers': {
+                circ_timing_header: str(timing['circ_ms']),
+            },
+        }
+
+
+    # Get a scan job
+    def post_relay_circ_get_job(self, request_info, **kwargs):
+
+        describe = False
+
+        # Retrieve from data
+        try:
+            resp_dict = json.loads(str(request_info.raw_args['payload']))
+        except Exception:
+            resp_dict = None
+
+        if resp_dict is not None:
+            try:
+                describe = resp_dict['describe']
+                if describe in ("true", "True"):
+                    describe = True
+            except Exception:
+                describe = False
+                job_id = resp_dict['job_id']
+        else:
+            # body is required
+            describe = True
+
+        # if describe is requested, show the usage
+        if describe:
+
+            response = {
+                'describe': 'This endpoint returns the state of a scan job, it requires a POST call with the following options:',
+                "resource_desc": "Get a scan job",
+                'options': [{
+                    'job_id': 'The job identifier',
+                }]
+            }
             return {
                 "payload": response,
                 'status': 200
             }
 
-        except Exception as e:
+        job = scan_jobs.get_job(str(job_id))
+
+        if job is None:
             return {
                 "payload": {
                     'action': 'failure',
-                    'exception': str(e),
+                    'message': 'The job could not be found, it may have expired, the relay may have been restarted, or the job may have been started by another process of the REST API handler, jobs are held in memory per process',
+                    'job_id': job_id,
                 },
-                'status': 500
+                'status': 404
+            }
+
+        return {
+            "payload": job,
+            'status': 200
+        }
+
+
+    # List scan jobs
+    def get_relay_circ_jobs(self, request_info, **kwargs):
+
+        describe = False
+        account = None
+        state = None
+
+        # Retrieve from data
+        try:
+            resp_dict = json.loads(str(request_info.raw_args['payload']))
+        except Exception:
+            resp_dict = None
+
+        if resp_dict is not None:
+            try:
+                describe = resp_dict['describe']
+                if describe in ("true", "True"):
+                    describe = True
+            except Exception:
+                describe = False
+                account = resp_dict.get('account')
+                state = resp_dict.get('state')
+        else:
+            # body is not required
+            describe = False
+
+        # filters can as well be submitted as query parameters
+        account = account or kwargs.get('account')
+        state = state or kwargs.get('state')
+
+        # if describe is requested, show the usage
+        if describe:
+
+            response = {
+                'describe': 'This endpoint lists the scan jobs, it requires a GET call with the following options:',
+                "resource_desc": "List scan jobs",
+                'options': [{
+                    'account': 'OPTIONAL: Only list the jobs of this account',
+                    'state': 'OPTIONAL: Only list the jobs in this state (submitted, running, completed, failed, timeout)',
+                }]
+            }
+            return {
+                "payload": response,
+                'status': 200
+            }
+
+        return {
+            "payload": scan_jobs.list_jobs(account, state),
+            'status': 200
+        }
+
+
+    # List the circuit breakers
+    def get_relay_circuit_breakers(self, request_info, **kwargs):
+
+        describe = False
+        account = None
+
+        # Retrieve from data
+        try:
+            resp_dict = json.loads(str(request_info.raw_args['payload']))
+        except Exception:
+            resp_dict = None
+
+        if resp_dict is not None:
+            try:
+                describe = resp_dict['describe']
+                if describe in ("true", "True"):
+                    describe = True
+            except Exception:
+                describe = False
+                account = resp_dict.get('account')
+        else:
+            # body is not required
+            describe = False
+
+        # filters can as well be submitted as query parameters
+        account = account or kwargs.get('account')
+
+        # if describe is requested, show the usage
+        if describe:
+
+            response = {
+                'describe': 'This endpoint lists the circuit breakers of the accounts used since the relay started, with their state (closed, open, half_open) and counters, it requires a GET call with the following options:',
+                "resource_desc": "List the circuit breakers",
+                'options': [{
+                    'account': 'OPTIONAL: Only list the circuit breaker of this account',
+                }]
+            }
+            return {
+                "payload": response,
+                'status': 200
             }
 
+        return {
+            "payload": [breaker for breaker in circuit_breakers.get_states() if not account or breaker['name'] == account],
+            'status': 200
+        }
+
+
+    # Get the state of the admission control
+    def get_relay_admission(self, request_info, **kwargs):
+
+        describe = False
+        account = None
+
+        # Retrieve from data
+        try:
+            resp_dict = json.loads(str(request_info.raw_args['payload']))
+        except Exception:
+            resp_dict = None
+
+        if resp_dict is not None:
+            try:
+                describe = resp_dict['describe']
+                if describe in ("true", "True"):
+                    describe = True
+            except Exception:
+                describe = False
+                account = resp_dict.get('account')
+        else:
+            # body is not required
+            describe = False
+
+        # filters can as well be submitted as query parameters
+        account = account or kwargs.get('account')
+
+        # if describe is requested, show the usage
+        if describe:
+
+            response = {
+                'describe': 'This endpoint returns the state of the admission control of the calls to circ since the relay started: the limits, the calls in progress and waiting for a worker, and the counters per account, it requires a GET call with the following options:',
+                "resource_desc": "Get the state of the admission control",
+                'options': [{
+                    'account': 'OPTIONAL: Only list the counters of this account',
+                }]
+            }
+            return {
+                "payload": response,
+                'status': 200
+            }
+
+        return {
+            "payload": circ_admission.get_state(account),
+            'status': 200
+        }
@@ -1,7 +1,5 @@
-import sys, requests, time, os
+import sys, time, os
 import logging
-from logging.handlers import RotatingFileHandler
-import json
 from os.path import join, dirname, basename
 ######################################################################
 # developed by Oliver Zimmermann
@@ -15,18 +13,10 @@ sys.path.append(join(APP_HOME, 'lib'))
 sys.path.append(join(APP_HOME, 'bin'))
 splunkhome = os.environ['SPLUNK_HOME']
 
-# set logging
-filehandler = RotatingFileHandler('%s/var/log/splunk/%s.log' % (splunkhome, APP_NAME), mode='a', maxBytes=10000000, backupCount=1)
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(filename)s %(funcName)s %(lineno)d %(message)s')
-logging.Formatter.converter = time.gmtime
-filehandler.setFormatter(formatter)
-log = logging.getLogger()  # root logger - Good to get it only once.
-for hdlr in log.handlers[:]:  # remove the existing file handlers
-    if isinstance(hdlr,logging.FileHandler):
-        log.removeHandler(hdlr)
-log.addHandler(filehandler)      # set the new handler
+# set logging, records are written to the log file by a background thread
+from lib_splunk_start_defender_logging import splunk_start_defender_setup_logging, JsonMessage
 # set the log level to INFO, DEBUG as the default is ERROR
-log.setLevel(logging.INFO)
+log = splunk_start_defender_setup_logging('%s/var/log/splunk/%s.log' % (splunkhome, APP_NAME), logging.INFO)
 
 try:
     from splunklib.searchcommands import dispatch, GeneratingCommand, Configuration, Option, validators
@@ -34,9 +24,12 @@ except Exception as e:
     logging.error(e)
 
 # import additional libs
-from lib_splunk_start_defender import splunk_start_defender_get_conf, splunk_start_defender_get_account, \
-    circ_get_status, circ_start_scan, \
-    circ_relay_get_status, circ_relay_start_scan
+from lib_splunk_start_defender import splunk_start_defender_get_command_context, \
+    circ_start_scan, circ_relay_start_scan, circ_relay_start_scan_batch, circ_relay_start_scan_job, \
+    splunk_start_defender_run_concurrent, splunk_start_defender_run_batches, \
+    splunk_start_defender_set_timing, splunk_start_defender_get_timing_fields, \
+    splunk_start_defender_apply_command_context
+from lib_splunk_start_defender_relays import RelayPool
 
 @Configuration()
 class StartDefender(GeneratingCommand):
@@ -50,7 +43,7 @@ class StartDefender(GeneratingCommand):
     computername = Option(
         doc='''
         **Syntax:** **computername=****
-        **Description:** computername to be used for the query.''',
+        **Description:** computername to be used for the query, multiple computer names can be submitted as a comma separated list.''',
         require=True, default=None, validate=validators.Match("computername", r"^.*$"))
 
     fullscan = Option(
@@ -59,110 +52,195 @@ class StartDefender(GeneratingCommand):
         **Description:** computername to be used for the query.''',
         require=False, default=False, validate=validators.Boolean())
 
+    max_concurrency = Option(
+        doc='''
+        **Syntax:** **max_concurrency=****
+        **Description:** maximum number of concurrent scan requests in flight when multiple computer names are submitted, defaults to 10 (up to 100 with engine=threads).''',
+        require=False, default=10, validate=validators.Integer(minimum=1, maximum=1000))
+
+    engine = Option(
+        doc='''
+        **Syntax:** **engine=****
+        **Description:** when running on the relay, run the requests to circ on a pool of threads (threads, up to 100 requests in flight) or on an asyncio event loop (asyncio, for high fan-out sweeps with hundreds of requests in flight), defaults to threads.''',
+        require=False, default="threads", validate=validators.Set("threads", "asyncio"))
+
+    max_rate = Option(
+        doc='''
+        **Syntax:** **max_rate=****
+        **Description:** maximum number of scan requests started per second when multiple computer names are submitted, unlimited by default.''',
+        require=False, default=None, validate=validators.Float(minimum=0.1))
+
+    track = Option(
+        doc='''
+        **Syntax:** **track=****
+        **Description:** track the scans as jobs on the relay until they end, the job identifiers are returned and can be used with the defenderjobs command, engine does not apply to tracked scans (boolean).''',
+        require=False, default=False, validate=validators.Boolean())
+
     def generate(self):
 
-        # get instance_role
-        try:
-            start_defender_conf = splunk_start_defender_get_conf(self._metadata.searchinfo.session_key, self._metadata.searchinfo.splunkd_uri)
-            instance_role = start_defender_conf['role']['instance_role']
+        # get the list of computer names, duplicates are removed while preserving the order
+        computernames = []
+        for computername in self.computername.split(','):
+            computername = computername.strip()
+            if computername and computername not in computernames:
+                computernames.append(computername)
 
-        except Exception as e:
-            raise Exception(str(e))
+        # time spent per phase in milliseconds, for the search and for each computer name
+        timing = {}
+        timings = {}
 
-        # get account
+        # get instance_role, loglevel and account in a single call
+        search_start = time.monotonic()
+        start = time.perf_counter()
         try:
-            # get account
-            account_conf = splunk_start_defender_get_account(self._metadata.searchinfo.session_key, self._metadata.searchinfo.splunkd_uri, self.account)
+            command_context = splunk_start_defender_get_command_context(self._metadata.searchinfo.session_key, self._metadata.searchinfo.splunkd_uri, self.account)
+            instance_role = command_context['instance_role']
+            account_conf = command_context['account']
 
         except Exception as e:
             raise Exception(str(e))
 
+        splunk_start_defender_set_timing(timing, 'context_ms', start)
+
+        # set the log level, the timeouts and the proxy, requests are not sent nor retried once the deadline of the
+        # search is reached, the asyncio engine falls back to threads if it does not support the proxy
+        deadline, engine = splunk_start_defender_apply_command_context(command_context, search_start, self.engine)
+
         # Process
         try:
 
-            # act depending on the context
-            if instance_role in ('splunk_cloud'):
+            relays = None
+
+            # act depending on the context: scans tracked as jobs are started through the relay job endpoint, which
+            # is the local splunkd when running on the relay itself, other scans are started through the relay when
+            # running on Splunk Cloud, or directly against circ when running on the relay
+            if self.track:
+
+                # the job endpoint of the relay starts the scans itself, the engine only applies to untracked scans
+                if engine == 'asyncio':
+                    logging.warning("start_defender, engine=asyncio is not supported with track=true, the scans are started with engine=threads")
+
+                if instance_role in ('splunk_cloud'):
+                    relay_url = account_conf.get('relay_url')
+                    job_token = account_conf.get('relay_token')
+                    job_auth_scheme = "Bearer"
+
+                    # the job is held by the relay which started it, scans only fail over to the next relay if the
+                    # request was certainly not sent, so that a scan is never started twice
+                    relays = RelayPool(relay_url)
+
+                    def call_job(func):
+                        return relays.call(func, idempotent=False)
+
+                    target = 'relay=\"{}\"'.format(relay_url)
+
+                else:
+                    job_url = self._metadata.searchinfo.splunkd_uri
+                    if not job_url.startswith("https://"):
+                        job_url = f"https://{job_url}"
+                    job_token = self._metadata.searchinfo.session_key
+                    job_auth_scheme = "Splunk"
+
+                    def call_job(func):
+                        return func(job_url)
+
+                    target = 'relay=\"{}\"'.format(job_url)
+
+                def run_requests(computernames):
+                    return splunk_start_defender_run_concurrent(
+                        lambda computername: call_job(lambda job_url: circ_relay_start_scan_job(self.account, job_token, computername, job_url, self.fullscan, job_auth_scheme, timings.setdefault(computername, {}), deadline)),
+                        computernames, self.max_concurrency, self.max_rate)
+
+            elif instance_role in ('splunk_cloud'):
 
                 relay_url = account_conf.get('relay_url')
                 relay_token = account_conf.get('relay_token')
 
-                # run call
-                yield_record = {
-                    '_time': time.time(),
-                    '_raw': {
-                        'action': 'requested',
-                        'requester': self._metadata.searchinfo.username,
-                        'computername': self.computername,
-                        'fullscan': self.fullscan,
-                        'account': self.account,
-                        'response': 'sending start_defender request to relay=\"{}\"'.format(relay_url),
-                    },
-                }
-                logging.info(json.dumps(yield_record, indent=2))
-                yield yield_record
+                # the account may list several relays, scans only fail over to the next relay if the request was
+                # certainly not sent, so that a scan is never started twice
+                relays = RelayPool(relay_url)
 
-                # run call
-                try:
-                    response = circ_relay_start_scan(self.account, relay_token, self.computername, relay_url, self.fullscan)
-                    yield_record = {
-                    '_time': time.time(),
-                    '_raw': response,
-                    }
-                    logging.info(json.dumps(yield_record, indent=2))
-                    yield yield_record
+                # a single computer name is sent as is, multiple computer names are sent to the relays in batches
+                def run_requests(computernames):
+                    if len(computernames) == 1:
+                        return splunk_start_defender_run_concurrent(
+                            lambda computername: relays.call(lambda relay_url: circ_relay_start_scan(self.account, relay_token, computername, relay_url, self.fullscan, timings.setdefault(computername, {}), deadline), idempotent=False),
+                            computernames)
+                    else:
+                        return splunk_start_defender_run_batches(
+                            lambda batch: relays.call(lambda relay_url: circ_relay_start_scan_batch(self.account, relay_token, batch, relay_url, self.fullscan, self.max_concurrency, self.max_rate, timings, deadline), idempotent=False),
+                            computernames, max_batches_in_flight=relays.get_batches_in_flight())
 
-                except Exception as e:
-                    yield_record = {
-                    '_time': time.time(),
-                    '_raw': {
-                        'action': 'failure',
-                        'exception': str(e),
-                        },
-                    }
-                    logging.error(json.dumps(yield_record, indent=2))
-                    yield yield_record
+                target = 'relay=\"{}\"'.format(relay_url)
 
             else:
 
                 circ_url = account_conf.get('circ_url')
                 circ_token = account_conf.get('circ_token')
-            
-                # run call
-                yield_record = {
-                    '_time': time.time(),
-                    '_raw': {
-                        'action': 'requested',
-                        'requester': self._metadata.searchinfo.username,
-                        'computername': self.computername,
-                        'fullscan': self.fullscan,
-                        'account': self.account,
-                        'response': 'sending start_defender request to circ=\"{}\"'.format(circ_url),
-                    },
-                }
-                logging.info(json.dumps(yield_record, indent=2))
-                yield yield_record
 
-                # run call
-                try:
-                    response = circ_start_scan(circ_token, self.computername, circ_url, self.fullscan)
+                def run_requests(computernames):
+                    if engine == 'asyncio':
+                        # the asyncio client (httpx) is only imported when used, to keep the startup of the command short
+                        from lib_splunk_start_defender_async import circ_start_scan_async, splunk_start_defender_run_async
+                        return splunk_start_defender_run_async(
+                            lambda client, computername: circ_start_scan_async(client, circ_token, computername, circ_url, self.fullscan, timings.setdefault(computername, {}), deadline),
+                            computernames, self.max_concurrency, self.max_rate)
+                    return splunk_start_defender_run_concurrent(
+                        lambda computername: circ_start_scan(circ_token, computername, circ_url, self.fullscan, timings.setdefault(computername, {}), deadline),
+                        computernames, self.max_concurrency, self.max_rate)
+
+                target = 'circ=\"{}\"'.format(circ_url)
+
+            # run call
+            yield_record = {
+                '_time': time.time(),
+                '_raw': {
+                    'action': 'requested',
+                    'requester': self._metadata.searchinfo.username,
+                    'computername': ','.join(computernames),
+                    'account': self.account,
+                    'fullscan': self.fullscan,
+                    'track': self.track,
+                    'response': 'sending start_defender request to {}'.format(target),
+                },
+            }
+            yield_record.update(splunk_start_defender_get_timing_fields(timing))
+            logging.info(JsonMessage(yield_record))
+            yield yield_record
+
+            # run calls, with a single computer name this is a single request, otherwise requests are dispatched
+            # through the pool and results yielded as soon as they complete
+            for computername, response, exception in run_requests(computernames):
+
+                if exception is None:
                     yield_record = {
                     '_time': time.time(),
                     '_raw': response,
+                    'computername': computername,
                     }
-                    logging.info(json.dumps(yield_record, indent=2))
+                    if self.track:
+                        yield_record['job_id'] = response.get('job_id')
+                    yield_record.update(splunk_start_defender_get_timing_fields(timing, timings.pop(computername, None)))
+                    logging.info(JsonMessage(yield_record))
                     yield yield_record
 
-                except Exception as e:
+                else:
                     yield_record = {
                     '_time': time.time(),
                     '_raw': {
                         'action': 'failure',
-                        'exception': str(e),
+                        'computername': computername,
+                        'exception': str(exception),
                         },
+                    'computername': computername,
                     }
-                    logging.error(json.dumps(yield_record, indent=2))
+                    yield_record.update(splunk_start_defender_get_timing_fields(timing, timings.pop(computername, None)))
+                    logging.error(JsonMessage(yield_record))
                     yield yield_record
 
+            if relays is not None:
+                logging.info("start_defender, relays=%s", JsonMessage(relays.get_metrics()))
+
         except Exception as e:
 
             msg = "start_defender, an exception was encountered, exception=\"{}\"".format(str(e))
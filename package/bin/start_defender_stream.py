@@ -0,0 +1,66 @@
+import sys, os
+import logging
+from os.path import join, dirname, basename
+######################################################################
+# developed by Oliver Zimmermann
+#
+######################################################################
+
+URL_CONF = 'defender'
+APP_NAME = basename(dirname(dirname(__file__)))
+APP_HOME = dirname(dirname(__file__))
+sys.path.append(join(APP_HOME, 'lib'))
+sys.path.append(join(APP_HOME, 'bin'))
+splunkhome = os.environ['SPLUNK_HOME']
+
+# set logging, records are written to the log file by a background thread
+from lib_splunk_start_defender_logging import splunk_start_defender_setup_logging
+# set the log level to INFO, DEBUG as the default is ERROR
+log = splunk_start_defender_setup_logging('%s/var/log/splunk/%s.log' % (splunkhome, APP_NAME), logging.INFO)
+
+try:
+    from splunklib.searchcommands import dispatch, Configuration, Option, validators
+except Exception as e:
+    logging.error(e)
+
+# import additional libs
+from lib_splunk_start_defender import circ_start_scan, circ_relay_start_scan_batch
+from lib_splunk_start_defender_stream import DefenderStreamingCommand
+
+@Configuration(distributed=False)
+class StartDefenderStream(DefenderStreamingCommand):
+
+    command_name = 'start_defender_stream'
+
+    # batches of scans only fail over to the next relay if the request was certainly not sent, so that a scan is never
+    # started twice
+    relay_idempotent = False
+
+    fullscan = Option(
+        doc='''
+        **Syntax:** **fullscan=****
+        **Description:** run a full scan rather than a quick scan (boolean).''',
+        require=False, default=False, validate=validators.Boolean())
+
+    max_rate = Option(
+        doc='''
+        **Syntax:** **max_rate=****
+        **Description:** maximum number of scan requests started per second, unlimited by default.''',
+        require=False, default=None, validate=validators.Float(minimum=0.1))
+
+    def call_relay_batch(self, relay_token, computernames, relay_url, timings):
+        return circ_relay_start_scan_batch(self.account, relay_token, computernames, relay_url, self.fullscan, self.max_concurrency, self.max_rate, timings, self.deadline)
+
+    def call_circ(self, circ_token, computername, circ_url, timing):
+        return circ_start_scan(circ_token, computername, circ_url, self.fullscan, timing, self.deadline)
+
+    async def call_circ_async(self, client, circ_token, computername, circ_url, timing):
+        # the asyncio client (httpx) is only imported when used, to keep the startup of the command short
+        from lib_splunk_start_defender_async import circ_start_scan_async
+        return await circ_start_scan_async(client, circ_token, computername, circ_url, self.fullscan, timing, self.deadline)
+
+    def get_summary(self, count, target):
+        return 'start_defender_stream, requester=\"{}\", account=\"{}\", fullscan=\"{}\", processed {} start_defender requests against {}'.format(
+            self._metadata.searchinfo.username, self.account, self.fullscan, count, target)
+
+dispatch(StartDefenderStream, sys.argv, sys.stdin, sys.stdout, __name__)
@@ -7,18 +7,17 @@ __author__ = "Guilhem Marchand for Mercedes"
 
 import os
 import sys
-import splunk
-import splunk.entity
-import requests
-from requests.structures import CaseInsensitiveDict
-import re
 import json
 import random
 import time
 import datetime
+import email.utils
 import logging
-import uuid
-from urllib.parse import urlencode
+import itertools
+import threading
+import atexit
+import collections
+import concurrent.futures
 import urllib.parse
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -27,13 +26,10 @@ splunkhome = os.environ['SPLUNK_HOME']
 
 sys.path.append(os.path.join(splunkhome, 'etc', 'apps', 'splunk_start_defender', 'lib'))
 
-import splunklib.client as client
-import splunklib.results as results
-
-# import ucclibs
-from splunktaucclib.alert_actions_base import ModularAlertBase
-from splunklib.modularinput.event import Event, ET
-from splunklib.modularinput.event_writer import EventWriter
+# imports:
+# the custom commands start a Python process per search and import this lib first, only the modules the HTTP client
+# needs are imported here, the callers which need splunklib, splunktaucclib or the Splunk modules import them
+# themselves. Random identifiers are taken from os.urandom rather than uuid, whose import costs more than the calls.
 
 # logging:
 # To avoid overriding logging destination of callers, the libs will not set on purpose any logging definition
@@ -41,6 +37,479 @@ from splunklib.modularinput.event_writer import EventWriter
 
 import requests
 from requests.structures import CaseInsensitiveDict
+from requests.adapters import HTTPAdapter
+
+from lib_splunk_start_defender_logging import splunk_start_defender_set_loglevel
+
+# http sessions:
+# sessions are created once per process for a given base URL and credential, and re-used by every call so that
+# connections are kept alive across calls and threads, rather than paying a new TCP and TLS handshake for each call.
+# The pool size must be at least the maximum number of concurrent requests the commands and endpoints can run.
+http_session_pool_maxsize = 100
+http_session_max_sessions = 32
+http_sessions = collections.OrderedDict()
+http_sessions_lock = threading.Lock()
+
+# proxy:
+# calls to circ and to the relay are routed through the proxy of the [proxy] settings when it is enabled, the proxy is
+# set once per process with splunk_start_defender_set_proxy() and applied to the pooled sessions of these targets,
+# calls to the local splunkd never use it. socks4 and socks5 proxies require PySocks, with proxy_rdns the host names
+# of the targets are resolved by the proxy (socks4a, socks5h).
+http_proxies = None
+proxy_schemes = {
+    'http': ('http', 'http'),
+    'socks4': ('socks4', 'socks4a'),
+    'socks5': ('socks5', 'socks5h'),
+}
+
+# proxy schemes supported by the asyncio client (httpx), which does not support socks4 proxies: with a socks4 proxy,
+# engine=asyncio falls back to the threads engine, see splunk_start_defender_get_engine()
+async_proxy_schemes = ('http', 'socks5', 'socks5h')
+
+
+# get the proxies of requests for the proxy settings
+def splunk_start_defender_get_proxies(proxy_conf):
+    """
+    Return the proxies dictionary for the proxy settings (the [proxy] stanza, with the clear proxy_password),
+    or None if the proxy is not enabled.
+    """
+
+    if not proxy_conf or str(proxy_conf.get('proxy_enabled')).lower() not in ('1', 'true'):
+        return None
+
+    proxy_type = proxy_conf.get('proxy_type') or 'http'
+    if proxy_type not in proxy_schemes:
+        raise Exception(f"Unsupported proxy_type=\"{proxy_type}\", valid options are: {', '.join(proxy_schemes)}")
+
+    proxy_rdns = str(proxy_conf.get('proxy_rdns')).lower() in ('1', 'true')
+    proxy_scheme = proxy_schemes[proxy_type][1 if proxy_rdns else 0]
+
+    # the host may have been entered as a URL
+    proxy_host = str(proxy_conf.get('proxy_url')).split('://')[-1].rstrip('/')
+
+    proxy_credentials = ''
+    if proxy_conf.get('proxy_username'):
+        proxy_credentials = urllib.parse.quote(proxy_conf.get('proxy_username'), safe='')
+        if proxy_conf.get('proxy_password'):
+            proxy_credentials += ':' + urllib.parse.quote(proxy_conf.get('proxy_password'), safe='')
+        proxy_credentials += '@'
+
+    proxy = f"{proxy_scheme}://{proxy_credentials}{proxy_host}:{proxy_conf.get('proxy_port')}"
+
+    return {
+        'http': proxy,
+        'https': proxy,
+    }
+
+
+# set the proxy of the process
+def splunk_start_defender_set_proxy(proxy_conf):
+    """
+    Set the proxy used by the calls to circ and to the relay, from the proxy settings. If the proxy was changed,
+    the pooled sessions using the previous proxy are closed.
+    """
+
+    global http_proxies
+
+    proxies = splunk_start_defender_get_proxies(proxy_conf)
+
+    with http_sessions_lock:
+        if proxies == http_proxies:
+            return
+
+        http_proxies = proxies
+
+        for session_key in [session_key for session_key in http_sessions if session_key[3] is not None]:
+            http_sessions.pop(session_key).close()
+
+    if proxies:
+        logging.info(f"proxy enabled, proxy_type=\"{proxy_conf.get('proxy_type')}\", proxy_url=\"{proxy_conf.get('proxy_url')}\", proxy_port=\"{proxy_conf.get('proxy_port')}\"")
+    else:
+        logging.info("proxy disabled")
+
+
+# get the engine of the requests to circ, the asyncio engine is only used if it supports the proxy
+def splunk_start_defender_get_engine(engine):
+    """
+    Return engine, or threads if engine is asyncio and the proxy set with splunk_start_defender_set_proxy() is not
+    supported by the asyncio client (socks4).
+    """
+
+    if engine == 'asyncio' and http_proxies:
+        proxy_scheme = urllib.parse.urlsplit(http_proxies['https']).scheme
+        if proxy_scheme not in async_proxy_schemes:
+            logging.warning(f"engine=asyncio does not support the proxy scheme=\"{proxy_scheme}\", the requests run with engine=threads")
+            return 'threads'
+
+    return engine
+
+
+# get a pooled keep-alive session for a target URL and headers
+def splunk_start_defender_get_session(target_url, headers, use_proxy=False):
+    """
+    Return the shared session for the base URL of target_url and the Authorization header, creating it if needed.
+    If use_proxy is True, the session goes through the proxy set with splunk_start_defender_set_proxy(), if any.
+    The least recently used session is closed when more than http_session_max_sessions are open.
+    """
+
+    target = urllib.parse.urlsplit(target_url)
+
+    with http_sessions_lock:
+        proxies = http_proxies if use_proxy else None
+        session_key = (target.scheme, target.netloc, headers.get("Authorization"), proxies['https'] if proxies else None)
+
+        session = http_sessions.get(session_key)
+
+        if session is not None:
+            http_sessions.move_to_end(session_key)
+
+        else:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=http_session_pool_maxsize)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update(headers)
+            if proxies:
+                # the proxy of the settings takes precedence over the proxy environment variables
+                session.trust_env = False
+                session.proxies.update(proxies)
+            http_sessions[session_key] = session
+
+            if len(http_sessions) > http_session_max_sessions:
+                oldest_session_key, oldest_session = http_sessions.popitem(last=False)
+                oldest_session.close()
+
+    return session
+
+
+# close all sessions, called automatically when the process exits
+def splunk_start_defender_close_sessions():
+    """
+    Close all pooled sessions and their connections.
+    """
+
+    with http_sessions_lock:
+        while http_sessions:
+            session_key, session = http_sessions.popitem()
+            session.close()
+
+atexit.register(splunk_start_defender_close_sessions)
+
+
+# timeouts:
+# every call is made with a connect and a read timeout (Timeouts configuration tab), so that a hung splunkd, relay or
+# circ cannot block a process indefinitely. A call can as well be given a deadline, a time.monotonic() value after
+# which the call is neither started nor retried, its timeouts are then capped to the time left. Calls to the relay
+# forward the time left in milliseconds in the deadline_header request header, so that the relay abandons the work
+# the caller will no longer wait for.
+connect_timeout = 10
+read_timeout = 60
+deadline_header = 'X-Splunk-Start-Defender-Deadline-Ms'
+
+
+# raised when a call is not started, or abandoned, because its deadline was reached
+class DeadlineExceeded(Exception):
+    pass
+
+
+# set the timeouts of the process, from the settings
+def splunk_start_defender_set_timeouts(connect=None, read=None):
+    global connect_timeout, read_timeout
+    if connect:
+        connect_timeout = float(connect)
+    if read:
+        read_timeout = float(read)
+
+
+# get the deadline of a search which started at start (time.monotonic()) and may run for search_timeout seconds
+def splunk_start_defender_get_deadline(search_timeout, start=None):
+    """
+    Return the deadline as a time.monotonic() value, or None if search_timeout is 0 (no deadline).
+    """
+
+    if not search_timeout or float(search_timeout) <= 0:
+        return None
+    return (start if start is not None else time.monotonic()) + float(search_timeout)
+
+
+# get the (connect, read) timeout of a call, capped to the time left before the deadline
+def splunk_start_defender_get_timeout(deadline=None):
+    """
+    Return the timeout tuple for requests, DeadlineExceeded is raised if the deadline was reached.
+    """
+
+    if deadline is None:
+        return (connect_timeout, read_timeout)
+
+    time_left = deadline - time.monotonic()
+    if time_left <= 0:
+        raise DeadlineExceeded("The deadline of the search was reached, the request was not sent")
+
+    return (min(connect_timeout, time_left), min(read_timeout, time_left))
+
+
+# get the deadline forwarded by the caller in the deadline_header, as a time.monotonic() value, or None
+def splunk_start_defender_get_forwarded_deadline(headers):
+    for name, value in headers:
+        if str(name).lower() == deadline_header.lower():
+            try:
+                return time.monotonic() + float(value) / 1000
+            except ValueError:
+                logging.error(f"Invalid value for the header {deadline_header}=\"{value}\", ignoring the deadline")
+    return None
+
+
+# retries:
+# transient failures of circ or the relay are retried with an exponential backoff and full jitter, honouring the
+# Retry-After header when returned. Get status calls are safe to retry. Scan calls are only retried when the request
+# was certainly not processed (429, or the connection could not be established), unless the target de-duplicates
+# them: scan calls to the relay carry an idempotency key, retries of the same call are then not started twice.
+# Retries are limited by a per-process budget: each call earns retry_budget_ratio retry, so that a circ brownout
+# under bulk load does not amplify into a retry storm.
+retry_statuses = (429, 502, 503, 504)
+retry_max_attempts = 3
+retry_backoff_base = 0.5
+retry_backoff_max = 8
+retry_after_max = 30
+retry_budget_ratio = 0.2
+retry_budget_min_tokens = 10
+retry_budget_max_tokens = 100
+
+
+# Retry budget shared by all the calls of the process
+class RetryBudget(object):
+    """
+    Thread safe token bucket: every call deposits ratio token, every retry withdraws a token.
+    The bucket starts with min_tokens and holds at most max_tokens.
+    """
+
+    def __init__(self, ratio, min_tokens, max_tokens):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = min_tokens
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+retry_budget = RetryBudget(retry_budget_ratio, retry_budget_min_tokens, retry_budget_max_tokens)
+
+
+# get the delay requested by a Retry-After header, in seconds, or None
+def splunk_start_defender_get_retry_after(response):
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
+
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, (email.utils.parsedate_to_datetime(retry_after) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except Exception:
+        return None
+
+
+# check if a failed request was certainly not sent to the target
+def splunk_start_defender_request_not_sent(exception):
+    if isinstance(exception, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exception, requests.exceptions.ConnectionError) and exception.args:
+        reason = getattr(exception.args[0], 'reason', None)
+        return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+    return False
+
+
+# a non successful HTTP response of circ, the status code tells apart circ being unavailable from a rejected request
+class CircHTTPError(Exception):
+
+    def __init__(self, message, status_code):
+        super(CircHTTPError, self).__init__(message)
+        self.status_code = status_code
+
+
+# check if a failed call to circ shows circ as unavailable (connection failure, timeout, HTTP 429 or 5xx), rather than
+# a rejected request or the deadline of the caller, the client functions wrap the original exception which is found in
+# the exception context
+def splunk_start_defender_is_circ_failure(exception):
+    while exception is not None:
+        if isinstance(exception, DeadlineExceeded):
+            return False
+        if isinstance(exception, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+        if isinstance(exception, CircHTTPError):
+            return exception.status_code == 429 or exception.status_code >= 500
+        exception = exception.__cause__ or exception.__context__
+    return False
+
+
+# get a new idempotency key, carried by the scan calls so that their retries are not started twice, see retries
+def splunk_start_defender_get_idempotency_key():
+    return os.urandom(16).hex()
+
+
+# run a request with retries
+def splunk_start_defender_request(session, method, url, idempotent=True, deadline=None, forward_deadline=False, **kwargs):
+    """
+    Run session.request(method, url, **kwargs), retrying transient failures, and return the last response.
+    If idempotent is False, the request is only retried when it was certainly not processed by the target.
+    No attempt is started after the deadline, if forward_deadline is True the time left is sent in the deadline_header.
+    The exception of the last attempt is raised if no response could be obtained.
+    """
+
+    retry_budget.deposit()
+
+    for attempt in range(1, retry_max_attempts + 1):
+
+        response = None
+        retry_after = None
+
+        # the timeouts, and the time left forwarded to the relay, are capped to the deadline at each attempt
+        kwargs['timeout'] = splunk_start_defender_get_timeout(deadline)
+        if deadline is not None and forward_deadline:
+            kwargs['headers'] = dict(kwargs.get('headers') or {})
+            kwargs['headers'][deadline_header] = str(int(max(0, deadline - time.monotonic()) * 1000))
+
+        try:
+            response = session.request(method, url, **kwargs)
+            if response.status_code not in retry_statuses or (not idempotent and response.status_code != 429):
+                return response
+            reason = f"HTTP status code: {response.status_code}"
+            retry_after = splunk_start_defender_get_retry_after(response)
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if deadline is not None and isinstance(e, requests.exceptions.Timeout) and time.monotonic() >= deadline:
+                raise DeadlineExceeded(f"The deadline of the search was reached while waiting for the response, url=\"{url}\"") from e
+            if isinstance(e, requests.exceptions.SSLError) or not (idempotent or splunk_start_defender_request_not_sent(e)):
+                raise
+            if attempt == retry_max_attempts:
+                raise
+            reason = f"exception=\"{str(e)}\""
+            exception = e
+
+        if attempt == retry_max_attempts:
+            return response
+
+        # the delay requested by the target is honoured, if it is longer than we accept the call fails now
+        if retry_after is not None and retry_after > retry_after_max:
+            logging.error(f"Not retrying request, url=\"{url}\", {reason}, the requested Retry-After={retry_after} exceeds {retry_after_max} seconds")
+            return response
+
+        if not retry_budget.withdraw():
+            logging.error(f"Not retrying request, url=\"{url}\", {reason}, the retry budget of this process is exhausted")
+            if response is None:
+                raise Exception(f"Request failed and the retry budget is exhausted, url=\"{url}\", {reason}") from exception
+            return response
+
+        if retry_after is None:
+            retry_after = random.uniform(0, min(retry_backoff_max, retry_backoff_base * 2 ** attempt))
+
+        # there is no point retrying if the deadline would be reached before the next attempt
+        if deadline is not None and time.monotonic() + retry_after >= deadline:
+            logging.error(f"Not retrying request, url=\"{url}\", {reason}, the deadline of the search would be reached before the next attempt")
+            if response is None:
+                raise DeadlineExceeded(f"Request failed and the deadline of the search would be reached before the next attempt, url=\"{url}\", {reason}") from exception
+            return response
+
+        logging.warning(f"Retrying request, url=\"{url}\", {reason}, attempt={attempt}, delay={round(retry_after, 3)}")
+
+        if response is not None:
+            response.close()
+
+        time.sleep(retry_after)
+
+
+# configuration generation:
+# persistent processes cache the configuration and accounts, a marker file is rewritten with a new random generation
+# whenever the configuration is changed through the configuration UI, so that these processes can detect the change
+# with a local file read rather than calls to splunkd
+config_generation_file = os.path.join(splunkhome, 'var', 'run', 'splunk', 'splunk_start_defender_config_generation')
+
+
+# get the current configuration generation
+def splunk_start_defender_get_config_generation():
+    """
+    Return the current configuration generation, or None if the marker does not exist yet.
+    """
+
+    try:
+        with open(config_generation_file, 'r') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+# bump the configuration generation
+def splunk_start_defender_touch_config_generation():
+    """
+    Write a new configuration generation to the marker, to invalidate the caches of persistent processes.
+    """
+
+    try:
+        tmp_file = f"{config_generation_file}.{os.urandom(16).hex()}"
+        with open(tmp_file, 'w') as f:
+            f.write(os.urandom(16).hex())
+        os.replace(tmp_file, config_generation_file)
+    except Exception as e:
+        logging.error(f"Failed to update the configuration generation marker, file=\"{config_generation_file}\", exception=\"{str(e)}\"")
+
+
+# timing:
+# client functions accept an optional timing dictionary, filled with the time spent per phase in milliseconds:
+# circ_ms for calls to circ, relay_ms for calls to the relay, in which case circ_ms is the time the relay spent
+# calling circ, as returned in the circ_timing_header response header
+circ_timing_header = 'X-Splunk-Start-Defender-Circ-Ms'
+
+
+# store the time elapsed since start, in milliseconds
+def splunk_start_defender_set_timing(timing, name, start):
+    if timing is not None:
+        timing[name] = round((time.perf_counter() - start) * 1000, 2)
+
+
+# store the time of a relay call, and the circ time reported by the relay
+def splunk_start_defender_set_relay_timing(timing, start, response):
+    if timing is not None:
+        splunk_start_defender_set_timing(timing, 'relay_ms', start)
+        try:
+            timing['circ_ms'] = float(response.headers[circ_timing_header])
+        except Exception:
+            pass
+
+
+# store the timing of each computer name of a relay batch response, the relay returns the circ time of each result
+def splunk_start_defender_set_relay_batch_timings(timings, start, batch_response):
+    if timings is not None:
+        relay_timing = {}
+        splunk_start_defender_set_timing(relay_timing, 'relay_ms', start)
+        for result in batch_response.get('results', []):
+            timings[result.get('computername')] = dict(relay_timing, circ_ms=result.get('circ_ms'))
+
+
+# get the timing fields of a result, as timing.<phase>_ms
+def splunk_start_defender_get_timing_fields(*timings):
+    timing_fields = {}
+    for timing in timings:
+        for name, value in (timing or {}).items():
+            if value is not None:
+                timing_fields[f"timing.{name}"] = value
+    return timing_fields
+
+
+# format the timing fields for the logs, as timing.<phase>_ms=<value> pairs
+def splunk_start_defender_format_timing(*timings):
+    return ', '.join(f"{name}={value}" for name, value in splunk_start_defender_get_timing_fields(*timings).items())
 
 
 # get system wide conf with least privilege approach
@@ -58,15 +527,14 @@ def splunk_start_defender_get_conf(session_key, splunkd_uri):
     headers["Authorization"] = f"Splunk {session_key}"
     target_url = f"{splunkd_uri}/services/splunk_start_defender/manager/splunk_start_defender_conf"
 
-    # Create a requests session for better performance
-    session = requests.Session()
-    session.headers.update(headers)
+    # Get a pooled keep-alive session, re-used across calls
+    session = splunk_start_defender_get_session(target_url, headers)
 
     try:
         # Use a context manager to handle the request
-        with session.get(target_url, verify=False) as response:
+        with session.get(target_url, timeout=splunk_start_defender_get_timeout(), verify=False) as response:
             if response.ok:
-                logging.debug(f"Success retrieving conf, data=\"{response}\"")
+                logging.debug("Success retrieving conf, data=\"%s\"", response)
                 response_json = response.json()
                 return response_json
             else:
@@ -95,15 +563,14 @@ def splunk_start_defender_get_account(session_key, splunkd_uri, account):
     headers["Authorization"] = f"Splunk {session_key}"
     target_url = f"{splunkd_uri}/services/splunk_start_defender/manager/get_account"
 
-    # Create a requests session for better performance
-    session = requests.Session()
-    session.headers.update(headers)
+    # Get a pooled keep-alive session, re-used across calls
+    session = splunk_start_defender_get_session(target_url, headers)
 
     try:
         # Use a context manager to handle the request
-        with session.post(target_url, data=json.dumps({'account': account}), verify=False) as response:
+        with session.post(target_url, data=json.dumps({'account': account}), timeout=splunk_start_defender_get_timeout(), verify=False) as response:
             if response.ok:
-                logging.debug(f"Success retrieving account, data=\"{response}\"")
+                logging.debug("Success retrieving account, data=\"%s\"", response)
                 response_json = response.json()
                 return response_json
             else:
@@ -117,45 +584,111 @@ def splunk_start_defender_get_account(session_key, splunkd_uri, account):
         raise Exception(error_message)
 
 
+
+# get the command context with least privilege approach
+def splunk_start_defender_get_command_context(session_key, splunkd_uri, account):
+    """
+    Retrieve the instance role, the logging level and the account creds in a single call.
+    """
+
+    # Ensure splunkd_uri starts with "https://"
+    if not splunkd_uri.startswith("https://"):
+        splunkd_uri = f"https://{splunkd_uri}"
+
+    # Build header and target URL
+    headers = CaseInsensitiveDict()
+    headers["Authorization"] = f"Splunk {session_key}"
+    target_url = f"{splunkd_uri}/services/splunk_start_defender/manager/command_context"
+
+    # Get a pooled keep-alive session, re-used across calls
+    session = splunk_start_defender_get_session(target_url, headers)
+
+    try:
+        # Use a context manager to handle the request
+        with session.post(target_url, data=json.dumps({'account': account}), timeout=splunk_start_defender_get_timeout(), verify=False) as response:
+            if response.ok:
+                logging.debug("Success retrieving command context, data=\"%s\"", response)
+                response_json = response.json()
+                return response_json
+            else:
+                error_message = f"Failed to retrieve command context, status_code={response.status_code}, response_text=\"{response.text}\""
+                logging.error(error_message)
+                raise Exception(error_message)
+
+    except Exception as e:
+        error_message = f"Failed to retrieve command context, exception=\"{str(e)}\""
+        logging.error(error_message)
+        raise Exception(error_message)
+
+
+
+# apply the command context to the process: log level, timeouts of the calls and proxy, shared by the custom commands
+# and the modular input so that a new context field is applied in a single place
+def splunk_start_defender_apply_command_context(command_context, search_start=None, engine='threads'):
+    """
+    Apply the log level, the timeouts and the proxy of command_context, returns (deadline, engine): the deadline of the
+    search started at search_start (time.monotonic(), None for no deadline), and the engine of the requests to circ,
+    which falls back to threads if the asyncio engine does not support the proxy.
+    """
+
+    # set loglevel
+    splunk_start_defender_set_loglevel(command_context['loglevel'])
+
+    # set the timeouts, requests are not sent nor retried once the deadline of the search is reached
+    timeouts = command_context.get('timeouts') or {}
+    splunk_start_defender_set_timeouts(timeouts.get('connect_timeout'), timeouts.get('read_timeout'))
+    deadline = None
+    if search_start is not None:
+        deadline = splunk_start_defender_get_deadline(timeouts.get('search_timeout'), search_start)
+
+    # route the calls to circ and to the relay through the proxy, if enabled
+    splunk_start_defender_set_proxy(command_context.get('proxy'))
+
+    return deadline, splunk_start_defender_get_engine(engine)
+
 # Get status (executed by the relay)
-def circ_get_status(circ_token, computername, circ_url):
+def circ_get_status(circ_token, computername, circ_url, timing=None, deadline=None):
     headers = CaseInsensitiveDict()
     headers["User-Agent"] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.87 Safari/537.36"
     headers["Authorization"] = f"Bearer {circ_token}"
     params = {'computername': computername}
 
-    session = requests.Session()
-    session.headers.update(headers)
-
     # set the url
     circ_url = circ_url + '/status'
 
+    # Get a pooled keep-alive session, re-used across calls
+    session = splunk_start_defender_get_session(circ_url, headers, use_proxy=True)
+
+    start = time.perf_counter()
     try:
-        with session.post(circ_url, params=params, verify=False) as response:
+        with splunk_start_defender_request(session, 'post', circ_url, deadline=deadline, params=params, verify=False) as response:
+            splunk_start_defender_set_timing(timing, 'circ_ms', start)
             if response.ok:
                 return response.json()
             else:
                 error_message = f"Failed to get status, HTTP status code: {response.status_code}, HTTP response: {response.text}"
                 logging.error(error_message)
-                raise Exception(error_message)
+                raise CircHTTPError(error_message, response.status_code)
     except Exception as e:
         logging.error(f"Failed to get status, exception=\"{str(e)}\"")
         raise Exception(f"Failed to get status, exception=\"{str(e)}\"")
 
 
 # Get status (relay, executed in Splunk Cloud and delegated to the relay)
-def circ_relay_get_status(account, relay_token, computername, relay_url):
+def circ_relay_get_status(account, relay_token, computername, relay_url, nocache=False, timing=None, deadline=None):
     headers = CaseInsensitiveDict()
     headers["Authorization"] = f"Bearer {relay_token}"
 
-    session = requests.Session()
-    session.headers.update(headers)
-
     # set the url
     relay_url = relay_url + '/services/splunk_start_defender/manager/relay_circ_get_status'
 
+    # Get a pooled keep-alive session, re-used across calls
+    session = splunk_start_defender_get_session(relay_url, headers, use_proxy=True)
+
+    start = time.perf_counter()
     try:
-        with session.post(relay_url, data=json.dumps({'account': account, 'computername': computername}), verify=False) as response:
+        with splunk_start_defender_request(session, 'post', relay_url, deadline=deadline, forward_deadline=True, data=json.dumps({'account': account, 'computername': computername, 'nocache': nocache}), verify=False) as response:
+            splunk_start_defender_set_relay_timing(timing, start, response)
             if response.ok:
                 return response.json()
             else:
@@ -167,43 +700,53 @@ def circ_relay_get_status(account, relay_token, computername, relay_url):
         raise Exception(f"Failed to get status, exception=\"{str(e)}\"")
 
 # Start scan
-def circ_start_scan(circ_token, computername, circ_url, fullscan=False):
+def circ_start_scan(circ_token, computername, circ_url, fullscan=False, timing=None, deadline=None):
     headers = CaseInsensitiveDict()
     headers["User-Agent"] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.87 Safari/537.36"
     headers["Authorization"] = f"Bearer {circ_token}"
     params = {'computername': computername, 'fullscan': fullscan}
 
-    session = requests.Session()
-    session.headers.update(headers)
-
     # set the url
     circ_url = circ_url + '/scan'
 
+    # Get a pooled keep-alive session, re-used across calls
+    session = splunk_start_defender_get_session(circ_url, headers, use_proxy=True)
+
+    # the idempotency key is sent for the Defender API to de-duplicate retries of this call, if it supports it
+    idempotency_key = splunk_start_defender_get_idempotency_key()
+
+    start = time.perf_counter()
     try:
-        with session.post(circ_url, params=params, verify=False) as response:
+        with splunk_start_defender_request(session, 'post', circ_url, idempotent=False, deadline=deadline, params=params, headers={'Idempotency-Key': idempotency_key}, verify=False) as response:
+            splunk_start_defender_set_timing(timing, 'circ_ms', start)
             if response.ok:
                 return response.json()
             else:
                 error_message = f"Failed to get status, HTTP status code: {response.status_code}, HTTP response: {response.text}"
                 logging.error(error_message)
-                raise Exception(error_message)
+                raise CircHTTPError(error_message, response.status_code)
     except Exception as e:
         logging.error(f"Failed to start scan, exception=\"{str(e)}\"")
         raise Exception(f"Failed to start scan, exception=\"{str(e)}\"")
 
 # Start scan (relay)
-def circ_relay_start_scan(account, relay_token, computername, relay_url, fullscan=False):
+def circ_relay_start_scan(account, relay_token, computername, relay_url, fullscan=False, timing=None, deadline=None):
     headers = CaseInsensitiveDict()
     headers["Authorization"] = f"Bearer {relay_token}"
 
-    session = requests.Session()
-    session.headers.update(headers)
-
     # set the url
     relay_url = relay_url + '/services/splunk_start_defender/manager/relay_circ_start_scan'
 
+    # Get a pooled keep-alive session, re-used across calls
+    session = splunk_start_defender_get_session(relay_url, headers, use_proxy=True)
+
+    # the relay starts the scan once per idempotency key, which makes retries of this call safe
+    idempotency_key = splunk_start_defender_get_idempotency_key()
+
+    start = time.perf_counter()
     try:
-        with session.post(relay_url, data=json.dumps({'account': account, 'computername': computername, 'fullscan': fullscan}), verify=False) as response:
+        with splunk_start_defender_request(session, 'post', relay_url, deadline=deadline, forward_deadline=True, data=json.dumps({'account': account, 'computername': computername, 'fullscan': fullscan, 'idempotency_key': idempotency_key}), verify=False) as response:
+            splunk_start_defender_set_relay_timing(timing, start, response)
             if response.ok:
                 return response.json()
             else:
@@ -214,3 +757,266 @@ def circ_relay_start_scan(account, relay_token, computername, relay_url, fullsca
         logging.error(f"Failed to start scan, exception=\"{str(e)}\"")
         raise Exception(f"Failed to start scan, exception=\"{str(e)}\"")
 
+
+# Get status for a batch of computer names (relay, executed in Splunk Cloud and delegated to the relay)
+def circ_relay_get_status_batch(account, relay_token, computernames, relay_url, max_concurrency=10, nocache=False, timings=None, deadline=None):
+    headers = CaseInsensitiveDict()
+    headers["Authorization"] = f"Bearer {relay_token}"
+
+    # set the url
+    relay_url = relay_url + '/services/splunk_start_defender/manager/relay_circ_get_status_batch'
+
+    # Get a pooled keep-alive session, re-used across calls
+    session = splunk_start_defender_get_session(relay_url, headers, use_proxy=True)
+
+    start = time.perf_counter()
+    try:
+        with splunk_start_defender_request(session, 'post', relay_url, deadline=deadline, forward_deadline=True, data=json.dumps({'account': account, 'computernames': list(computernames), 'max_concurrency': max_concurrency, 'nocache': nocache}), verify=False) as response:
+            if response.ok:
+                batch_response = response.json()
+                splunk_start_defender_set_relay_batch_timings(timings, start, batch_response)
+                return batch_response
+            else:
+                error_message = f"Failed to get status, HTTP status code: {response.status_code}, HTTP response: {response.text}"
+                logging.error(error_message)
+                raise Exception(error_message)
+    except Exception as e:
+        logging.error(f"Failed to get status, exception=\"{str(e)}\"")
+        raise Exception(f"Failed to get status, exception=\"{str(e)}\"")
+
+# Start scan for a batch of computer names (relay)
+def circ_relay_start_scan_batch(account, relay_token, computernames, relay_url, fullscan=False, max_concurrency=10, max_rate=None, timings=None, deadline=None):
+    headers = CaseInsensitiveDict()
+    headers["Authorization"] = f"Bearer {relay_token}"
+
+    # set the url
+    relay_url = relay_url + '/services/splunk_start_defender/manager/relay_circ_start_scan_batch'
+
+    # Get a pooled keep-alive session, re-used across calls
+    session = splunk_start_defender_get_session(relay_url, headers, use_proxy=True)
+
+    # the relay starts the scan once per idempotency key, which makes retries of this call safe
+    idempotency_key = splunk_start_defender_get_idempotency_key()
+
+    start = time.perf_counter()
+    try:
+        with splunk_start_defender_request(session, 'post', relay_url, deadline=deadline, forward_deadline=True, data=json.dumps({'account': account, 'computernames': list(computernames), 'fullscan': fullscan, 'max_concurrency': max_concurrency, 'max_rate': max_rate, 'idempotency_key': idempotency_key}), verify=False) as response:
+            if response.ok:
+                batch_response = response.json()
+                splunk_start_defender_set_relay_batch_timings(timings, start, batch_response)
+                return batch_response
+            else:
+                error_message = f"Failed to start scan, HTTP status code: {response.status_code}, HTTP response: {response.text}"
+                logging.error(error_message)
+                raise Exception(error_message)
+    except Exception as e:
+        logging.error(f"Failed to start scan, exception=\"{str(e)}\"")
+        raise Exception(f"Failed to start scan, exception=\"{str(e)}\"")
+
+# Start scan as a tracked job (relay, or local splunkd when running on the relay with auth_scheme="Splunk")
+def circ_relay_start_scan_job(account, relay_token, computername, relay_url, fullscan=False, auth_scheme="Bearer", timing=None, deadline=None):
+    headers = CaseInsensitiveDict()
+    headers["Authorization"] = f"{auth_scheme} {relay_token}"
+
+    # set the url
+    relay_url = relay_url + '/services/splunk_start_defender/manager/relay_circ_start_scan_job'
+
+    # Get a pooled keep-alive session, re-used across calls
+    session = splunk_start_defender_get_session(relay_url, headers, use_proxy=auth_scheme != "Splunk")
+
+    # the relay starts the scan once per idempotency key, which makes retries of this call safe
+    idempotency_key = splunk_start_defender_get_idempotency_key()
+
+    start = time.perf_counter()
+    try:
+        with splunk_start_defender_request(session, 'post', relay_url, deadline=deadline, forward_deadline=True, data=json.dumps({'account': account, 'computername': computername, 'fullscan': fullscan, 'idempotency_key': idempotency_key}), verify=False) as response:
+            splunk_start_defender_set_relay_timing(timing, start, response)
+            if response.ok:
+                return response.json()
+            else:
+                error_message = f"Failed to start scan job, HTTP status code: {response.status_code}, HTTP response: {response.text}"
+                logging.error(error_message)
+                raise Exception(error_message)
+    except Exception as e:
+        logging.error(f"Failed to start scan job, exception=\"{str(e)}\"")
+        raise Exception(f"Failed to start scan job, exception=\"{str(e)}\"")
+
+# Get a scan job (relay, or local splunkd when running on the relay with auth_scheme="Splunk")
+def circ_relay_get_job(relay_token, job_id, relay_url, auth_scheme="Bearer", deadline=None):
+    headers = CaseInsensitiveDict()
+    headers["Authorization"] = f"{auth_scheme} {relay_token}"
+
+    # set the url
+    relay_url = relay_url + '/services/splunk_start_defender/manager/relay_circ_get_job'
+
+    # Get a pooled keep-alive session, re-used across calls
+    session = splunk_start_defender_get_session(relay_url, headers, use_proxy=auth_scheme != "Splunk")
+
+    try:
+        with splunk_start_defender_request(session, 'post', relay_url, deadline=deadline, forward_deadline=True, data=json.dumps({'job_id': job_id}), verify=False) as response:
+            if response.ok:
+                return response.json()
+            else:
+                error_message = f"Failed to get job, HTTP status code: {response.status_code}, HTTP response: {response.text}"
+                logging.error(error_message)
+                raise Exception(error_message)
+    except Exception as e:
+        logging.error(f"Failed to get job, exception=\"{str(e)}\"")
+        raise Exception(f"Failed to get job, exception=\"{str(e)}\"")
+
+# List scan jobs (relay, or local splunkd when running on the relay with auth_scheme="Splunk")
+def circ_relay_list_jobs(relay_token, relay_url, account=None, state=None, auth_scheme="Bearer", deadline=None):
+    headers = CaseInsensitiveDict()
+    headers["Authorization"] = f"{auth_scheme} {relay_token}"
+
+    # set the url
+    relay_url = relay_url + '/services/splunk_start_defender/manager/relay_circ_jobs'
+
+    # Get a pooled keep-alive session, re-used across calls
+    session = splunk_start_defender_get_session(relay_url, headers, use_proxy=auth_scheme != "Splunk")
+
+    params = {}
+    if account:
+        params['account'] = account
+    if state:
+        params['state'] = state
+
+    try:
+        with splunk_start_defender_request(session, 'get', relay_url, deadline=deadline, forward_deadline=True, params=params, verify=False) as response:
+            if response.ok:
+                return response.json()
+            else:
+                error_message = f"Failed to list jobs, HTTP status code: {response.status_code}, HTTP response: {response.text}"
+                logging.error(error_message)
+                raise Exception(error_message)
+    except Exception as e:
+        logging.error(f"Failed to list jobs, exception=\"{str(e)}\"")
+        raise Exception(f"Failed to list jobs, exception=\"{str(e)}\"")
+
+# Rate limiter shared by concurrent workers
+class RateLimiter(object):
+    """
+    Thread safe rate limiter, spaces the calls to acquire() so that no more than max_rate calls per second are started.
+    """
+
+    def __init__(self, max_rate):
+        self.interval = 1.0 / float(max_rate)
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def reserve(self):
+        """
+        Reserve the next slot, and return the number of seconds to wait for it.
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+
+        return max(0, slot - now)
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+# a thread is started per call in flight, higher concurrency levels are served by the asyncio client,
+# see lib_splunk_start_defender_async.py
+run_concurrent_max_threads = 100
+
+
+# Run a function against many items with bounded concurrency
+def splunk_start_defender_run_concurrent(func, items, max_concurrency=10, max_rate=None):
+    """
+    Call func(item) for every item with at most max_concurrency calls in flight (up to run_concurrent_max_threads),
+    and if max_rate is set, no more than max_rate calls started per second.
+    Yields (item, response, exception) tuples as soon as each call completes, in completion order.
+    Items are consumed lazily, so the input can be a generator of any size.
+    """
+
+    max_concurrency = min(max_concurrency, run_concurrent_max_threads)
+
+    if max_rate:
+        rate_limiter = RateLimiter(max_rate)
+        unlimited_func = func
+
+        def func(item):
+            rate_limiter.acquire()
+            return unlimited_func(item)
+
+    items = iter(items)
+    in_flight = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+
+        # fill the pool
+        for item in itertools.islice(items, max_concurrency):
+            in_flight[executor.submit(func, item)] = item
+
+        while in_flight:
+            done, not_done = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                item = in_flight.pop(future)
+
+                # refill before yielding, so the pool stays busy while the caller processes the result
+                for next_item in itertools.islice(items, 1):
+                    in_flight[executor.submit(func, next_item)] = next_item
+
+                try:
+                    response = future.result()
+                    exception = None
+                except Exception as e:
+                    response = None
+                    exception = e
+
+                yield item, response, exception
+
+
+# Run relay batch calls over many items, yielding per item results as each batch completes
+def splunk_start_defender_run_batches(func, items, batch_size=100, max_batches_in_flight=2, get_computername=None):
+    """
+    Split items into batches of batch_size and call func(batch) for each batch, with at most max_batches_in_flight
+    batches in flight. func must return a relay batch response, whose results are matched to the items of the batch
+    on their computername, get_computername(item) returns the computer name of an item (the item itself by default).
+    Items must hold stripped, non empty computer names, the relay ignores the others.
+    Yields (item, response, exception) tuples like splunk_start_defender_run_concurrent.
+    """
+
+    if get_computername is None:
+        get_computername = lambda item: item
+
+    def get_batches():
+        items_iter = iter(items)
+        while True:
+            batch = list(itertools.islice(items_iter, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    for batch, response, exception in splunk_start_defender_run_concurrent(func, get_batches(), max_batches_in_flight):
+
+        # the results of a computer name submitted more than once in the batch are taken in order
+        results = {}
+        if exception is None:
+            for result in response.get('results', []):
+                results.setdefault(result.get('computername'), []).append(result)
+
+        for item in batch:
+
+            if exception is not None:
+                yield item, None, exception
+                continue
+
+            item_results = results.get(get_computername(item))
+            if not item_results:
+                yield item, None, Exception("The relay did not return a result for this item")
+                continue
+
+            result = item_results.pop(0)
+            if result.get('status') == 'success':
+                yield item, result.get('response'), None
+
+            else:
+                yield item, None, Exception(result.get('exception'))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__author__ = "Guilhem Marchand for Mercedes"
+
+import math
+import time
+import logging
+import threading
+
+# logging:
+# To avoid overriding logging destination of callers, the libs will not set on purpose any logging definition
+# and rely on callers themselves
+
+# admission control:
+# the relay runs the calls to circ in the threads of the requests (splunkd) and of the batches, a burst of searches
+# from Splunk Cloud would become a burst of calls to circ. At most max_workers calls to circ run at a time, and at
+# most account_max_workers for a given account, so that an account cannot take all the workers. Up to max_queued
+# further calls wait for a worker, for queue_timeout seconds at most, calls beyond are rejected immediately with
+# RelayOverloadedError, which the relay returns as HTTP 429 with a Retry-After hint estimated from the queue length
+# and the average duration of the calls. A max_workers of 0 disables the admission control. The state is held in
+# memory, the limits therefore apply per process (the persistent REST API handler), not across processes.
+admission_max_workers = 40
+admission_max_queued = 100
+admission_account_max_workers = 20
+admission_queue_timeout = 30
+admission_latency_alpha = 0.2
+admission_retry_after_max = 30
+
+
+class RelayOverloadedError(Exception):
+    """
+    Raised instead of calling when no worker is available, retry_after is the number of seconds to wait before retrying.
+    """
+
+    def __init__(self, message, retry_after):
+        super(RelayOverloadedError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionControl(object):
+    """
+    Thread safe bounded worker pool with a queue and a concurrency limit per account, see admission control.
+    """
+
+    def __init__(self, max_workers=admission_max_workers, max_queued=admission_max_queued,
+        account_max_workers=admission_account_max_workers, queue_timeout=admission_queue_timeout):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.account_max_workers = account_max_workers
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+
+        self.active = 0
+        self.queued = 0
+        self.accounts = {}
+        self.latency = None
+
+        # counters, for diagnostics
+        self.calls = 0
+        self.waited = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def configure(self, max_workers, max_queued, account_max_workers):
+        with self.condition:
+            self.max_workers = max_workers
+            self.max_queued = max_queued
+            self.account_max_workers = account_max_workers
+            # waiting calls may now have a worker
+            self.condition.notify_all()
+
+    def is_configured(self, max_workers, max_queued, account_max_workers):
+        return (self.max_workers, self.max_queued, self.account_max_workers) == (max_workers, max_queued, account_max_workers)
+
+    def get_account(self, account):
+        # called with the lock held
+        state = self.accounts.get(account)
+        if state is None:
+            state = {'active': 0, 'queued': 0, 'calls': 0, 'rejected': 0}
+            self.accounts[account] = state
+        return state
+
+    def has_worker(self, state):
+        # called with the lock held, the admission control may have been disabled while waiting
+        if self.max_workers <= 0:
+            return True
+        return self.active < self.max_workers and (self.account_max_workers <= 0 or state['active'] < self.account_max_workers)
+
+    def get_retry_after(self):
+        """
+        Return the number of seconds after which a worker is expected to be available, called with the lock held.
+        """
+        latency = self.latency if self.latency is not None else 1
+        retry_after = latency * (self.queued + 1) / max(1, self.max_workers)
+        return min(admission_retry_after_max, max(1, math.ceil(retry_after)))
+
+    def reject(self, account, state, message):
+        # called with the lock held
+        self.rejected += 1
+        state['rejected'] += 1
+        retry_after = self.get_retry_after()
+        logging.warning(f"admission control, call rejected, account=\"{account}\", reason=\"{message}\", active={self.active}, queued={self.queued}, retry_after={retry_after}")
+        return RelayOverloadedError(f"The relay is overloaded, {message}, active={self.active}, queued={self.queued}, "
+            f"account=\"{account}\", retry after {retry_after} seconds", retry_after)
+
+    def check(self, account):
+        """
+        Raise RelayOverloadedError if the queue is full, without waiting. Used before accepting a batch.
+        """
+
+        with self.condition:
+            if self.max_workers <= 0 or self.active < self.max_workers or self.queued < self.max_queued:
+                return
+            raise self.reject(account, self.get_account(account), "the queue is full")
+
+    def acquire(self, account, deadline=None):
+        """
+        Take a worker for account, waiting in the queue if none is available. Raise RelayOverloadedError if the queue
+        is full, or if no worker was available within queue_timeout seconds or before deadline (time.monotonic()).
+        """
+
+        with self.condition:
+            state = self.get_account(account)
+            state['calls'] += 1
+            self.calls += 1
+
+            if not self.has_worker(state):
+
+                if self.queued >= self.max_queued:
+                    raise self.reject(account, state, "the queue is full")
+
+                wait_until = time.monotonic() + self.queue_timeout
+                if deadline is not None:
+                    wait_until = min(wait_until, deadline)
+
+                self.waited += 1
+                self.queued += 1
+                state['queued'] += 1
+                try:
+                    while not self.has_worker(state):
+                        remaining = wait_until - time.monotonic()
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            raise self.reject(account, state, "no worker was available in time")
+                        self.condition.wait(remaining)
+                finally:
+                    self.queued -= 1
+                    state['queued'] -= 1
+
+            self.active += 1
+            state['active'] += 1
+
+    def release(self, account, duration):
+
+        with self.condition:
+            state = self.get_account(account)
+            self.active -= 1
+            state['active'] -= 1
+
+            if self.latency is None:
+                self.latency = duration
+            else:
+                self.latency += admission_latency_alpha * (duration - self.latency)
+
+            self.condition.notify_all()
+
+    def call(self, account, func, deadline=None):
+        """
+        Return func() once a worker is available for account, see acquire().
+        """
+
+        if self.max_workers <= 0:
+            return func()
+
+        self.acquire(account, deadline)
+        start = time.monotonic()
+
+        try:
+            return func()
+
+        finally:
+            self.release(account, time.monotonic() - start)
+
+    def get_state(self, account=None):
+        with self.condition:
+            return {
+                'max_workers': self.max_workers,
+                'max_queued': self.max_queued,
+                'account_max_workers': self.account_max_workers,
+                'active': self.active,
+                'queued': self.queued,
+                'latency_ms': round(self.latency * 1000, 2) if self.latency is not None else None,
+                'calls': self.calls,
+                'waited': self.waited,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'accounts': [dict(name=name, **state) for name, state in self.accounts.items() if not account or name == account],
+            }
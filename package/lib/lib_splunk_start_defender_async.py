@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__author__ = "Guilhem Marchand for Mercedes"
+
+import time
+import random
+import asyncio
+import logging
+import itertools
+import contextlib
+import urllib.parse
+
+import httpx
+
+import lib_splunk_start_defender
+from lib_splunk_start_defender import CircHTTPError, DeadlineExceeded, RateLimiter, retry_budget, retry_statuses, \
+    async_proxy_schemes, retry_max_attempts, retry_backoff_base, retry_backoff_max, retry_after_max, splunk_start_defender_get_retry_after, \
+    splunk_start_defender_get_timeout, splunk_start_defender_set_timing, splunk_start_defender_get_idempotency_key
+
+# logging:
+# To avoid overriding logging destination of callers, the libs will not set on purpose any logging definition
+# and rely on callers themselves
+
+# httpx logs every request at INFO level, only its warnings reach the logs of the callers
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# asyncio client:
+# for high fan-out sweeps, the calls to circ can run on an asyncio event loop rather than a thread per call in flight,
+# a single thread then keeps hundreds of requests in flight. The coroutines have the same payload semantics, retries,
+# timeouts and deadline as circ_get_status and circ_start_scan, splunk_start_defender_run_async() drives them from
+# the synchronous custom commands. The proxy set with splunk_start_defender_set_proxy() is honoured, http and socks5
+# proxies are supported, httpx does not support socks4 proxies: callers select the engine with
+# splunk_start_defender_get_engine(), which falls back to the threads engine.
+
+# asyncio client pool:
+# the connection pool of a client examines all of its connections for every request, its cost grows with the pool size
+# and a single client with hundreds of connections is CPU bound. The calls in flight are spread in round robin across
+# clients of at most async_client_max_connections connections each.
+async_client_max_connections = 10
+
+
+# get an asyncio http client, with a connection pool sized for max_connections calls in flight
+def splunk_start_defender_get_async_client(max_connections):
+    """
+    Return an httpx.AsyncClient, to be used as an async context manager within a single event loop.
+    """
+
+    http_proxies = lib_splunk_start_defender.http_proxies
+    proxy = http_proxies['https'] if http_proxies else None
+
+    if proxy and urllib.parse.urlsplit(proxy).scheme not in async_proxy_schemes:
+        raise ValueError(f"The asyncio client does not support the proxy scheme=\"{urllib.parse.urlsplit(proxy).scheme}\", "
+            f"supported schemes are: {', '.join(async_proxy_schemes)}, use engine=threads")
+
+    return httpx.AsyncClient(
+        verify=False,
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        proxy=proxy,
+        # the proxy of the settings takes precedence over the proxy environment variables
+        trust_env=proxy is None,
+    )
+
+
+# run a request with retries, see splunk_start_defender_request
+async def splunk_start_defender_request_async(client, method, url, idempotent=True, deadline=None, **kwargs):
+    """
+    Run client.request(method, url, **kwargs), retrying transient failures, and return the last response.
+    If idempotent is False, the request is only retried when it was certainly not processed by the target.
+    No attempt is started after the deadline.
+    The exception of the last attempt is raised if no response could be obtained.
+    """
+
+    retry_budget.deposit()
+
+    for attempt in range(1, retry_max_attempts + 1):
+
+        response = None
+        retry_after = None
+
+        # the timeouts are capped to the deadline at each attempt
+        connect_timeout, read_timeout = splunk_start_defender_get_timeout(deadline)
+        kwargs['timeout'] = httpx.Timeout(read_timeout, connect=connect_timeout)
+
+        try:
+            response = await client.request(method, url, **kwargs)
+            if response.status_code not in retry_statuses or (not idempotent and response.status_code != 429):
+                return response
+            reason = f"HTTP status code: {response.status_code}"
+            retry_after = splunk_start_defender_get_retry_after(response)
+
+        except httpx.TransportError as e:
+            if deadline is not None and isinstance(e, httpx.TimeoutException) and time.monotonic() >= deadline:
+                raise DeadlineExceeded(f"The deadline of the search was reached while waiting for the response, url=\"{url}\"") from e
+            if not (idempotent or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))):
+                raise
+            if attempt == retry_max_attempts:
+                raise
+            reason = f"exception=\"{str(e)}\""
+            exception = e
+
+        if attempt == retry_max_attempts:
+            return response
+
+        # the delay requested by the target is honoured, if it is longer than we accept the call fails now
+        if retry_after is not None and retry_after > retry_after_max:
+            logging.error(f"Not retrying request, url=\"{url}\", {reason}, the requested Retry-After={retry_after} exceeds {retry_after_max} seconds")
+            return response
+
+        if not retry_budget.withdraw():
+            logging.error(f"Not retrying request, url=\"{url}\", {reason}, the retry budget of this process is exhausted")
+            if response is None:
+                raise Exception(f"Request failed and the retry budget is exhausted, url=\"{url}\", {reason}") from exception
+            return response
+
+        if retry_after is None:
+            retry_after = random.uniform(0, min(retry_backoff_max, retry_backoff_base * 2 ** attempt))
+
+        # there is no point retrying if the deadline would be reached before the next attempt
+        if deadline is not None and time.monotonic() + retry_after >= deadline:
+            logging.error(f"Not retrying request, url=\"{url}\", {reason}, the deadline of the search would be reached before the next attempt")
+            if response is None:
+                raise DeadlineExceeded(f"Request failed and the deadline of the search would be reached before the next attempt, url=\"{url}\", {reason}") from exception
+            return response
+
+        logging.warning(f"Retrying request, url=\"{url}\", {reason}, attempt={attempt}, delay={round(retry_after, 3)}")
+
+        await asyncio.sleep(retry_after)
+
+
+# Get status (asyncio, executed by the relay)
+async def circ_get_status_async(client, circ_token, computername, circ_url, timing=None, deadline=None):
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.87 Safari/537.36",
+        "Authorization": f"Bearer {circ_token}",
+    }
+    params = {'computername': computername}
+
+    # set the url
+    circ_url = circ_url + '/status'
+
+    start = time.perf_counter()
+    try:
+        response = await splunk_start_defender_request_async(client, 'post', circ_url, deadline=deadline, params=params, headers=headers)
+        splunk_start_defender_set_timing(timing, 'circ_ms', start)
+        if response.is_success:
+            return response.json()
+        else:
+            error_message = f"Failed to get status, HTTP status code: {response.status_code}, HTTP response: {response.text}"
+            logging.error(error_message)
+            raise CircHTTPError(error_message, response.status_code)
+    except Exception as e:
+        logging.error(f"Failed to get status, exception=\"{str(e)}\"")
+        raise Exception(f"Failed to get status, exception=\"{str(e)}\"")
+
+
+# Start scan (asyncio)
+async def circ_start_scan_async(client, circ_token, computername, circ_url, fullscan=False, timing=None, deadline=None):
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.87 Safari/537.36",
+        "Authorization": f"Bearer {circ_token}",
+        # the idempotency key is sent for the Defender API to de-duplicate retries of this call, if it supports it
+        "Idempotency-Key": splunk_start_defender_get_idempotency_key(),
+    }
+    # booleans are sent as requests does (True/False), httpx would send them lower case
+    params = {'computername': computername, 'fullscan': str(fullscan)}
+
+    # set the url
+    circ_url = circ_url + '/scan'
+
+    start = time.perf_counter()
+    try:
+        response = await splunk_start_defender_request_async(client, 'post', circ_url, idempotent=False, deadline=deadline, params=params, headers=headers)
+        splunk_start_defender_set_timing(timing, 'circ_ms', start)
+        if response.is_success:
+            return response.json()
+        else:
+            error_message = f"Failed to get status, HTTP status code: {response.status_code}, HTTP response: {response.text}"
+            logging.error(error_message)
+            raise CircHTTPError(error_message, response.status_code)
+    except Exception as e:
+        logging.error(f"Failed to start scan, exception=\"{str(e)}\"")
+        raise Exception(f"Failed to start scan, exception=\"{str(e)}\"")
+
+
+# Run a coroutine function against many items with bounded concurrency, see splunk_start_defender_run_concurrent
+async def splunk_start_defender_run_concurrent_async(func, items, max_concurrency=100, max_rate=None):
+    """
+    Await func(client, item) for every item with at most max_concurrency calls in flight, sharing a pool of clients,
+    and if max_rate is set, no more than max_rate calls started per second.
+    Yields (item, response, exception) tuples as soon as each call completes, in completion order.
+    Items are consumed lazily, only max_concurrency calls exist at any time whatever the number of items.
+    """
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    rate_limiter = RateLimiter(max_rate) if max_rate else None
+    items = iter(items)
+    in_flight = set()
+
+    async def call(client, item):
+        try:
+            return item, await func(client, item), None
+        except Exception as e:
+            return item, None, e
+        finally:
+            semaphore.release()
+
+    async with contextlib.AsyncExitStack() as stack:
+
+        clients_count = -(-max_concurrency // async_client_max_connections)
+        clients = itertools.cycle([
+            await stack.enter_async_context(splunk_start_defender_get_async_client(-(-max_concurrency // clients_count)))
+            for index in range(clients_count)
+        ])
+
+        try:
+            while True:
+
+                # start calls while the semaphore has free slots
+                while not semaphore.locked():
+                    item = next(items, StopIteration)
+                    if item is StopIteration:
+                        break
+                    await semaphore.acquire()
+                    if rate_limiter:
+                        await asyncio.sleep(rate_limiter.reserve())
+                    in_flight.add(asyncio.ensure_future(call(next(clients), item)))
+
+                if not in_flight:
+                    return
+
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    yield task.result()
+
+        finally:
+            # the caller stopped consuming the results
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+
+# Run a coroutine function against many items from synchronous code, such as the custom commands
+def splunk_start_defender_run_async(func, items, max_concurrency=100, max_rate=None):
+    """
+    Synchronous wrapper of splunk_start_defender_run_concurrent_async, with a private event loop in the calling thread.
+    Yields (item, response, exception) tuples like splunk_start_defender_run_concurrent, the calls in flight only make
+    progress while the caller waits for the next result.
+    """
+
+    loop = asyncio.new_event_loop()
+    results = splunk_start_defender_run_concurrent_async(func, items, max_concurrency, max_rate)
+
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+
+    finally:
+        loop.run_until_complete(results.aclose())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
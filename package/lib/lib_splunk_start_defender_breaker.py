@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__author__ = "Guilhem Marchand for Mercedes"
+
+import time
+import logging
+import threading
+
+# logging:
+# To avoid overriding logging destination of callers, the libs will not set on purpose any logging definition
+# and rely on callers themselves
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling when the circuit is open, retry_after is the number of seconds before a probe is allowed.
+    """
+
+    def __init__(self, message, retry_after):
+        super(CircuitOpenError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """
+    Thread safe circuit breaker.
+    closed: calls are made, the circuit opens after failure_threshold consecutive failures.
+    open: calls fail immediately with CircuitOpenError, for reset_timeout seconds.
+    half_open: a single probe call is made, the circuit closes if it succeeds and opens again if it fails, it stays half
+    open if the probe raises an exception which is not a failure of the service.
+    A failure_threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = None
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+
+        # counters, for diagnostics
+        self.calls = 0
+        self.failures_total = 0
+        self.rejected = 0
+        self.trips = 0
+        self.last_failure = None
+        self.last_state_change = time.time()
+
+    def configure(self, failure_threshold, reset_timeout):
+        with self.lock:
+            self.failure_threshold = failure_threshold
+            self.reset_timeout = reset_timeout
+
+    def set_state(self, state):
+        # called with the lock held
+        if state != self.state:
+            logging.info(f"circuit breaker state change, name=\"{self.name}\", previous_state=\"{self.state}\", state=\"{state}\", consecutive_failures={self.failures}")
+            self.state = state
+            self.last_state_change = time.time()
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError if the call is not allowed, returns True if the call is the half open probe.
+        """
+
+        with self.lock:
+            self.calls += 1
+
+            if self.failure_threshold <= 0:
+                return False
+
+            if self.state == 'open':
+                retry_after = self.opened + self.reset_timeout - time.time()
+                if retry_after > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"The circuit breaker of {self.name} is open after {self.failures} consecutive failures, requests are rejected for {round(retry_after, 1)} seconds", retry_after)
+                self.set_state('half_open')
+
+            if self.state == 'half_open':
+                if self.probe_in_flight:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"The circuit breaker of {self.name} is half open and a probe request is in progress, requests are rejected until it completes", 1)
+                self.probe_in_flight = True
+                return True
+
+            return False
+
+    def on_success(self, probe):
+        with self.lock:
+            if probe:
+                self.probe_in_flight = False
+            self.failures = 0
+            if self.state != 'closed':
+                self.set_state('closed')
+
+    def on_failure(self, probe):
+        with self.lock:
+            if probe:
+                self.probe_in_flight = False
+            self.failures += 1
+            self.failures_total += 1
+            self.last_failure = time.time()
+
+            if self.failure_threshold <= 0:
+                return
+
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                self.opened = time.time()
+                self.trips += 1
+                self.set_state('open')
+
+    def on_ignored(self, probe):
+        # the call ended without telling whether the service works (the deadline of the search was reached before the
+        # request was sent, for instance), the probe slot is released and the circuit stays half open
+        with self.lock:
+            if probe:
+                self.probe_in_flight = False
+
+    def call(self, func, is_failure=None):
+        """
+        Call func() through the breaker, is_failure(exception) tells if an exception counts as a failure of the
+        service (all exceptions count by default), other exceptions are raised without affecting the breaker.
+        """
+
+        probe = self.before_call()
+
+        try:
+            response = func()
+
+        except Exception as e:
+            if is_failure is None or is_failure(e):
+                self.on_failure(probe)
+            else:
+                self.on_ignored(probe)
+            raise
+
+        self.on_success(probe)
+        return response
+
+    def get_state(self):
+        with self.lock:
+            retry_after = None
+            if self.state == 'open':
+                retry_after = round(max(0, self.opened + self.reset_timeout - time.time()), 1)
+
+            return {
+                'name': self.name,
+                'state': self.state,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+                'consecutive_failures': self.failures,
+                'retry_after': retry_after,
+                'calls': self.calls,
+                'failures': self.failures_total,
+                'rejected': self.rejected,
+                'trips': self.trips,
+                'last_failure': self.last_failure,
+                'last_state_change': self.last_state_change,
+            }
+
+
+class CircuitBreakers(object):
+    """
+    Circuit breakers by name, created on first use.
+    """
+
+    def __init__(self):
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, name, failure_threshold, reset_timeout):
+        """
+        Return the breaker for name, its settings are updated if they changed.
+        """
+
+        with self.lock:
+            breaker = self.breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+                self.breakers[name] = breaker
+
+        if breaker.failure_threshold != failure_threshold or breaker.reset_timeout != reset_timeout:
+            breaker.configure(failure_threshold, reset_timeout)
+
+        return breaker
+
+    def get_states(self):
+        with self.lock:
+            breakers = list(self.breakers.values())
+        return [breaker.get_state() for breaker in breakers]
+
+    def clear(self):
+        with self.lock:
+            self.breakers.clear()
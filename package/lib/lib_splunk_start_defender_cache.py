@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__author__ = "Guilhem Marchand for Mercedes"
+
+import time
+import threading
+import collections
+
+# logging:
+# To avoid overriding logging destination of callers, the libs will not set on purpose any logging definition
+# and rely on callers themselves
+
+
+class InFlightCall(object):
+    """
+    A call in progress, concurrent callers of the same key wait for it rather than calling again.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.exception = None
+
+
+class SingleFlightCache(object):
+    """
+    Thread safe TTL cache with request coalescing: while a call for a key is in progress, concurrent callers for the
+    same key wait for its result rather than making their own call. Failures are never cached.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, func, ttl, nocache=False):
+        """
+        Return a tuple (response, cache_status), cache_status is one of:
+        hit (served from the cache), coalesced (shared the result of a concurrent call), miss (called func),
+        bypass (called func as nocache was requested, the result still refreshes the cache).
+        """
+
+        with self.lock:
+            now = time.time()
+
+            if not nocache and ttl > 0:
+                entry = self.entries.get(key)
+                if entry is not None and now - entry[0] < ttl:
+                    return entry[1], 'hit'
+
+            call = self.in_flight.get(key)
+            if call is not None and not nocache:
+                leader = False
+            else:
+                call = InFlightCall()
+                self.in_flight[key] = call
+                leader = True
+
+        # wait for the call in progress
+        if not leader:
+            call.event.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.response, 'coalesced'
+
+        try:
+            call.response = func()
+
+        except Exception as e:
+            call.exception = e
+            raise
+
+        finally:
+            with self.lock:
+                if self.in_flight.get(key) is call:
+                    del self.in_flight[key]
+
+                if call.exception is None and ttl > 0:
+                    self.entries[key] = (time.time(), call.response)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+
+            call.event.set()
+
+        return call.response, 'bypass' if nocache else 'miss'
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__author__ = "Guilhem Marchand for Mercedes"
+
+import os
+import re
+import json
+import logging
+
+# logging:
+# To avoid overriding logging destination of callers, the libs will not set on purpose any logging definition
+# and rely on callers themselves
+
+# checkpoints:
+# the modular inputs keep their progress as a JSON file per input in the checkpoint directory provided by splunkd, so
+# that a sweep interrupted by a restart resumes where it stopped rather than starting over. Files are replaced
+# atomically, a crash while saving leaves the previous checkpoint in place.
+# The per host state of the delta sweeps (status hash, last check and last change times) is a checkpoint as well, kept
+# in the hosts namespace: a subdirectory of the checkpoint directory, so that it cannot collide with the checkpoint of
+# another input whatever its name.
+
+
+# get the checkpoint file of an input, the input name (scheme://name) is made safe for the file system, checkpoints of
+# a namespace are stored in a subdirectory of the checkpoint directory
+def splunk_start_defender_get_checkpoint_path(checkpoint_dir, input_name, namespace=None):
+    if namespace:
+        checkpoint_dir = os.path.join(checkpoint_dir, namespace)
+    return os.path.join(checkpoint_dir, re.sub(r'[^\w.-]', '_', input_name) + '.json')
+
+
+# load a checkpoint, returns None if there is none or if it cannot be read
+def splunk_start_defender_load_checkpoint(checkpoint_dir, input_name, namespace=None):
+
+    checkpoint_path = splunk_start_defender_get_checkpoint_path(checkpoint_dir, input_name, namespace)
+
+    try:
+        with open(checkpoint_path, 'r') as f:
+            return json.load(f)
+
+    except FileNotFoundError:
+        return None
+
+    except Exception as e:
+        logging.error(f"Failed to load checkpoint, file=\"{checkpoint_path}\", exception=\"{str(e)}\", the checkpoint is ignored")
+        return None
+
+
+# save a checkpoint
+def splunk_start_defender_save_checkpoint(checkpoint_dir, input_name, checkpoint, namespace=None):
+
+    checkpoint_path = splunk_start_defender_get_checkpoint_path(checkpoint_dir, input_name, namespace)
+    checkpoint_tmp_path = f"{checkpoint_path}.tmp"
+
+    os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+
+    with open(checkpoint_tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(checkpoint_tmp_path, checkpoint_path)
+
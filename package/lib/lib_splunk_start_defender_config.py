@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__author__ = "Guilhem Marchand for Mercedes"
+
+import os
+import time
+import types
+import hashlib
+import logging
+import threading
+
+from lib_splunk_start_defender import splunkhome, splunk_start_defender_get_config_generation
+
+# logging:
+# To avoid overriding logging destination of callers, the libs will not set on purpose any logging definition
+# and rely on callers themselves
+
+# configuration snapshots:
+# the persistent REST API handler reads the settings and the accounts conf files once into an immutable snapshot,
+# and serves every lookup from memory. The snapshot is reloaded when its generation changes: the configuration
+# generation marker (changes made through the configuration UI of this instance), combined with the modification
+# time and size of the conf files of the app, default and local. The conf files of a search head cluster member are
+# rewritten when the configuration is replicated from another member (conf_replication_include in server.conf),
+# which a stat detects without any call to splunkd. passwords.conf holds the encrypted fields of the accounts and
+# is replicated the same way. Snapshots are reloaded after config_snapshot_max_age seconds in any case.
+config_snapshot_conf_files = ('splunk_start_defender_settings', 'splunk_start_defender_account')
+config_snapshot_watched_files = config_snapshot_conf_files + ('passwords',)
+config_snapshot_max_age = 300
+app_home = os.path.join(splunkhome, 'etc', 'apps', 'splunk_start_defender')
+
+
+# get the version of the conf files of the app, changes when any of them is written
+def splunk_start_defender_get_config_version(conf_files=config_snapshot_watched_files):
+    """
+    Return a short hash of the modification time and size of the default and local conf files.
+    """
+
+    markers = []
+
+    for conf_file in conf_files:
+        for directory in ('default', 'local'):
+            try:
+                stat = os.stat(os.path.join(app_home, directory, f"{conf_file}.conf"))
+                markers.append(f"{directory}/{conf_file}:{stat.st_mtime_ns}:{stat.st_size}")
+            except OSError:
+                markers.append(f"{directory}/{conf_file}:none")
+
+    return hashlib.sha1('|'.join(markers).encode('utf-8')).hexdigest()[:16]
+
+
+# get the generation of the configuration: the generation marker and the version of the conf files
+def splunk_start_defender_get_config_snapshot_generation():
+    return f"{splunk_start_defender_get_config_generation()}-{splunk_start_defender_get_config_version()}"
+
+
+# read conf files with a splunklib service, as a dictionary of stanzas per conf file
+def splunk_start_defender_read_confs(service, conf_files=config_snapshot_conf_files):
+
+    confs = {}
+
+    for conf_file in conf_files:
+        confs[conf_file] = {}
+        for stanza in service.confs[str(conf_file)]:
+            confs[conf_file][stanza.name] = dict(stanza.content.items())
+
+    return confs
+
+
+class ConfigSnapshot(object):
+    """
+    The stanzas of the conf files at a given generation, read-only.
+    """
+
+    __slots__ = ('generation', 'confs', 'loaded')
+
+    def __init__(self, generation, confs):
+        self.generation = generation
+        self.confs = types.MappingProxyType(dict(
+            (conf_file, types.MappingProxyType(dict(
+                (name, types.MappingProxyType(dict(content))) for name, content in stanzas.items()
+            ))) for conf_file, stanzas in confs.items()
+        ))
+        self.loaded = time.monotonic()
+
+    def get_conf(self, conf_file):
+        """
+        Return the stanzas of conf_file, by stanza name.
+        """
+        return self.confs.get(conf_file, types.MappingProxyType({}))
+
+    def get_stanza(self, conf_file, name):
+        """
+        Return the content of a stanza, or None if it does not exist.
+        """
+        return self.get_conf(conf_file).get(name)
+
+
+class ConfigSnapshotCache(object):
+    """
+    Thread safe holder of the current configuration snapshot, only a single caller reloads a stale snapshot.
+    """
+
+    def __init__(self, max_age=config_snapshot_max_age):
+        self.max_age = max_age
+        self.snapshot = None
+        self.loads = 0
+        self.load_lock = threading.Lock()
+
+    def is_fresh(self, snapshot, generation):
+        return snapshot is not None and snapshot.generation == generation and time.monotonic() - snapshot.loaded < self.max_age
+
+    def get(self, load, generation=None):
+        """
+        Return the snapshot of the current generation, calling load() to read the conf files if it is stale.
+        load() returns the stanzas per conf file, see splunk_start_defender_read_confs().
+        """
+
+        if generation is None:
+            generation = splunk_start_defender_get_config_snapshot_generation()
+
+        snapshot = self.snapshot
+        if self.is_fresh(snapshot, generation):
+            return snapshot
+
+        with self.load_lock:
+            snapshot = self.snapshot
+            if self.is_fresh(snapshot, generation):
+                return snapshot
+
+            # the generation is taken before reading, a change made while reading causes another reload
+            snapshot = ConfigSnapshot(generation, load())
+            self.snapshot = snapshot
+            self.loads += 1
+
+        logging.debug("config snapshot loaded, generation=\"%s\", loads=%s", generation, self.loads)
+
+        return snapshot
+
+    def clear(self):
+        self.snapshot = None
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__author__ = "Guilhem Marchand for Mercedes"
+
+import json
+import time
+import logging
+import threading
+
+# logging:
+# To avoid overriding logging destination of callers, the libs will not set on purpose any logging definition
+# and rely on callers themselves
+
+# realm of the encrypted account fields managed by ucc-gen
+account_credential_realm = '__REST_CREDENTIAL__#splunk_start_defender#configs/conf-splunk_start_defender_account'
+
+# realm of the encrypted settings managed by ucc-gen, the name of the credential is the name of the stanza
+settings_credential_realm = '__REST_CREDENTIAL__#splunk_start_defender#configs/conf-splunk_start_defender_settings'
+
+# ucc-gen stores encrypted values in chunks named <realm>:<name>``splunk_cred_sep``<index>: and writes a last chunk
+# containing an end mark, see solnlib.credentials.CredentialManager
+credential_separator = '``splunk_cred_sep``'
+credential_end_mark = '``splunk_cred_sep``S``splunk_cred_sep``P``splunk_cred_sep``L``splunk_cred_sep``I``splunk_cred_sep``T``splunk_cred_sep``'
+credential_max_chunks = 100
+
+# decoded credentials:
+# the encrypted fields of an account are stored by ucc-gen as a JSON object, for instance {"circ_token": "..."}, the
+# chunks are assembled with a join and the value is parsed as JSON once. The decoded fields are cached per realm and
+# name until the configuration generation changes, or for credential_cache_ttl seconds at most.
+credential_cache_ttl = 3600
+
+
+# get the clear value of an encrypted account
+def splunk_start_defender_get_credential(storage_passwords, account, realm=account_credential_realm):
+    """
+    Retrieve the raw clear value of the encrypted fields of an account.
+    Only the chunks of this account are fetched, by name and in order, rather than enumerating every credential of
+    the store: the cost depends on the size of the value, not on the number of credentials stored on the instance.
+    With a round trip per chunk, this is slower than the enumeration of a store of a few credentials, which is accepted
+    as the callers cache the decoded fields, see CredentialCache.
+    Returns an empty string if the account has no encrypted fields.
+    """
+
+    chunks = []
+
+    for index in range(1, credential_max_chunks + 1):
+
+        credential_name = f"{realm}:{account}{credential_separator}{index}:"
+
+        try:
+            credential = storage_passwords[credential_name]
+        except KeyError:
+            break
+
+        chunk = str(credential.content.clear_password)
+        if chunk == credential_end_mark:
+            break
+
+        chunks.append(chunk)
+
+    logging.debug("get_credential, account=\"%s\", retrieved %s chunks", account, len(chunks))
+
+    return ''.join(chunks)
+
+
+# decode the clear value of the encrypted fields of an account
+def splunk_start_defender_decode_credential(rawvalue):
+    """
+    Parse the clear value returned by splunk_start_defender_get_credential, returns the encrypted fields as a dict,
+    empty if there are none. Raises ValueError if the value is not a JSON object.
+    """
+
+    if not rawvalue:
+        return {}
+
+    fields = json.loads(rawvalue)
+    if not isinstance(fields, dict):
+        raise ValueError(f"The credential is not a JSON object, type=\"{type(fields).__name__}\"")
+
+    return fields
+
+
+class CredentialCache(object):
+    """
+    Decoded encrypted fields by realm and name, emptied when the configuration generation changes.
+    """
+
+    def __init__(self, ttl=credential_cache_ttl):
+        self.ttl = ttl
+        self.generation = None
+        self.credentials = {}
+        self.lock = threading.Lock()
+
+    def get(self, storage_passwords, name, realm=account_credential_realm, generation=None):
+        """
+        Return the decoded encrypted fields of name, from the cache or from the credential store.
+        """
+
+        key = (realm, name)
+
+        with self.lock:
+            if self.generation != generation:
+                self.generation = generation
+                self.credentials.clear()
+
+            cached = self.credentials.get(key)
+
+        if cached and time.time() - cached['mtime'] < self.ttl:
+            return cached['fields']
+
+        fields = splunk_start_defender_decode_credential(splunk_start_defender_get_credential(storage_passwords, name, realm))
+
+        # store in the cache, only if the configuration was not changed in the meantime
+        with self.lock:
+            if self.generation == generation:
+                self.credentials[key] = {
+                    'mtime': time.time(),
+                    'fields': fields,
+                }
+
+        return fields
+
+    def clear(self):
+        with self.lock:
+            self.credentials.clear()
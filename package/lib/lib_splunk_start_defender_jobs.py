@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__author__ = "Guilhem Marchand for Mercedes"
+
+import time
+import json
+import heapq
+import hashlib
+import logging
+import threading
+import uuid
+
+from lib_splunk_start_defender import splunk_start_defender_run_concurrent
+
+# logging:
+# To avoid overriding logging destination of callers, the libs will not set on purpose any logging definition
+# and rely on callers themselves
+
+# polling: a job is polled every job_poll_initial_interval seconds, the interval is multiplied by job_poll_backoff
+# each time the status is unchanged, up to job_poll_max_interval, and reset when the status changes
+job_poll_initial_interval = 15
+job_poll_max_interval = 300
+job_poll_backoff = 1.5
+job_poll_concurrency = 10
+
+# a job still running after job_max_duration seconds is abandoned, ended jobs are kept for job_retention seconds
+job_max_duration = 6 * 3600
+job_retention = 24 * 3600
+job_max_jobs = 10000
+
+# scan states, as reported in the circ status response
+job_states_running = ('running', 'in_progress', 'inprogress', 'started', 'pending', 'queued', 'scanning')
+job_states_completed = ('completed', 'complete', 'finished', 'succeeded', 'success', 'done')
+job_states_failed = ('failed', 'failure', 'error', 'cancelled', 'canceled', 'aborted')
+job_state_fields = ('scan_status', 'scanStatus', 'scan_state', 'scanState', 'status', 'state')
+job_states_ended = ('completed', 'failed', 'timeout')
+
+
+# get the scan state from a circ status response
+def get_scan_state(status_response):
+    """
+    Look for a known state field in the status response (and in its first level sub-dictionaries),
+    return running, completed or failed, or None if no known state could be found.
+    """
+
+    candidates = [status_response]
+    if isinstance(status_response, dict):
+        candidates.extend(value for value in status_response.values() if isinstance(value, dict))
+
+    for candidate in candidates:
+        if not isinstance(candidate, dict):
+            continue
+        for field in job_state_fields:
+            value = str(candidate.get(field, '')).strip().lower()
+            if value in job_states_completed:
+                return 'completed'
+            elif value in job_states_failed:
+                return 'failed'
+            elif value in job_states_running:
+                return 'running'
+
+    return None
+
+
+# get a stable hash of a circ status response
+def get_status_hash(status_response):
+    return hashlib.sha256(json.dumps(status_response, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ScanJobTracker(object):
+    """
+    Track scans started by the relay until they end, with a background poller.
+    Jobs are held in memory by the persistent REST handler process, fetching or listing jobs never calls circ.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.get_status_funcs = {}
+        self.schedule = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.poller = None
+
+    def submit(self, account, computername, fullscan, scan_response, get_status, baseline_status=None):
+        """
+        Register a scan which was accepted by circ, get_status is a callable returning the circ status of the
+        computer, baseline_status is the status before the scan was started if it could be retrieved.
+        Returns the job.
+        """
+
+        now = time.time()
+        job_id = uuid.uuid4().hex
+
+        job = {
+            'job_id': job_id,
+            'account': account,
+            'computername': computername,
+            'fullscan': fullscan,
+            'state': 'submitted',
+            'created': now,
+            'updated': now,
+            'ended': None,
+            'polls': 0,
+            'poll_interval': job_poll_initial_interval,
+            'next_poll': now + job_poll_initial_interval,
+            'last_error': None,
+            'scan_response': scan_response,
+            'status': baseline_status,
+            'transitions': [{'time': now, 'state': 'submitted'}],
+            'baseline_hash': get_status_hash(baseline_status) if baseline_status is not None else None,
+        }
+
+        with self.lock:
+            self.purge()
+            self.jobs[job_id] = job
+            self.get_status_funcs[job_id] = get_status
+            heapq.heappush(self.schedule, (job['next_poll'], job_id))
+
+        self.start_poller()
+        self.wakeup.set()
+
+        logging.info(f"scan job submitted, job_id=\"{job_id}\", account=\"{account}\", computername=\"{computername}\", fullscan=\"{fullscan}\"")
+
+        return self.get_job(job_id)
+
+    def get_job(self, job_id):
+        """
+        Return a copy of the job, or None if the job does not exist.
+        """
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return self.render_job(job)
+
+    def list_jobs(self, account=None, state=None):
+        """
+        Return a copy of all jobs, optionally filtered by account and state, most recent first.
+        """
+
+        with self.lock:
+            jobs = [self.render_job(job) for job in self.jobs.values()
+                if (account is None or job['account'] == account) and (state is None or job['state'] == state)]
+
+        return sorted(jobs, key=lambda job: job['created'], reverse=True)
+
+    def render_job(self, job):
+        rendered_job = dict((key, value) for key, value in job.items() if key not in ('baseline_hash', 'next_poll'))
+        rendered_job['transitions'] = list(job['transitions'])
+        if job['ended'] is None:
+            rendered_job['next_poll'] = job['next_poll']
+        return rendered_job
+
+    def purge(self):
+        # called with the lock held, removes ended jobs past retention, and the oldest ended jobs above the limit
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items() if job['ended'] and now - job['ended'] > job_retention]:
+            del self.jobs[job_id]
+
+        if len(self.jobs) >= job_max_jobs:
+            ended_jobs = sorted((job for job in self.jobs.values() if job['ended']), key=lambda job: job['ended'])
+            for job in ended_jobs[:len(self.jobs) - job_max_jobs + 1]:
+                del self.jobs[job['job_id']]
+
+    def start_poller(self):
+        with self.lock:
+            if self.poller is None or not self.poller.is_alive():
+                self.poller = threading.Thread(target=self.run_poller, name='splunk_start_defender_scan_jobs_poller', daemon=True)
+                self.poller.start()
+
+    def run_poller(self):
+        while True:
+            self.wakeup.clear()
+
+            with self.lock:
+                now = time.time()
+                due_job_ids = []
+                while self.schedule and self.schedule[0][0] <= now:
+                    next_poll, job_id = heapq.heappop(self.schedule)
+                    job = self.jobs.get(job_id)
+                    # skip stale schedule entries
+                    if job is not None and job['ended'] is None and job['next_poll'] == next_poll:
+                        due_job_ids.append((job_id, self.get_status_funcs[job_id]))
+
+                wait_time = self.schedule[0][0] - now if self.schedule else None
+
+            if due_job_ids:
+                for (job_id, get_status), status_response, exception in splunk_start_defender_run_concurrent(
+                    lambda job: job[1](), due_job_ids, job_poll_concurrency):
+                    self.update_job(job_id, status_response, exception)
+                continue
+
+            self.wakeup.wait(wait_time)
+
+    def update_job(self, job_id, status_response, exception):
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+
+            now = time.time()
+            job['polls'] += 1
+            job['updated'] = now
+            changed = False
+
+            if exception is not None:
+                job['last_error'] = str(exception)
+                logging.error(f"scan job poll failure, job_id=\"{job_id}\", computername=\"{job['computername']}\", exception=\"{str(exception)}\"")
+
+            else:
+                job['last_error'] = None
+                status_hash = get_status_hash(status_response)
+                changed = status_hash != get_status_hash(job['status'])
+                job['status'] = status_response
+
+                # an ended state is only accepted once the status differs from the status before the scan,
+                # which otherwise would reflect the previous scan
+                state = get_scan_state(status_response) or 'running'
+                if state in job_states_ended and status_hash == job['baseline_hash']:
+                    state = 'running'
+
+                if state != job['state']:
+                    job['transitions'].append({'time': now, 'state': state})
+                    job['state'] = state
+                    changed = True
+
+            if job['state'] not in job_states_ended and now - job['created'] > job_max_duration:
+                job['transitions'].append({'time': now, 'state': 'timeout'})
+                job['state'] = 'timeout'
+
+            if job['state'] in job_states_ended:
+                job['ended'] = now
+                self.get_status_funcs.pop(job_id, None)
+                logging.info(f"scan job ended, job_id=\"{job_id}\", computername=\"{job['computername']}\", state=\"{job['state']}\", polls={job['polls']}")
+                return
+
+            # adaptive backoff
+            if changed:
+                job['poll_interval'] = job_poll_initial_interval
+            else:
+                job['poll_interval'] = min(job_poll_max_interval, job['poll_interval'] * job_poll_backoff)
+
+            job['next_poll'] = now + job['poll_interval']
+            heapq.heappush(self.schedule, (job['next_poll'], job_id))
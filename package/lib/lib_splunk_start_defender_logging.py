@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__author__ = "Guilhem Marchand for Mercedes"
+
+import json
+import time
+import queue
+import atexit
+import logging
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+# logging:
+# the custom commands, the modular input and the REST API handler call splunk_start_defender_setup_logging() once when
+# they start. Records are put in a queue by the calling threads and written to the log file by a background thread,
+# so that the disk I/O is not on the path of the requests. The queue is drained when the process exits.
+
+log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(filename)s %(funcName)s %(lineno)d %(message)s')
+log_listener = None
+log_level = None
+
+
+class JsonMessage(object):
+    """
+    A log message serialized as single line JSON, only if the record is emitted.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return json.dumps(self.data)
+
+
+# set the root logger of the process, writing to the log file through a queue
+def splunk_start_defender_setup_logging(log_file, level=logging.INFO):
+    """
+    Replace the file handlers of the root logger by a queue handler, the records are written to log_file by a
+    background thread. Returns the root logger.
+    """
+
+    global log_listener
+
+    filehandler = RotatingFileHandler(log_file, mode='a', maxBytes=10000000, backupCount=1)
+    logging.Formatter.converter = time.gmtime
+    filehandler.setFormatter(log_formatter)
+
+    log = logging.getLogger()  # root logger - Good to get it only once.
+    for hdlr in log.handlers[:]:  # remove the existing file and queue handlers
+        if isinstance(hdlr, (logging.FileHandler, QueueHandler)):
+            log.removeHandler(hdlr)
+
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, filehandler)
+    log_listener.start()
+    log.addHandler(QueueHandler(log_queue))
+
+    splunk_start_defender_set_loglevel(level)
+
+    return log
+
+
+# set the level of the root logger, only if it changed: setting the level empties the level cache of every logger
+def splunk_start_defender_set_loglevel(level):
+
+    global log_level
+
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+
+    if level != log_level:
+        logging.getLogger().setLevel(level)
+        log_level = level
+
+
+# write the records still in the queue when the process exits
+@atexit.register
+def splunk_start_defender_stop_logging():
+
+    global log_listener
+
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
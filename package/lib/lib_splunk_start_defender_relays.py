@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__author__ = "Guilhem Marchand for Mercedes"
+
+import os
+import json
+import time
+import logging
+import threading
+
+import requests
+
+from lib_splunk_start_defender import splunkhome, DeadlineExceeded, splunk_start_defender_request_not_sent
+
+# logging:
+# To avoid overriding logging destination of callers, the libs will not set on purpose any logging definition
+# and rely on callers themselves
+
+# relays:
+# the relay_url of a splunk_cloud account may list several relays (Heavy Forwarders), separated by commas. Each call
+# is sent to the relay with the least requests in progress in this process, ties are broken by the lowest average
+# latency, so that the load is spread over the relays and slower relays receive less. A relay which cannot be reached
+# is marked down for relay_down_time seconds and the call fails over to the next relay: get status calls on any
+# connection failure or timeout, scan calls only if the request was certainly not sent, so that a scan is never
+# started twice. Relays marked down are shared by the processes of the instance through relay_health_file, so that
+# the next searches do not wait for the same connection timeout. When every relay is down, the relay expected back
+# first is still tried.
+relay_down_time = 30
+relay_latency_alpha = 0.2
+relay_batches_in_flight = 2
+relay_health_file = os.path.join(splunkhome, 'var', 'run', 'splunk', 'splunk_start_defender_relay_health.json')
+
+
+# get the list of relay URLs of an account, https is enforced and the trailing slash removed
+def splunk_start_defender_get_relay_urls(relay_url):
+
+    relay_urls = []
+
+    for url in str(relay_url or '').replace(';', ',').split(','):
+        url = url.strip()
+        if not url:
+            continue
+        if not url.startswith("https://"):
+            url = "https://" + url
+        url = url.rstrip('/')
+        if url not in relay_urls:
+            relay_urls.append(url)
+
+    return relay_urls
+
+
+# check if a failed call shows the relay as unreachable, the client functions wrap the original exception which is
+# found in the exception context
+def splunk_start_defender_is_relay_unreachable(exception, idempotent=True):
+    while exception is not None:
+        if isinstance(exception, DeadlineExceeded):
+            return False
+        if splunk_start_defender_request_not_sent(exception):
+            return True
+        if idempotent and isinstance(exception, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+        exception = exception.__cause__ or exception.__context__
+    return False
+
+
+# load the relays marked down by the processes of the instance, as {relay_url: down_until (epoch)}
+def splunk_start_defender_load_relay_health():
+    try:
+        with open(relay_health_file, 'r') as f:
+            health = json.load(f)
+        return health if isinstance(health, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+# mark a relay down until down_until (epoch), or up if down_until is None, for the processes of the instance
+def splunk_start_defender_save_relay_health(relay_url, down_until):
+
+    try:
+        health = splunk_start_defender_load_relay_health()
+        now = time.time()
+        health = dict((url, until) for url, until in health.items() if isinstance(until, (int, float)) and until > now)
+        if down_until is None:
+            if relay_url not in health:
+                return
+            del health[relay_url]
+        else:
+            health[relay_url] = down_until
+
+        tmp_file = f"{relay_health_file}.{os.urandom(16).hex()}"
+        with open(tmp_file, 'w') as f:
+            json.dump(health, f)
+        os.replace(tmp_file, relay_health_file)
+
+    except Exception as e:
+        logging.error(f"Failed to update the relay health, file=\"{relay_health_file}\", exception=\"{str(e)}\"")
+
+
+class Relay(object):
+    """
+    A relay of a RelayPool and its metrics.
+    """
+
+    def __init__(self, url, down_until=0):
+        self.url = url
+        self.down_until = down_until
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.failovers = 0
+        self.latency_ms = None
+
+    def is_up(self, now):
+        return self.down_until <= now
+
+
+class RelayPool(object):
+    """
+    Thread safe selection of the relays of an account, with failover and per relay metrics.
+    """
+
+    def __init__(self, relay_url, down_time=relay_down_time):
+        self.down_time = down_time
+        self.lock = threading.Lock()
+
+        health = splunk_start_defender_load_relay_health()
+        self.relays = [Relay(url, health.get(url, 0) if isinstance(health.get(url, 0), (int, float)) else 0)
+            for url in splunk_start_defender_get_relay_urls(relay_url)]
+
+    def get_relay_urls(self):
+        return [relay.url for relay in self.relays]
+
+    def get_batches_in_flight(self):
+        """
+        Return the number of relay batches to keep in flight, relay_batches_in_flight per relay.
+        """
+        return relay_batches_in_flight * max(1, len(self.relays))
+
+    def acquire(self, excluded):
+        """
+        Select a relay which is not in excluded and count the request in progress, returns None if there is none.
+        """
+
+        with self.lock:
+            now = time.time()
+            candidates = [relay for relay in self.relays if relay not in excluded]
+            if not candidates:
+                return None
+
+            relays_up = [relay for relay in candidates if relay.is_up(now)]
+            if relays_up:
+                relay = min(relays_up, key=lambda relay: (relay.outstanding, relay.latency_ms or 0))
+            else:
+                relay = min(candidates, key=lambda relay: relay.down_until)
+
+            relay.outstanding += 1
+            return relay
+
+    def release(self, relay, start, exception=None):
+
+        with self.lock:
+            relay.outstanding -= 1
+            relay.requests += 1
+
+            if exception is not None:
+                relay.failures += 1
+                return
+
+            latency_ms = (time.perf_counter() - start) * 1000
+            if relay.latency_ms is None:
+                relay.latency_ms = latency_ms
+            else:
+                relay.latency_ms += relay_latency_alpha * (latency_ms - relay.latency_ms)
+
+            was_down = relay.down_until > 0
+            relay.down_until = 0
+
+        if was_down:
+            logging.info(f"relay=\"{relay.url}\" is reachable again")
+            splunk_start_defender_save_relay_health(relay.url, None)
+
+    def mark_down(self, relay):
+
+        with self.lock:
+            relay.down_until = time.time() + self.down_time
+            relay.failovers += 1
+            down_until = relay.down_until
+
+        splunk_start_defender_save_relay_health(relay.url, down_until)
+
+    def call(self, func, idempotent=True):
+        """
+        Return func(relay_url) from a selected relay, failing over to the next relays when a relay cannot be reached.
+        If idempotent is False, the call only fails over when the request was certainly not sent.
+        The exception of the last relay is raised if no relay could serve the call.
+        """
+
+        if not self.relays:
+            raise Exception("No relay is configured for this account, relay_url is required when running on Splunk Cloud")
+
+        excluded = []
+
+        while True:
+
+            relay = self.acquire(excluded)
+            start = time.perf_counter()
+
+            try:
+                response = func(relay.url)
+
+            except Exception as e:
+                if not splunk_start_defender_is_relay_unreachable(e, idempotent):
+                    self.release(relay, start, e)
+                    raise
+                # marked down before it is released, so that no other call selects it meanwhile
+                self.mark_down(relay)
+                self.release(relay, start, e)
+                excluded.append(relay)
+                if len(excluded) == len(self.relays):
+                    raise
+                logging.warning(f"relay=\"{relay.url}\" could not be reached, failing over to the next relay, exception=\"{str(e)}\"")
+                continue
+
+            self.release(relay, start)
+            return response
+
+    def get_metrics(self):
+        """
+        Return the metrics of each relay: requests, failures, failovers, requests in progress, average latency and state.
+        """
+
+        with self.lock:
+            now = time.time()
+            return [{
+                'relay': relay.url,
+                'requests': relay.requests,
+                'failures': relay.failures,
+                'failovers': relay.failovers,
+                'outstanding': relay.outstanding,
+                'latency_ms': round(relay.latency_ms, 2) if relay.latency_ms is not None else None,
+                'state': 'up' if relay.is_up(now) else 'down',
+            } for relay in self.relays]
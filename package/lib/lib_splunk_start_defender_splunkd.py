@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__author__ = "Guilhem Marchand for Mercedes"
+
+import io
+import logging
+import threading
+import collections
+import urllib3
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import splunklib.client as client
+import splunklib.binding as binding
+
+# logging:
+# To avoid overriding logging destination of callers, the libs will not set on purpose any logging definition
+# and rely on callers themselves
+
+# splunkd services:
+# the persistent REST API handler connects to the local splunkd with the system token of each request. Services are
+# cached per port and token and shared by the requests and their threads, rather than connecting for every request.
+# Their requests go through a keep-alive session, the default handler of splunklib opens a new TCP and TLS
+# connection per request. A service whose token is rejected by splunkd (401) is dropped, and the call is retried
+# once with a new service. The calls to splunkd never use the proxy.
+splunkd_service_max_entries = 8
+splunkd_pool_maxsize = 20
+splunkd_timeout = 60
+
+
+# a splunklib HTTP handler sending the requests of the services through a keep-alive session
+def splunk_start_defender_splunkd_handler(session, timeout=splunkd_timeout):
+    """
+    Return a splunklib handler, see splunklib.binding.HttpLib, using session for its requests.
+    The response body is read before the connection is returned to the pool.
+    """
+
+    def request(url, message, **kwargs):
+
+        with session.request(message.get('method', 'GET'), url, data=message.get('body') or None,
+            headers=dict(message['headers']), timeout=timeout, verify=False) as response:
+            body = response.content
+
+        return {
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': list(response.headers.items()),
+            'body': binding.ResponseReader(io.BytesIO(body)),
+        }
+
+    return request
+
+
+class ServiceCache(object):
+    """
+    Thread safe cache of splunklib services to the local splunkd, by port and token.
+    """
+
+    def __init__(self, owner='nobody', app='splunk_start_defender', max_entries=splunkd_service_max_entries):
+        self.owner = owner
+        self.app = app
+        self.max_entries = max_entries
+        self.services = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.connections = 0
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=splunkd_pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # splunklib does not use the proxy environment variables either
+        self.session.trust_env = False
+
+    def get(self, port, token):
+        """
+        Return the service for port and token, connecting if needed. The least recently used service is dropped
+        when more than max_entries are cached.
+        """
+
+        key = (str(port), token)
+
+        with self.lock:
+            service = self.services.get(key)
+            if service is not None:
+                self.services.move_to_end(key)
+                return service
+
+        # with a token, connecting does not call splunkd
+        service = client.connect(owner=self.owner, app=self.app, port=port, token=token,
+            handler=splunk_start_defender_splunkd_handler(self.session))
+
+        with self.lock:
+            self.connections += 1
+            service = self.services.setdefault(key, service)
+            self.services.move_to_end(key)
+            while len(self.services) > self.max_entries:
+                self.services.popitem(last=False)
+
+        return service
+
+    def discard(self, port, token, service):
+        """
+        Drop service from the cache, if it is still the cached service for port and token.
+        """
+
+        key = (str(port), token)
+
+        with self.lock:
+            if self.services.get(key) is service:
+                del self.services[key]
+
+    def call(self, port, token, func):
+        """
+        Return func(service) with the service for port and token. If splunkd rejects the token of a cached service,
+        the service is replaced and func is called once again.
+        """
+
+        service = self.get(port, token)
+
+        try:
+            return func(service)
+
+        except binding.HTTPError as e:
+            if e.status != 401:
+                raise
+            logging.info("splunkd rejected the token of a cached service, port=\"%s\", connecting again", port)
+            self.discard(port, token, service)
+
+        return func(self.get(port, token))
+
+    def clear(self):
+        with self.lock:
+            self.services.clear()
+
+    def close(self):
+        self.clear()
+        self.session.close()
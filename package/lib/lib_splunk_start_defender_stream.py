@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+__author__ = "Guilhem Marchand for Mercedes"
+
+import abc
+import time
+import logging
+
+from splunklib.searchcommands import StreamingCommand, Option, validators
+
+from lib_splunk_start_defender_logging import JsonMessage
+from lib_splunk_start_defender import splunk_start_defender_get_command_context, \
+    splunk_start_defender_run_concurrent, splunk_start_defender_run_batches, \
+    splunk_start_defender_set_timing, splunk_start_defender_get_timing_fields, \
+    splunk_start_defender_apply_command_context
+from lib_splunk_start_defender_relays import RelayPool
+
+# logging:
+# To avoid overriding logging destination of callers, the libs will not set on purpose any logging definition
+# and rely on callers themselves
+
+# streaming commands:
+# the streaming commands read the computer names from the upstream results and run a request per computer name, in
+# batches to the relays on Splunk Cloud, or concurrently against circ on the relay (threads or asyncio engine), and
+# yield the results as soon as they complete. DefenderStreamingCommand holds the options, the context and the
+# dispatching they share, each command only defines its own options and the calls it runs for a computer name.
+
+
+class DefenderStreamingCommand(StreamingCommand, metaclass=abc.ABCMeta):
+    """
+    Base class of the streaming commands, the commands implement the abstract methods call_relay_batch(), call_circ(),
+    call_circ_async() and get_summary(), and are decorated with @Configuration(). A command missing one of them cannot
+    be instantiated, it fails when started rather than while processing the records.
+    """
+
+    # the name of the command in the logs
+    command_name = None
+
+    # whether a batch can be sent again to another relay when the relay failed after the request was sent
+    relay_idempotent = True
+
+    # maximum number of requests started per second, unlimited unless the command defines the max_rate option
+    max_rate = None
+
+    account = Option(
+        doc='''
+        **Syntax:** **account=****
+        **Description:** account to be used for the query.''',
+        require=False, default="circapi_defender", validate=validators.Match("account", r"^.*$"))
+
+    field = Option(
+        doc='''
+        **Syntax:** **field=****
+        **Description:** name of the field in the upstream results containing the computer name, defaults to computername.''',
+        require=False, default="computername", validate=validators.Match("field", r"^.*$"))
+
+    max_concurrency = Option(
+        doc='''
+        **Syntax:** **max_concurrency=****
+        **Description:** maximum number of concurrent requests in flight, defaults to 10 (up to 100 with engine=threads).''',
+        require=False, default=10, validate=validators.Integer(minimum=1, maximum=1000))
+
+    engine = Option(
+        doc='''
+        **Syntax:** **engine=****
+        **Description:** when running on the relay, run the requests to circ on a pool of threads (threads, up to 100 requests in flight) or on an asyncio event loop (asyncio, for high fan-out sweeps with hundreds of requests in flight), defaults to threads.''',
+        require=False, default="threads", validate=validators.Set("threads", "asyncio"))
+
+    batch_size = Option(
+        doc='''
+        **Syntax:** **batch_size=****
+        **Description:** when running on Splunk Cloud, number of computer names sent to the relay per request, defaults to 100.''',
+        require=False, default=100, validate=validators.Integer(minimum=1, maximum=1000))
+
+    # instance_role and account configuration are retrieved once per search, and re-used for every chunk
+    instance_role = None
+    account_conf = None
+    timing = None
+    deadline = None
+    relays = None
+
+    @abc.abstractmethod
+    def call_relay_batch(self, relay_token, computernames, relay_url, timings):
+        """
+        Run the requests of a batch of computer names on the relay, returns the results of the batch.
+        """
+
+    @abc.abstractmethod
+    def call_circ(self, circ_token, computername, circ_url, timing):
+        """
+        Run the request of a computer name against circ, returns the response.
+        """
+
+    @abc.abstractmethod
+    async def call_circ_async(self, client, circ_token, computername, circ_url, timing):
+        """
+        Run the request of a computer name against circ with the asyncio client, returns the response.
+        """
+
+    @abc.abstractmethod
+    def get_summary(self, count, target):
+        """
+        Return the message logged once the records of a chunk are processed.
+        """
+
+    def get_computername(self, record):
+        """
+        Return the stripped computer name of an upstream record, an empty string if the field is missing or blank.
+        """
+        return str(record.get(self.field) or '').strip()
+
+    def get_context(self):
+
+        # time spent per phase, in milliseconds
+        if self.timing is None:
+            self.timing = {}
+
+        # get instance_role, loglevel and account in a single call
+        if self.instance_role is None:
+            search_start = time.monotonic()
+            start = time.perf_counter()
+            try:
+                command_context = splunk_start_defender_get_command_context(self._metadata.searchinfo.session_key, self._metadata.searchinfo.splunkd_uri, self.account)
+                self.instance_role = command_context['instance_role']
+                self.account_conf = command_context['account']
+
+            except Exception as e:
+                raise Exception(str(e))
+
+            splunk_start_defender_set_timing(self.timing, 'context_ms', start)
+
+            # set the log level, the timeouts and the proxy, requests are not sent nor retried once the deadline of the
+            # search is reached, the asyncio engine falls back to threads if it does not support the proxy
+            self.deadline, self.engine = splunk_start_defender_apply_command_context(command_context, search_start, self.engine)
+
+        return self.instance_role, self.account_conf
+
+    def stream(self, records):
+
+        instance_role, account_conf = self.get_context()
+
+        # time spent per computer name, in milliseconds
+        timings = {}
+
+        # act depending on the context
+        if instance_role in ('splunk_cloud'):
+
+            relay_url = account_conf.get('relay_url')
+            relay_token = account_conf.get('relay_token')
+
+            # the account may list several relays, batches are spread over the relays and fail over to the next relay
+            # if one cannot be reached, the relays and their metrics are kept for every chunk
+            if self.relays is None:
+                self.relays = RelayPool(relay_url)
+            relays = self.relays
+
+            # computer names are sent to the relays in batches, the relay runs the requests concurrently
+            def run_requests(queued_records):
+                return splunk_start_defender_run_batches(
+                    lambda batch: relays.call(lambda relay_url: self.call_relay_batch(relay_token, [self.get_computername(record) for record in batch], relay_url, timings), idempotent=self.relay_idempotent),
+                    queued_records, self.batch_size, relays.get_batches_in_flight(), self.get_computername)
+
+            target = 'relay=\"{}\"'.format(relay_url)
+
+        else:
+
+            circ_url = account_conf.get('circ_url')
+            circ_token = account_conf.get('circ_token')
+
+            def run_requests(queued_records):
+                if self.engine == 'asyncio':
+                    # the asyncio client (httpx) is only imported when used, to keep the startup of the command short
+                    from lib_splunk_start_defender_async import splunk_start_defender_run_async
+                    return splunk_start_defender_run_async(
+                        lambda client, record: self.call_circ_async(client, circ_token, self.get_computername(record), circ_url, timings.setdefault(self.get_computername(record), {})),
+                        queued_records, self.max_concurrency, self.max_rate)
+                return splunk_start_defender_run_concurrent(
+                    lambda record: self.call_circ(circ_token, self.get_computername(record), circ_url, timings.setdefault(self.get_computername(record), {})),
+                    queued_records, self.max_concurrency, self.max_rate)
+
+            target = 'circ=\"{}\"'.format(circ_url)
+
+        # records without a computer name, or with a blank one, are returned immediately as failures, others are queued
+        # for the pool
+        def get_queued_records():
+            for record in records:
+                if not self.get_computername(record):
+                    yield_record = dict(record)
+                    yield_record['_time'] = time.time()
+                    yield_record['_raw'] = {
+                        'action': 'failure',
+                        'exception': 'the field {} was not found or is empty in this record'.format(self.field),
+                    }
+                    failed_records.append(yield_record)
+                else:
+                    yield record
+
+        failed_records = []
+        count = 0
+
+        # run calls, results are yielded as soon as they complete
+        for record, response, exception in run_requests(get_queued_records()):
+
+            while failed_records:
+                yield_record = failed_records.pop(0)
+                logging.error(JsonMessage(yield_record))
+                yield yield_record
+
+            count += 1
+            yield_record = dict(record)
+            yield_record['_time'] = time.time()
+            yield_record.update(splunk_start_defender_get_timing_fields(self.timing, timings.pop(self.get_computername(record), None)))
+
+            if exception is None:
+                yield_record['_raw'] = response
+                logging.info(JsonMessage(yield_record))
+
+            else:
+                yield_record['_raw'] = {
+                    'action': 'failure',
+                    'computername': self.get_computername(record),
+                    'exception': str(exception),
+                }
+                logging.error(JsonMessage(yield_record))
+
+            yield yield_record
+
+        while failed_records:
+            yield_record = failed_records.pop(0)
+            logging.error(JsonMessage(yield_record))
+            yield yield_record
+
+        logging.info(self.get_summary(count, target))
+
+        if self.relays is not None:
+            logging.info("%s, relays=%s", self.command_name, JsonMessage(self.relays.get_metrics()))